@@ -0,0 +1,105 @@
+"""
+Бенчмарк конкурентности запросов на одном воркере (одном цикле событий): синхронные шлюзы блокируют цикл
+на время каждого запроса к БД, асинхронные - нет. Сетевая задержка до БД эмулируется через pg_sleep
+Запуск: python -m benchmarks.async_concurrency
+"""
+import asyncio
+from datetime import date, timedelta
+from time import perf_counter
+from unittest.mock import patch
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from hotel_business_module.gateways.async_gateways import AsyncCategoriesGateway
+from hotel_business_module.gateways.categories_gateway import CategoriesGateway
+from hotel_business_module.models.categories import Category
+from hotel_business_module.models.rooms import Room
+from hotel_business_module.tests.session import get_session, get_async_engine
+from hotel_business_module.utils.calendar_cache import calendar_cache
+from .common import clean_database, print_table
+
+REQUESTS = 200
+CONCURRENCY = (1, 10, 50)
+# задержка сети до БД в секундах
+LATENCY = 0.005
+ROOMS_COUNT = 20
+
+
+def spawn_category(db) -> Category:
+    category = Category(
+        name='bench_category', description='', price=1000, prepayment_percent=20, refund_percent=50,
+        main_photo_path='', rooms_count=ROOMS_COUNT, floors=1, beds=2, square=50,
+    )
+    db.add(category)
+    db.commit()
+    db.add_all([Room(category_id=category.id, room_number=number) for number in range(1, ROOMS_COUNT + 1)])
+    db.commit()
+    return category
+
+
+async def sync_request(category: Category, start: date, end: date, get_async_session):
+    # синхронный шлюз внутри async обработчика: цикл событий стоит, пока идут запросы
+    with get_session() as db:
+        db.execute(text('SELECT pg_sleep(:latency)'), {'latency': LATENCY})
+        CategoriesGateway.get_free_rooms(category, start, end, db)
+
+
+async def async_request(category: Category, start: date, end: date, get_async_session):
+    async with get_async_session() as db:
+        await db.execute(text('SELECT pg_sleep(:latency)'), {'latency': LATENCY})
+        await AsyncCategoriesGateway.get_free_rooms(category, start, end, db)
+
+
+async def measure(request, concurrency: int, category: Category, get_async_session):
+    """
+    Выполнение REQUESTS запросов с ограничением одновременных и замер задержки цикла событий
+    :return: запросов в секунду, максимальная задержка цикла событий в мс
+    """
+    start = date.today() + timedelta(days=1)
+    end = start + timedelta(days=30)
+    semaphore = asyncio.Semaphore(concurrency)
+    lag = 0.0
+    done = asyncio.Event()
+
+    async def heartbeat():
+        # насколько позже запланированного просыпается задача - столько цикл был занят
+        nonlocal lag
+        while not done.is_set():
+            started = perf_counter()
+            await asyncio.sleep(0.001)
+            lag = max(lag, perf_counter() - started - 0.001)
+
+    async def limited():
+        async with semaphore:
+            await request(category, start, end, get_async_session)
+
+    monitor = asyncio.create_task(heartbeat())
+    started = perf_counter()
+    await asyncio.gather(*(limited() for _ in range(REQUESTS)))
+    elapsed = perf_counter() - started
+    done.set()
+    await monitor
+    return REQUESTS / elapsed, lag * 1000
+
+
+async def run(category: Category):
+    engine = get_async_engine()
+    get_async_session = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+    rows = []
+    for concurrency in CONCURRENCY:
+        for name, request in (('sync', sync_request), ('async', async_request)):
+            rps, lag = await measure(request, concurrency, category, get_async_session)
+            rows.append((concurrency, name, f'{rps:.0f}', f'{lag:.1f}'))
+    await engine.dispose()
+    return rows
+
+
+def main():
+    # без кэша календарей каждый запрос идет в БД
+    with clean_database(), get_session() as db, patch.object(calendar_cache, 'max_size', 0):
+        category = spawn_category(db)
+        rows = asyncio.run(run(category))
+    print_table(('concurrency', 'flow', 'requests/s', 'max loop lag ms'), rows)
+
+
+if __name__ == '__main__':
+    main()
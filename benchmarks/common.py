@@ -0,0 +1,56 @@
+from contextlib import contextmanager
+from time import perf_counter
+from sqlalchemy import event
+from hotel_business_module.models.base import Base
+from hotel_business_module.tests.session import engine
+
+
+class StatementCounter:
+    """
+    Счетчик запросов, отправленных в БД
+    """
+    def __init__(self):
+        self.count = 0
+        self.commits = 0
+        self.elapsed = 0.0
+
+    def __call__(self, *args, **kwargs):
+        self.count += 1
+
+    def on_commit(self, *args, **kwargs):
+        self.commits += 1
+
+
+@contextmanager
+def count_statements():
+    """
+    Подсчет кол-ва запросов, фиксаций транзакций и времени выполнения блока
+    """
+    counter = StatementCounter()
+    event.listen(engine, 'before_cursor_execute', counter)
+    event.listen(engine, 'commit', counter.on_commit)
+    started = perf_counter()
+    try:
+        yield counter
+    finally:
+        counter.elapsed = perf_counter() - started
+        event.remove(engine, 'before_cursor_execute', counter)
+        event.remove(engine, 'commit', counter.on_commit)
+
+
+@contextmanager
+def clean_database():
+    """
+    Создание схемы тестовой БД на время бенчмарка
+    """
+    Base.metadata.create_all(engine)
+    try:
+        yield
+    finally:
+        Base.metadata.drop_all(engine)
+
+
+def print_table(header, rows):
+    widths = [max(len(str(item)) for item in column) for column in zip(header, *rows)]
+    for row in (header, *rows):
+        print('  '.join(str(item).rjust(width) for item, width in zip(row, widths)))
@@ -0,0 +1,102 @@
+"""
+Бенчмарк оформления заказа из корзины: кол-во запросов и фиксаций транзакций до и после
+Запуск: python -m benchmarks.confirm_cart
+"""
+from datetime import date, timedelta
+from hotel_business_module.gateways.carts_gateway import CartsGateway
+from hotel_business_module.gateways.clients_gateway import ClientsGateway
+from hotel_business_module.gateways.orders_gateway import OrdersGateway
+from hotel_business_module.models.categories import Category
+from hotel_business_module.models.orders import Cart, Order, Purchase
+from hotel_business_module.models.rooms import Room
+from hotel_business_module.models.users import User, Client
+from hotel_business_module.tests.session import get_session
+from .common import count_statements, clean_database, print_table
+
+PURCHASES_IN_CART = (1, 3, 10)
+REPEATS = 10
+
+
+def legacy_confirm_cart(cart: Cart, email: str, db, is_fully_paid: bool = False):
+    """
+    Исходная реализация CartsGateway.confirm_cart (для сравнения, без изменений).
+    Итоги корзины в ней читаются уже после переноса покупок, поэтому оплата получается нулевой,
+    на кол-во запросов и фиксаций это не влияет
+    """
+    client = db.query(User).filter(
+        User.email == email,
+    ).first()
+    if client is None:
+        client = Client(email=email)
+        ClientsGateway.save_client(client, db)
+
+    order = Order(client=client)
+    OrdersGateway.save_order(order, db)
+    db.query(Purchase).filter(
+        Purchase.order_id == cart.id,
+    ).update({'order_id': order.id})
+    db.refresh(cart)
+    db.delete(cart)
+    db.commit()
+
+    if is_fully_paid:
+        order.paid = cart.price
+    else:
+        order.paid = cart.prepayment
+    OrdersGateway.save_order(order, db)
+
+    return order
+
+
+def spawn_cart(db, room: Room, purchases_count: int, offset: int) -> Cart:
+    cart = Cart()
+    db.add(cart)
+    db.commit()
+    start = date.today() + timedelta(days=offset)
+    db.add_all([
+        Purchase(
+            order_id=cart.id, room_id=room.id, price=1000, prepayment=200, refund=500,
+            start=start + timedelta(days=day), end=start + timedelta(days=day + 1),
+        )
+        for day in range(purchases_count)
+    ])
+    db.commit()
+    return cart
+
+
+def main():
+    rows = []
+    with clean_database(), get_session() as db:
+        category = Category(
+            name='bench_category', description='', price=1000, prepayment_percent=20, refund_percent=50,
+            main_photo_path='', rooms_count=1, floors=1, beds=2, square=50,
+        )
+        client = Client(email='bench@gmail.com')
+        db.add_all([category, client])
+        db.commit()
+        room = Room(category_id=category.id, room_number=1)
+        db.add(room)
+        db.commit()
+
+        offset = 0
+        for purchases_count in PURCHASES_IN_CART:
+            for name, confirm in (('legacy', legacy_confirm_cart), ('single', CartsGateway.confirm_cart)):
+                carts = []
+                for _ in range(REPEATS):
+                    carts.append(spawn_cart(db, room, purchases_count, offset))
+                    offset += purchases_count
+                with count_statements() as counter:
+                    for cart in carts:
+                        confirm(cart, client.email, db)
+                rows.append((
+                    purchases_count,
+                    name,
+                    counter.count // REPEATS,
+                    counter.commits // REPEATS,
+                    f'{counter.elapsed / REPEATS * 1000:.2f}',
+                ))
+    print_table(('purchases', 'flow', 'statements', 'commits', 'ms/call'), rows)
+
+
+if __name__ == '__main__':
+    main()
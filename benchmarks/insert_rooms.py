@@ -0,0 +1,37 @@
+"""
+Бенчмарк массового добавления комнат: проверки ссылок и уникальности номеров выполняются пачкой при flush,
+поэтому кол-во запросов не должно зависеть от кол-ва комнат
+Запуск: python -m benchmarks.insert_rooms
+"""
+from hotel_business_module.models.categories import Category
+from hotel_business_module.models.rooms import Room
+from hotel_business_module.tests.session import get_session
+from .common import count_statements, clean_database, print_table
+
+ROOMS_COUNTS = (10, 100, 500)
+
+
+def main():
+    rows = []
+    with clean_database(), get_session() as db:
+        category = Category(
+            name='bench_category', description='', price=1000, prepayment_percent=20, refund_percent=50,
+            main_photo_path='', rooms_count=sum(ROOMS_COUNTS), floors=1, beds=2, square=50,
+        )
+        db.add(category)
+        db.commit()
+        offset = 0
+        for rooms_count in ROOMS_COUNTS:
+            with count_statements() as counter:
+                db.add_all([
+                    Room(category_id=category.id, room_number=number)
+                    for number in range(offset + 1, offset + rooms_count + 1)
+                ])
+                db.commit()
+            offset += rooms_count
+            rows.append((rooms_count, counter.count, f'{counter.elapsed * 1000:.2f}'))
+    print_table(('rooms', 'statements', 'ms'), rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Бенчмарк входов на одном воркере (одном цикле событий): синхронный authenticate_user считает bcrypt
+прямо в цикле событий, асинхронный - в пуле потоков или процессов password_hasher
+Запуск: python -m benchmarks.login_throughput
+"""
+import asyncio
+from time import perf_counter
+from unittest.mock import patch
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from hotel_business_module.gateways import async_gateways
+from hotel_business_module.gateways.async_gateways import AsyncUsersGateway
+from hotel_business_module.gateways.users_gateway import UsersGateway
+from hotel_business_module.models.users import Client
+from hotel_business_module.settings import settings
+from hotel_business_module.tests.session import get_session, get_async_engine
+from hotel_business_module.utils.passwords import PasswordHasher, hash_password
+from .common import clean_database, print_table
+
+REQUESTS = 64
+CONCURRENCY = (1, 8, 32)
+# стоимость bcrypt ниже боевой, чтоб бенчмарк шел недолго (12 - примерно в 4 раза дольше на каждый вход)
+ROUNDS = 10
+WORKERS = 4
+EMAIL = 'bench@mail.com'
+PASSWORD = 'bench_password'
+
+
+async def sync_login(get_async_session):
+    # синхронный шлюз внутри async обработчика: цикл событий стоит, пока считается хэш
+    with get_session() as db:
+        UsersGateway.authenticate_user(EMAIL, PASSWORD, db)
+
+
+async def async_login(get_async_session):
+    async with get_async_session() as db:
+        await AsyncUsersGateway.authenticate_user(EMAIL, PASSWORD, db)
+
+
+async def measure(login, concurrency: int, get_async_session):
+    """
+    Выполнение REQUESTS входов с ограничением одновременных и замер задержки цикла событий
+    :return: входов в секунду, максимальная задержка цикла событий в мс
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    lag = 0.0
+    done = asyncio.Event()
+
+    async def heartbeat():
+        nonlocal lag
+        while not done.is_set():
+            started = perf_counter()
+            await asyncio.sleep(0.001)
+            lag = max(lag, perf_counter() - started - 0.001)
+
+    async def limited():
+        async with semaphore:
+            await login(get_async_session)
+
+    monitor = asyncio.create_task(heartbeat())
+    started = perf_counter()
+    await asyncio.gather(*(limited() for _ in range(REQUESTS)))
+    elapsed = perf_counter() - started
+    done.set()
+    await monitor
+    return REQUESTS / elapsed, lag * 1000
+
+
+async def run():
+    engine = get_async_engine()
+    get_async_session = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+    rows = []
+    for concurrency in CONCURRENCY:
+        rps, lag = await measure(sync_login, concurrency, get_async_session)
+        rows.append((concurrency, 'sync', f'{rps:.1f}', f'{lag:.1f}'))
+        for pool in ('thread', 'process'):
+            hasher = PasswordHasher(pool, WORKERS)
+            with patch.object(async_gateways, 'password_hasher', hasher):
+                rps, lag = await measure(async_login, concurrency, get_async_session)
+            hasher.shutdown()
+            rows.append((concurrency, f'async {pool} x{WORKERS}', f'{rps:.1f}', f'{lag:.1f}'))
+    await engine.dispose()
+    return rows
+
+
+def main():
+    with clean_database(), get_session() as db, patch.object(settings, 'BCRYPT_ROUNDS', ROUNDS):
+        db.add(Client(email=EMAIL, password=hash_password(PASSWORD), is_confirmed=True))
+        db.commit()
+        rows = asyncio.run(run())
+    print_table(('concurrency', 'flow', 'logins/s', 'max loop lag ms'), rows)
+
+
+if __name__ == '__main__':
+    main()
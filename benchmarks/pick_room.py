@@ -0,0 +1,69 @@
+"""
+Бенчмарк подбора комнаты: кол-во запросов и время не должны зависеть от продолжительности брони
+Запуск: python -m benchmarks.pick_room
+"""
+from datetime import date, timedelta
+from hotel_business_module.gateways.categories_gateway import CategoriesGateway
+from hotel_business_module.models.categories import Category
+from hotel_business_module.models.orders import Order, Purchase
+from hotel_business_module.models.rooms import Room
+from hotel_business_module.models.users import Client
+from hotel_business_module.tests.session import get_session
+from .common import count_statements, clean_database, print_table
+
+ROOMS_COUNT = 50
+STAY_LENGTHS = (1, 7, 14, 30, 90)
+REPEATS = 20
+
+
+def spawn_data(db):
+    """
+    Категория с комнатами, каждая из которых забронирована через день
+    """
+    category = Category(
+        name='bench_category', description='', price=1000, prepayment_percent=20, refund_percent=50,
+        main_photo_path='', rooms_count=ROOMS_COUNT, floors=1, beds=2, square=50,
+    )
+    client = Client(email='bench@gmail.com')
+    order = Order(client=client)
+    db.add_all([category, client, order])
+    # комнатам нужен id категории
+    db.commit()
+    rooms = [Room(category_id=category.id, room_number=number) for number in range(1, ROOMS_COUNT + 1)]
+    db.add_all(rooms)
+    db.commit()
+    today = date.today()
+    purchases = []
+    for room in rooms[:-1]:
+        for day in range(0, 120, 2):
+            purchases.append(Purchase(
+                order_id=order.id,
+                room_id=room.id,
+                start=today + timedelta(days=day),
+                end=today + timedelta(days=day + 1),
+            ))
+    db.add_all(purchases)
+    db.commit()
+    return category
+
+
+def main():
+    rows = []
+    with clean_database(), get_session() as db:
+        category = spawn_data(db)
+        start = date.today()
+        for stay_length in STAY_LENGTHS:
+            end = start + timedelta(days=stay_length)
+            with count_statements() as counter:
+                for _ in range(REPEATS):
+                    CategoriesGateway.pick_room(category, start, end, db)
+            rows.append((
+                stay_length,
+                counter.count // REPEATS,
+                f'{counter.elapsed / REPEATS * 1000:.2f}',
+            ))
+    print_table(('nights', 'statements', 'ms/call'), rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+"""
+Массовый импорт категорий, комнат, клиентов и покупок из csv (с заголовком) или jsonl
+Запуск: python -m hotel_business_module.commands.bulk_import {categories,rooms,clients,purchases} <файл> [--format csv|jsonl]
+"""
+import argparse
+import sys
+from ..gateways.import_gateway import ImportGateway
+from ..session.session import get_session
+
+IMPORTS = {
+    'categories': ImportGateway.import_categories,
+    'rooms': ImportGateway.import_rooms,
+    'clients': ImportGateway.import_clients,
+    'purchases': ImportGateway.import_purchases,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Массовый импорт через COPY')
+    parser.add_argument('kind', choices=IMPORTS.keys())
+    parser.add_argument('path')
+    parser.add_argument('--format', choices=(ImportGateway.CSV, ImportGateway.JSONL))
+    args = parser.parse_args(argv)
+    # по умолчанию формат определяется по расширению файла
+    file_format = args.format or (ImportGateway.JSONL if args.path.endswith('.jsonl') else ImportGateway.CSV)
+
+    with get_session() as db, open(args.path, encoding='utf-8', newline='') as source:
+        report = IMPORTS[args.kind](source, db, file_format)
+        print(f'импортировано: {report.imported}, отклонено: {len(report.rejected)}')
+        for row in report.rejected:
+            print(f'строка {row.line}: {row.reason}')
+        # ненулевой код возврата, если часть строк отклонена
+        return int(bool(report.rejected))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
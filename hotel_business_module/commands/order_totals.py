@@ -0,0 +1,22 @@
+"""
+Сверка хранимых итогов заказов (base_order.price_total, prepayment_total) с покупками
+Запуск: python -m hotel_business_module.commands.order_totals
+"""
+import argparse
+import sys
+from ..gateways.orders_gateway import OrdersGateway
+from ..session.session import get_session
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Пересчет итогов заказов по покупкам')
+    parser.parse_args(argv)
+
+    with get_session() as db:
+        fixed = OrdersGateway.reconcile_totals(db)
+        print(f'исправлено заказов: {fixed}')
+        return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
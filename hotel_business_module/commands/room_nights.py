@@ -0,0 +1,29 @@
+"""
+Обслуживание журнала занятых ночей комнат
+Запуск: python -m hotel_business_module.commands.room_nights {rebuild,verify}
+"""
+import argparse
+import sys
+from ..gateways.room_nights_gateway import RoomNightsGateway
+from ..session.session import get_session
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Журнал занятых ночей комнат (room_night)')
+    parser.add_argument('action', choices=('rebuild', 'verify'))
+    args = parser.parse_args(argv)
+
+    with get_session() as db:
+        drift = RoomNightsGateway.verify(db)
+        print(f'нет в журнале: {drift.missing}, лишних в журнале: {drift.extra}')
+        if args.action == 'verify':
+            # ненулевой код возврата, если журнал разошелся с покупками
+            return int(drift.missing > 0 or drift.extra > 0)
+
+        inserted = RoomNightsGateway.rebuild(db)
+        print(f'журнал перестроен, записано ночей: {inserted}')
+        return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
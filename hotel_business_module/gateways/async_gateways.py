@@ -0,0 +1,254 @@
+"""
+Асинхронные варианты шлюзов для AsyncSession (asyncpg).
+Методы выполняют синхронные методы шлюзов через AsyncSession.run_sync: запросы, проверки и кэши общие,
+а ввод-вывод БД не блокирует цикл событий. Хэширование паролей выполняется в пуле password_hasher.
+Объекты, полученные через асинхронный шлюз, нужно передавать обратно в его методы:
+ленивая загрузка связей работает только внутри них
+"""
+import inspect
+from functools import wraps
+from sqlalchemy.ext.asyncio import AsyncSession
+from ..models.categories import Category
+from ..models.photos import Photo
+from ..models.sales import Sale
+from ..models.tokens import Token
+from ..models.users import User
+from ..utils.file_manager import FileManager
+from ..utils.gateway_metrics import instrumented
+from ..utils.passwords import needs_rehash, password_hasher
+from ..utils.protocols import SupportsAsyncReading
+from .carts_gateway import CartsGateway
+from .categories_gateway import CategoriesGateway
+from .clients_gateway import ClientsGateway
+from .orders_gateway import OrdersGateway
+from .photos_gateway import PhotosGateway
+from .purchase_gateway import PurchasesGateway
+from .rooms_gateway import RoomsGateway
+from .sales_gateway import SalesGateway
+from .users_gateway import UsersGateway
+from .workers_gateway import WorkersGateway
+
+
+def run_in_session(method):
+    """
+    Асинхронная обертка синхронного метода шлюза: вместо сессии принимает AsyncSession (параметр db)
+    и выполняет метод на ее синхронной сессии
+    :param method: метод синхронного шлюза
+    :return: статический асинхронный метод
+    """
+    signature = inspect.signature(method)
+
+    @wraps(method)
+    async def wrapper(*args, **kwargs):
+        arguments = signature.bind(*args, **kwargs)
+        db: AsyncSession = arguments.arguments['db']
+
+        def call(session):
+            arguments.arguments['db'] = session
+            return method(*arguments.args, **arguments.kwargs)
+
+        return await db.run_sync(call)
+
+    return staticmethod(wrapper)
+
+
+@instrumented
+class AsyncCategoriesGateway:
+    """
+    Асинхронный CategoriesGateway
+    """
+    pick_room = run_in_session(CategoriesGateway.pick_room)
+    get_free_rooms = run_in_session(CategoriesGateway.get_free_rooms)
+    get_busy_dates = run_in_session(CategoriesGateway.get_busy_dates)
+    is_day_busy = run_in_session(CategoriesGateway.is_day_busy)
+    find_stays = run_in_session(CategoriesGateway.find_stays)
+    get_familiar = run_in_session(CategoriesGateway.get_familiar)
+    filter = run_in_session(CategoriesGateway.filter)
+    delete_category = run_in_session(CategoriesGateway.delete_category)
+    add_tag_to_category = run_in_session(CategoriesGateway.add_tag_to_category)
+    remove_tag_from_category = run_in_session(CategoriesGateway.remove_tag_from_category)
+    add_sale_to_category = run_in_session(CategoriesGateway.add_sale_to_category)
+    remove_sale_to_category = run_in_session(CategoriesGateway.remove_sale_to_category)
+    get_all = run_in_session(CategoriesGateway.get_all)
+    get_by_id = run_in_session(CategoriesGateway.get_by_id)
+
+    @staticmethod
+    async def save_category(
+            category: Category,
+            db: AsyncSession,
+            file: SupportsAsyncReading | None = None,
+            file_name: str | None = None,
+    ):
+        if file is not None and file_name is not None:
+            category.main_photo_path = await FileManager.asave_file(
+                file=file, file_name=file_name, old_path=category.main_photo_path
+            )
+        await db.run_sync(lambda session: CategoriesGateway.save_category(category, session))
+
+
+@instrumented
+class AsyncRoomsGateway:
+    """
+    Асинхронный RoomsGateway
+    """
+    save_room = run_in_session(RoomsGateway.save_room)
+    delete_room = run_in_session(RoomsGateway.delete_room)
+    get_all = run_in_session(RoomsGateway.get_all)
+    get_by_id = run_in_session(RoomsGateway.get_by_id)
+
+
+@instrumented
+class AsyncPhotosGateway:
+    """
+    Асинхронный PhotosGateway
+    """
+    delete_photo = run_in_session(PhotosGateway.delete_photo)
+    get_all = run_in_session(PhotosGateway.get_all)
+    get_by_id = run_in_session(PhotosGateway.get_by_id)
+
+    @staticmethod
+    async def save_photo(
+            photo: Photo,
+            db: AsyncSession,
+            file: SupportsAsyncReading | None = None,
+            file_name: str | None = None,
+    ):
+        if file is not None and file_name is not None:
+            photo.path = await FileManager.asave_file(file=file, file_name=file_name, old_path=photo.path)
+        await db.run_sync(lambda session: PhotosGateway.save_photo(photo, session))
+
+
+@instrumented
+class AsyncSalesGateway:
+    """
+    Асинхронный SalesGateway
+    """
+    delete_sale = run_in_session(SalesGateway.delete_sale)
+    filter = run_in_session(SalesGateway.filter)
+    get_all = run_in_session(SalesGateway.get_all)
+    get_by_id = run_in_session(SalesGateway.get_by_id)
+
+    @staticmethod
+    async def save_sale(
+            sale: Sale,
+            db: AsyncSession,
+            file: SupportsAsyncReading | None = None,
+            file_name: str | None = None,
+    ):
+        if file is not None and file_name is not None:
+            sale.image_path = await FileManager.asave_file(file=file, file_name=file_name, old_path=sale.image_path)
+        await db.run_sync(lambda session: SalesGateway.save_sale(sale, session, None, None))
+
+
+@instrumented
+class AsyncPurchasesGateway:
+    """
+    Асинхронный PurchasesGateway
+    """
+    quote_many = run_in_session(PurchasesGateway.quote_many)
+    save_purchase = run_in_session(PurchasesGateway.save_purchase)
+    allocate_purchases = run_in_session(PurchasesGateway.allocate_purchases)
+    mark_as_canceled = run_in_session(PurchasesGateway.mark_as_canceled)
+    get_all = run_in_session(PurchasesGateway.get_all)
+    get_by_id = run_in_session(PurchasesGateway.get_by_id)
+
+
+@instrumented
+class AsyncOrdersGateway:
+    """
+    Асинхронный OrdersGateway
+    """
+    reconcile_totals = run_in_session(OrdersGateway.reconcile_totals)
+    save_order = run_in_session(OrdersGateway.save_order)
+    record_payment = run_in_session(OrdersGateway.record_payment)
+    record_refund = run_in_session(OrdersGateway.record_refund)
+    mark_as_canceled = run_in_session(OrdersGateway.mark_as_canceled)
+    mark_as_paid = run_in_session(OrdersGateway.mark_as_paid)
+    finish_orders = run_in_session(OrdersGateway.finish_orders)
+    get_all = run_in_session(OrdersGateway.get_all)
+    get_by_id = run_in_session(OrdersGateway.get_by_id)
+
+
+@instrumented
+class AsyncCartsGateway:
+    """
+    Асинхронный CartsGateway
+    """
+    confirm_cart = run_in_session(CartsGateway.confirm_cart)
+    clean_carts = run_in_session(CartsGateway.clean_carts)
+    save_cart = run_in_session(CartsGateway.save_cart)
+    get_by_uuid = run_in_session(CartsGateway.get_by_uuid)
+
+
+@instrumented
+class AsyncClientsGateway:
+    """
+    Асинхронный ClientsGateway
+    """
+    save_client = run_in_session(ClientsGateway.save_client)
+    delete_client = run_in_session(ClientsGateway.delete_client)
+    get_all = run_in_session(ClientsGateway.get_all)
+    get_by_id = run_in_session(ClientsGateway.get_by_id)
+    get_all_client_orders = run_in_session(ClientsGateway.get_all_client_orders)
+    get_client_order_by_id = run_in_session(ClientsGateway.get_client_order_by_id)
+
+
+@instrumented
+class AsyncUsersGateway:
+    """
+    Асинхронный UsersGateway (регистрация, вход, токены и права)
+    """
+    get_permission_codes = run_in_session(UsersGateway.get_permission_codes)
+    get_user_permissions = run_in_session(UsersGateway.get_user_permissions)
+    can_actions = run_in_session(UsersGateway.can_actions)
+    confirm_account = run_in_session(UsersGateway.confirm_account)
+    request_reset = run_in_session(UsersGateway.request_reset)
+    check_token = run_in_session(UsersGateway.check_token)
+    refresh_auth_tokens = run_in_session(UsersGateway.refresh_auth_tokens)
+    generate_auth_tokens = staticmethod(UsersGateway.generate_auth_tokens)
+    get_all = run_in_session(UsersGateway.get_all)
+    get_by_id = run_in_session(UsersGateway.get_by_id)
+
+    @staticmethod
+    async def authenticate_user(login: str, password: str, db: AsyncSession):
+        user = await db.run_sync(lambda session: UsersGateway.get_by_email(login, session))
+        if user is None or not await password_hasher.check(password, user.password) or not user.is_confirmed:
+            raise ValueError('Активный пользователь с таким логином и паролем не найден')
+        if needs_rehash(user.password):
+            hashed_password = await password_hasher.hash(password)
+            await db.run_sync(lambda session: UsersGateway.set_password(user, hashed_password, session))
+        return user
+
+    @staticmethod
+    async def register_user(user: User, db: AsyncSession):
+        hashed_password = await password_hasher.hash(user.password)
+        return await db.run_sync(
+            lambda session: UsersGateway.register_user(user, session, hashed_password=hashed_password)
+        )
+
+    @staticmethod
+    async def confirm_reset(token: Token, password: str, db: AsyncSession):
+        hashed_password = await password_hasher.hash(password)
+        await db.run_sync(
+            lambda session: UsersGateway.confirm_reset(token, None, session, hashed_password=hashed_password)
+        )
+
+
+@instrumented
+class AsyncWorkersGateway:
+    """
+    Асинхронный WorkersGateway
+    """
+    save_worker = run_in_session(WorkersGateway.save_worker)
+    delete_worker = run_in_session(WorkersGateway.delete_worker)
+    add_group_to_worker = run_in_session(WorkersGateway.add_group_to_worker)
+    remove_group_from_worker = run_in_session(WorkersGateway.remove_group_from_worker)
+    get_all = run_in_session(WorkersGateway.get_all)
+    get_by_id = run_in_session(WorkersGateway.get_by_id)
+
+    @staticmethod
+    async def create_superuser(email: str, password: str, db: AsyncSession):
+        hashed_password = await password_hasher.hash(password)
+        await db.run_sync(
+            lambda session: WorkersGateway.create_superuser(email, None, session, hashed_password=hashed_password)
+        )
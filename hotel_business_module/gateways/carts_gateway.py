@@ -1,45 +1,128 @@
-from ..models.orders import Purchase, Order, Cart
+from ..models.orders import Purchase, Order, Cart, BaseOrder
 from ..models.users import User, Client
-from .clients_gateway import ClientsGateway
 from .orders_gateway import OrdersGateway
+from ..utils import purchase_events
 from ..settings import settings
+from ..utils.gateway_metrics import instrumented
+from sqlalchemy import select, delete, update
 from sqlalchemy.orm import Session
-from datetime import datetime, timedelta
+from datetime import datetime
+from typing import Iterable, NamedTuple
+from _decimal import Decimal
 
 
+class CleanStats(NamedTuple):
+    # удаленные корзины
+    carts: int
+    # удаленные покупки корзин
+    purchases: int
+    # освобожденные ночи комнат
+    nights: int
+
+
+@instrumented
 class CartsGateway:
     @staticmethod
     def confirm_cart(cart: Cart, email: str, db: Session, is_fully_paid: bool = False):
+        """
+        Оформление заказа из корзины одной транзакцией
+        :param cart: корзина
+        :param email: эл. почта клиента (если клиента с ней нет, то он создается)
+        :param db: сессия БД
+        :param is_fully_paid: оплачен ли заказ полностью (иначе оплачена предоплата)
+        :return: созданный заказ
+        """
         client = db.query(User).filter(
             User.email == email,
         ).first()
         if client is None:
             client = Client(email=email)
-            ClientsGateway.save_client(client, db)
+            db.add(client)
 
         order = Order(client=client)
-        OrdersGateway.save_order(order, db)
-        db.query(Purchase).filter(
-            Purchase.order_id == cart.id,
-        ).update({'order_id': order.id})
-        db.refresh(cart)
-        db.delete(cart)
-        db.commit()
+        db.add(order)
+        db.flush()
+        # переносим покупки в заказ, итоги корзины переходят к заказу триггером
+        moved = db.execute(
+            update(Purchase).where(
+                Purchase.order_id == cart.id,
+            ).values(order_id=order.id).returning(Purchase.order_price, Purchase.prepayment)
+        ).all()
+        db.execute(CartsGateway.delete_carts_statement([cart.id]))
+        if cart in db:
+            db.expunge(cart)
 
         if is_fully_paid:
-            order.paid = cart.price
+            amount = sum((row.order_price for row in moved), Decimal(0))
         else:
-            order.paid = cart.prepayment
-        OrdersGateway.save_order(order, db)
+            amount = sum((row.prepayment for row in moved), Decimal(0))
+        if amount > 0:
+            db.execute(OrdersGateway.payment_statement(order.id, amount))
+        db.commit()
+        OrdersGateway.expire_payment(order, db)
 
         return order
 
     @staticmethod
-    def clean_carts(db: Session):
-        db.query(Cart).filter(
-            Cart.date_created < datetime.now(tz=settings.TIMEZONE) - timedelta(hours=24)
-        ).delete()
-        db.commit()
+    def clean_carts(
+            db: Session,
+            batch_size: int | None = None,
+            max_batches: int | None = None,
+    ) -> CleanStats:
+        """
+        Удаление брошенных корзин и их покупок частями в отдельных транзакциях.
+        Корзины блокируются с пропуском заблокированных, поэтому чистку можно запускать параллельно на нескольких узлах
+        :param db: сессия БД
+        :param batch_size: кол-во корзин в одной транзакции
+        :param max_batches: максимум транзакций за запуск (остальные корзины удалит следующий запуск)
+        :return: статистика запуска
+        """
+        batch_size = batch_size or settings.CART_REAPER_BATCH_SIZE
+        max_batches = max_batches or settings.CART_REAPER_MAX_BATCHES
+        expired = datetime.now(tz=settings.TIMEZONE) - settings.CART_LIFETIME
+        carts = purchases = nights = 0
+        for _ in range(max_batches):
+            # самые старые корзины выбираются по индексу (type, date_created)
+            cart_ids = db.scalars(
+                select(BaseOrder.id).where(
+                    BaseOrder.type == 'cart',
+                    BaseOrder.date_created < expired,
+                ).order_by(BaseOrder.date_created).limit(batch_size).with_for_update(skip_locked=True)
+            ).all()
+            if not cart_ids:
+                db.commit()
+                break
+            # удаляем покупки брошенных корзин, чтоб освободить комнаты (ночи из журнала удаляются каскадно)
+            deleted = db.execute(
+                delete(Purchase).where(
+                    Purchase.order_id.in_(cart_ids),
+                ).returning(*OrdersGateway.RELEASED_COLUMNS)
+            ).all()
+            db.execute(CartsGateway.delete_carts_statement(cart_ids))
+            changes = OrdersGateway.released_changes(deleted, db)
+            db.commit()
+            purchase_events.dispatch(changes)
+
+            carts += len(cart_ids)
+            purchases += len(deleted)
+            nights += sum((row.end - row.start).days for row in deleted)
+            if len(cart_ids) < batch_size:
+                break
+        return CleanStats(carts, purchases, nights)
+
+    @staticmethod
+    def delete_carts_statement(cart_ids: Iterable[int]):
+        """
+        Запрос удаления корзин сразу из обеих таблиц наследования (cart и base_order)
+        :param cart_ids: id корзин
+        :return:
+        """
+        deleted_carts = delete(Cart.__table__).where(
+            Cart.__table__.c.id.in_(list(cart_ids)),
+        ).returning(Cart.__table__.c.id).cte('deleted_carts')
+        return delete(BaseOrder.__table__).where(
+            BaseOrder.__table__.c.id.in_(select(deleted_carts.c.id)),
+        )
 
     @staticmethod
     def save_cart(cart: Cart, db: Session):
@@ -1,29 +1,78 @@
 from datetime import date, timedelta, datetime
-from typing import Optional
+from typing import Optional, Dict, Iterable, List, NamedTuple
 import math
-from sqlalchemy import func, text, desc
+from sqlalchemy import func, text, desc, select, cast, join, and_, distinct, false, true, Date, Integer
 from ..models.categories import Category
 from ..models.rooms import Room
 from ..models.tags import Tag, category_tag
 from ..models.sales import Sale
 from ..models.orders import Purchase
+from ..models.room_nights import RoomNight
 from ..settings import settings
+from ..session.routing import replica_read
+from ..utils.gateway_metrics import instrumented
 from hotel_business_module.utils.file_manager import FileManager
 from hotel_business_module.utils.protocols import SupportsReading, SupportsAsyncReading
-from sqlalchemy.orm import Session
+from hotel_business_module.utils.calendar_cache import calendar_cache
+from hotel_business_module.utils.sales_timeline import sales_timeline
+from sqlalchemy.orm import Session, aliased
 
 
+class StayOption(NamedTuple):
+    category: Category
+    start: date
+    # кол-во комнат категории, свободных на все ночи
+    free_rooms: int
+
+
+@instrumented
 class CategoriesGateway:
     """
     Класс для управления категориями
     """
+    @staticmethod
+    def __room_busy(start: date, end: date, purchase_id: int | None = None):
+        """
+        Условие "комната (Room) занята хотя бы одну ночь периода"
+        :param start: дата начала периода
+        :param end: дата конца периода (ночь этого дня не входит)
+        :param purchase_id: id покупки, брони которой не учитываются
+        :return:
+        """
+        if settings.ROOM_NIGHT_LEDGER:
+            # по журналу это поиск по первичному ключу (room_id, night)
+            overlapping = select(RoomNight.night).where(
+                RoomNight.room_id == Room.id,
+                RoomNight.night >= start,
+                RoomNight.night < end,
+            )
+            if purchase_id is not None:
+                overlapping = overlapping.where(RoomNight.purchase_id != purchase_id)
+            return overlapping.exists()
+
+        # брони комнаты, пересекающиеся с запрашиваемым периодом (условие покрывается gist индексом purchase)
+        overlapping = select(Purchase.id).where(
+            Purchase.room_id == Room.id,
+            Purchase.is_canceled == False,
+            func.daterange(Purchase.start, Purchase.end).op('&&')(
+                func.daterange(cast(start, Date), cast(end, Date))
+            ),
+        )
+        if purchase_id is not None:
+            overlapping = overlapping.where(Purchase.id != purchase_id)
+        return overlapping.exists()
+
+    # способы выбора комнаты среди свободных
+    PICK_STRATEGIES = ('first', 'random', 'best_fit')
+
     @staticmethod
     def pick_room(
             category: Category,
             start: date,
             end: date,
             db: Session,
-            purchase_id: int | None = None
+            purchase_id: int | None = None,
+            strategy: str = 'first',
     ) -> int | None:
         """
         Поиск свободной комнаты категории
@@ -32,41 +81,126 @@ class CategoriesGateway:
         :param end: дата конца брони
         :param db: сессия БД
         :param purchase_id: id покупки, если нужно подобрать комнату для обновления покупки, а не создания новой
+        :param strategy: способ выбора среди свободных комнат: first - с наименьшим id, random - случайная,
+        best_fit - комната, предыдущая бронь которой заканчивается ближе всего к началу (меньше "дыр" в календаре)
         :return: id комнаты, если нашлась подходящая, иначе None
         """
-        # комнаты категории
-        rooms = db.query(Room).filter(
+        if strategy not in CategoriesGateway.PICK_STRATEGIES:
+            raise ValueError(f'Неизвестный способ выбора комнаты: {strategy}')
+
+        # свободные комнаты категории ищем одним запросом, вне зависимости от продолжительности брони
+        free_rooms = select(Room.id).where(
             Room.date_deleted == None,
             Room.category_id == category.id,
-        ).with_entities(Room.id).all()
-        # id комнат категории
-        free_rooms = {item[0] for item in rooms}
-        # обявления первого дня проверки
-        day_to_check = start
-
-        while free_rooms and day_to_check < end:
-            # занятые комнаты на проверяемую дату
-            busy_rooms = db.query(Purchase).filter(
-                Purchase.room_id.in_(free_rooms),
+            ~CategoriesGateway.__room_busy(start, end, purchase_id),
+        )
+
+        if strategy == 'random':
+            free_rooms = free_rooms.order_by(func.random())
+        elif strategy == 'best_fit':
+            # дата окончания последней брони комнаты перед запрашиваемым периодом
+            previous_end = select(func.max(Purchase.end)).where(
+                Purchase.room_id == Room.id,
                 Purchase.is_canceled == False,
-                Purchase.start <= day_to_check,
-                Purchase.end > day_to_check,
-                Purchase.id != purchase_id
-            ).with_entities(Purchase.room_id).all()
+                Purchase.end <= start,
+            ).scalar_subquery()
+            free_rooms = free_rooms.order_by(previous_end.desc().nulls_last(), Room.id)
+        else:
+            free_rooms = free_rooms.order_by(Room.id)
+
+        return db.scalar(free_rooms.limit(1))
+
+    @staticmethod
+    def __free_rooms_by_day(category_id, date_start: date, date_end: date):
+        """
+        Запрос кол-ва свободных комнат категории по дням (колонки day и free)
+        :param category_id: id категории или колонка, если запрос нужно связать с внешним
+        :param date_start: дата начала проверки
+        :param date_end: дата конца проверки (включительно)
+        :return:
+        """
+        days = func.generate_series(date_start, date_end, timedelta(days=1)).table_valued('day').render_derived()
+        day = cast(days.c.day, Date)
+        # кол-во действующих комнат категории
+        category_rooms = aliased(Room)
+        rooms_count = select(func.count(category_rooms.id)).where(
+            category_rooms.category_id == category_id,
+            category_rooms.date_deleted == None,
+        ).correlate_except(category_rooms).scalar_subquery()
+        # к каждому дню присоединяем брони комнат категории, которые на него приходятся
+        if settings.ROOM_NIGHT_LEDGER:
+            busy_rooms = join(RoomNight, Room, RoomNight.room_id == Room.id)
+            busy_room_id = RoomNight.room_id
+            busy_on_day = RoomNight.night == day
+        else:
+            busy_rooms = join(Purchase, Room, Purchase.room_id == Room.id)
+            busy_room_id = Purchase.room_id
+            busy_on_day = and_(
+                Purchase.is_canceled == False,
+                func.daterange(Purchase.start, Purchase.end).op('@>')(day),
+            )
+        return select(
+            day.label('day'),
+            (rooms_count - func.count(distinct(busy_room_id))).label('free'),
+        ).select_from(
+            days.outerjoin(busy_rooms, and_(
+                Room.category_id == category_id,
+                Room.date_deleted == None,
+                busy_on_day,
+            ))
+        ).group_by(days.c.day)
+
+    @staticmethod
+    def get_free_rooms(category: Category, date_start: date, date_end: date, db: Session) -> Dict[date, int]:
+        """
+        Получение кол-ва свободных комнат категории по дням (одним запросом)
+        :param category: категория, комнаты которой нужно проверить
+        :param date_start: дата начала проверки
+        :param date_end: дата конца проверки (включительно)
+        :param db: сессия БД
+        :return: словарь {дата: кол-во свободных комнат}, прошедшие даты считаются полностью занятыми
+        """
+        if date_end < date.today():
+            # если запрашиваем прошедшие даты, то проверять смысла нету и возвращаем, что все занято
+            return {date_start + timedelta(days=x): 0 for x in range((date_end - date_start).days + 1)}
 
-            # убираем занятые комнаты
-            free_rooms -= {item[0] for item in busy_rooms}
-            # передвигаем день
-            day_to_check += timedelta(days=1)
+        if calendar_cache.enabled:
+            calendar = CategoriesGateway.__cached_free_rooms(category.id, date_start, date_end, db)
+        else:
+            calendar = db.execute(
+                CategoriesGateway.__free_rooms_by_day(category.id, date_start, date_end).order_by(text('day'))
+            ).all()
+        return {day: free if day >= date.today() else 0 for day, free in calendar}
 
-        if not free_rooms:
-            return None
+    @staticmethod
+    def __cached_free_rooms(category_id: int, date_start: date, date_end: date, db: Session):
+        """
+        Получение кол-ва свободных комнат по дням через кэш календарей по месяцам,
+        недостающие месяцы загружаются одним запросом
+        """
+        months = calendar_cache.months(date_start, date_end)
+        cached = {month: calendar_cache.get(calendar_cache.month_key(category_id, month)) for month in months}
+        missing = [month for month, calendar in cached.items() if calendar is None]
+        if missing:
+            generation = calendar_cache.generation
+            load_end = calendar_cache.next_month(missing[-1]) - timedelta(days=1)
+            loaded = db.execute(
+                CategoriesGateway.__free_rooms_by_day(category_id, missing[0], load_end).order_by(text('day'))
+            ).all()
+            # календарь, прочитанный с реплики, может отставать и не должен попадать в общий кэш
+            from_replica = getattr(db, 'reads_replica', False)
+            for month in missing:
+                cached[month] = {day: free for day, free in loaded if (day.year, day.month) == (month.year, month.month)}
+                if not from_replica:
+                    calendar_cache.set(calendar_cache.month_key(category_id, month), cached[month], generation)
 
-        # т.к. может вернуться несколько подходящих комнат, возвращаем первую
-        picked_room_id = list(free_rooms)[0]
-        return picked_room_id
+        return [
+            (day, free) for calendar in cached.values() for day, free in calendar.items()
+            if date_start <= day <= date_end
+        ]
 
     @staticmethod
+    @replica_read
     def get_busy_dates(category: Category, date_start: date, date_end: date, db: Session):
         """
         Получение занятых дней комнат категории
@@ -76,22 +210,8 @@ class CategoriesGateway:
         :param db: сессия БД
         :return:
         """
-        if date_end < date.today():
-            # если запрашиваем прошедшие даты, то проверять смысла нету и возвращаем, что все занято
-            return sorted([
-                date_start + timedelta(days=x) for x in range((date_end - date_start).days + 1)
-            ])
-
-        current_day = date_start
-        busy_dates = []
-        while current_day <= date_end:
-            # проверяем занят ли день и не прошедшая ли дата
-            if current_day < date.today() or CategoriesGateway.is_day_busy(category, current_day, db):
-                busy_dates.append(current_day)
-            current_day += timedelta(days=1)
-        # сортируем даты
-        busy_dates.sort()
-        return busy_dates
+        calendar = CategoriesGateway.get_free_rooms(category, date_start, date_end, db)
+        return [day for day, free in calendar.items() if free <= 0]
 
     @staticmethod
     def is_day_busy(category: Category, day: date, db: Session):
@@ -102,36 +222,77 @@ class CategoriesGateway:
         :param db: сессия БД
         :return:
         """
-        #  если нету комнат, то возвращаем как занятно
-        if not db.query(
-                db.query(Room).filter(
-                    Room.category_id == category.id,
-                    Room.date_deleted == None,
-                ).exists()
-        ).scalar():
-            return True
-
-        # получаем брони, которые есть на этот день
-        purchases = db.query(Purchase.room_id).filter(
-            Purchase.start <= day,
-            Purchase.end > day,
-            Purchase.is_canceled == False
-        ).subquery('purchases')
-
-        # если есть хоть одна комната, на которую нету брони в этот день, то есть свободная
-        if db.query(
-                db.query(Room).filter(
-                    Room.category_id == category.id,
-                    Room.date_deleted == None,
-                    Room.id.not_in(
-                        purchases
-                    )
-                ).exists()
-        ).scalar():
-            return False
-        return True
+        # если нету комнат или на все есть брони, то день занят
+        free = db.execute(CategoriesGateway.__free_rooms_by_day(category.id, day, day)).one().free
+        return free <= 0
+
+    @staticmethod
+    def find_stays(
+            date_start: date,
+            date_end: date,
+            nights: int,
+            db: Session,
+            category_ids: Iterable[int] | None = None,
+            show_hidden: bool = False,
+            limit: int = 10,
+    ) -> List[StayOption]:
+        """
+        Поиск вариантов заезда на несколько ночей в пределах периода ("любые 3 ночи в ближайшие 2 месяца")
+        :param date_start: самая ранняя дата заезда
+        :param date_end: самая поздняя дата выезда
+        :param nights: кол-во ночей
+        :param db: сессия БД
+        :param category_ids: id категорий, среди которых искать (по умолчанию все)
+        :param show_hidden: искать ли среди скрытых категорий
+        :param limit: кол-во возвращаемых вариантов
+        :return: варианты (категория, дата заезда, кол-во свободных комнат), самые ранние и дешевые первыми
+        """
+        if nights < 1 or limit < 1:
+            raise ValueError('кол-во ночей и вариантов не может быть меньше 1')
+        if (date_end - date_start).days > 366:
+            raise ValueError('нельзя запросить больше 366 дней')
+        # прошедшие даты всегда заняты
+        date_start = max(date_start, date.today())
+        last_night = date_end - timedelta(days=1)
+        if (last_night - date_start).days + 1 < nights:
+            return []
+
+        days = func.generate_series(date_start, last_night, timedelta(days=1)).table_valued('day').render_derived()
+        day = cast(days.c.day, Date)
+        # занятость каждой комнаты по дням (1 - занята, 0 - свободна)
+        rooms_days = select(Room.id.label('room_id'), Room.category_id, day.label('day')).add_columns(
+            cast(CategoriesGateway.__room_busy(day, day + 1), Integer).label('busy'),
+        ).select_from(Room).join(days, true()).where(
+            Room.date_deleted == None,
+        )
+        if category_ids is not None:
+            rooms_days = rooms_days.where(Room.category_id.in_(list(category_ids)))
+        rooms_days = rooms_days.subquery()
+
+        # скользящим окном считаем занятые ночи (и ночи вообще, чтоб отбросить обрезанные окна в конце периода)
+        window = dict(partition_by=rooms_days.c.room_id, order_by=rooms_days.c.day, rows=(0, nights - 1))
+        windows = select(
+            rooms_days.c.category_id,
+            rooms_days.c.day,
+            func.sum(rooms_days.c.busy).over(**window).label('busy_nights'),
+            func.count().over(**window).label('window_nights'),
+        ).subquery()
+
+        free_rooms = func.count().label('free_rooms')
+        options = select(Category, windows.c.day, free_rooms).join(
+            windows, windows.c.category_id == Category.id,
+        ).where(
+            windows.c.busy_nights == 0,
+            windows.c.window_nights == nights,
+            Category.date_deleted == None,
+        ).group_by(Category.id, windows.c.day).order_by(windows.c.day, Category.price, Category.id).limit(limit)
+        if not show_hidden:
+            options = options.where(Category.is_hidden == False)
+
+        return [StayOption(category, start, free) for category, start, free in db.execute(options).all()]
 
     @staticmethod
+    @replica_read
     def get_familiar(category: Category, db: Session):
         """
         Получение похожих категория (с похожими тегами)
@@ -170,6 +331,7 @@ class CategoriesGateway:
         return familiar_items
 
     @staticmethod
+    @replica_read
     def filter(db: Session, filter: dict | None = None):
         """
         Фильтрация категорий
@@ -238,18 +400,19 @@ class CategoriesGateway:
                 Category.rooms_count <= filter['rooms_until']
             )
         if 'free_dates' in filter:
-            categories_to_check = categories.all()
             date_from = filter['free_dates']['date_from']
             date_until = filter['free_dates']['date_until']
             if (date_until - date_from).days > 31:
                 raise ValueError('нельзя запросить больше 31 дня')
-            busy_categories_ids = []
-            for category in categories_to_check:
-                if CategoriesGateway.get_busy_dates(category, date_from, date_until, db=db):
-                    busy_categories_ids.append(category.id)
-            categories = categories.filter(
-                Category.id.not_in(busy_categories_ids)
-            )
+            if date_from < date.today():
+                # прошедшие даты всегда заняты, поэтому под фильтр не подходит ни одна категория
+                categories = categories.filter(false())
+            else:
+                # исключаем категории, у которых есть хоть один день без свободных комнат
+                busy_days = CategoriesGateway.__free_rooms_by_day(Category.id, date_from, date_until)
+                categories = categories.filter(
+                    ~busy_days.having(busy_days.selected_columns.free <= 0).exists()
+                )
 
         if filter['desc']:
             categories = categories.order_by(desc(filter['sort_by']))
@@ -261,8 +424,15 @@ class CategoriesGateway:
 
         limit = filter['page_size']
         offset = filter['page_size'] * (filter['page'] - 1)
-        pages_count = math.ceil(categories.count() / filter['page_size'])
-        return categories.offset(offset).limit(limit).all(), pages_count
+        # общее кол-во категорий получаем оконной функцией вместе со страницей, чтоб не делать отдельный count
+        rows = categories.add_columns(func.count().over()).offset(offset).limit(limit).all()
+        if rows:
+            total = rows[0][1]
+        else:
+            # страница за пределами выборки, кол-во приходится считать отдельно
+            total = categories.count() if offset else 0
+        pages_count = math.ceil(total / filter['page_size'])
+        return [row[0] for row in rows], pages_count
 
     @staticmethod
     def save_category(
@@ -319,6 +489,7 @@ class CategoriesGateway:
         db.add(category)
         category.sales.append(sale)
         db.commit()
+        sales_timeline.invalidate([category.id])
 
     @staticmethod
     def remove_sale_to_category(category: Category, sale: Sale, db: Session):
@@ -326,8 +497,10 @@ class CategoriesGateway:
         if sale in category.sales:
             category.sales.remove(sale)
         db.commit()
+        sales_timeline.invalidate([category.id])
 
     @staticmethod
+    @replica_read
     def get_all(db: Session):
         return db.query(Category).filter(Category.date_deleted == None).all()
 
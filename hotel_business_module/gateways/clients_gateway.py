@@ -3,8 +3,11 @@ from sqlalchemy.orm import Session
 from ..models.users import Client
 from ..settings import settings
 from ..models.orders import Order
+from ..session.routing import replica_read
+from ..utils.gateway_metrics import instrumented
 
 
+@instrumented
 class ClientsGateway:
     """
     Класс для управления клиентами
@@ -21,6 +24,7 @@ class ClientsGateway:
         db.commit()
 
     @staticmethod
+    @replica_read
     def get_all(db: Session):
         return db.query(Client).filter_by(date_deleted=None).all()
 
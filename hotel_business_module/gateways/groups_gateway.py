@@ -1,8 +1,12 @@
 from ..models.groups import Group
 from ..models.permissions import Permission
+from ..session.routing import replica_read
+from ..utils.gateway_metrics import instrumented
+from ..utils.permission_cache import permission_cache
 from sqlalchemy.orm import Session
 
 
+@instrumented
 class GroupsGateway:
     @staticmethod
     def save_group(group: Group, db: Session):
@@ -13,8 +17,10 @@ class GroupsGateway:
     def delete_group(group: Group, db: Session):
         db.delete(group)
         db.commit()
+        permission_cache.bump()
 
     @staticmethod
+    @replica_read
     def get_all(db: Session):
         return db.query(Group).all()
 
@@ -27,10 +33,12 @@ class GroupsGateway:
         db.add(group)
         group.permissions.append(permission)
         db.commit()
+        permission_cache.bump()
 
     @staticmethod
     def remove_permission_from_group(group: Group, permission: Permission, db: Session):
         db.add(group)
         group.permissions.remove(permission)
         db.commit()
+        permission_cache.bump()
         
\ No newline at end of file
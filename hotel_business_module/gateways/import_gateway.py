@@ -0,0 +1,516 @@
+import csv
+import json
+from datetime import datetime
+from typing import Iterable, List, NamedTuple, TextIO
+from sqlalchemy import (
+    MetaData, Table, Column, BigInteger, Integer, String, Date, Boolean, Float, Identity,
+    select, insert, update, exists, func, case, cast, literal, or_, and_,
+)
+from sqlalchemy.types import DECIMAL
+from sqlalchemy.orm import Session
+from ..models.categories import Category
+from ..models.orders import BaseOrder, Order, Purchase
+from ..models.payments import Payment
+from ..models.rooms import Room
+from ..models.users import User, Client
+from ..settings import settings
+from ..utils import purchase_events
+from ..utils.calendar_cache import calendar_cache
+from ..utils.purchase_events import PurchaseChange
+from .room_nights_gateway import RoomNightsGateway
+from ..utils.gateway_metrics import instrumented
+
+# промежуточные таблицы импорта: временные, удаляются при фиксации транзакции
+staging = MetaData()
+
+
+def staging_table(name: str, *columns: Column) -> Table:
+    """
+    Промежуточная таблица импорта: номер строки файла, колонки файла и причина отклонения строки
+    """
+    return Table(
+        name,
+        staging,
+        # COPY заполняет строки по порядку, поэтому identity совпадает с номером строки данных в файле
+        Column('line', BigInteger, Identity(), primary_key=True),
+        *columns,
+        Column('reject_reason', String),
+        prefixes=['TEMPORARY'],
+        postgresql_on_commit='DROP',
+    )
+
+
+def resolved(name: str, type_) -> Column:
+    """
+    Колонка, которую заполняет импорт (не читается из файла)
+    """
+    return Column(name, type_, info={'resolved': True})
+
+
+import_categories = staging_table(
+    'import_categories',
+    Column('name', String),
+    Column('description', String),
+    Column('price', DECIMAL(precision=10, scale=2)),
+    Column('prepayment_percent', Float),
+    Column('refund_percent', Float),
+    Column('main_photo_path', String),
+    Column('rooms_count', Integer),
+    Column('floors', Integer),
+    Column('beds', Integer),
+    Column('square', Float),
+    Column('is_hidden', Boolean),
+)
+
+import_rooms = staging_table(
+    'import_rooms',
+    Column('room_number', Integer),
+    Column('category_id', Integer),
+)
+
+import_clients = staging_table(
+    'import_clients',
+    Column('email', String),
+    Column('first_name', String),
+    Column('last_name', String),
+    Column('date_of_birth', Date),
+)
+
+import_purchases = staging_table(
+    'import_purchases',
+    # внешний номер заказа: покупки с одинаковым номером попадают в один заказ
+    Column('order_ref', String),
+    Column('client_email', String),
+    Column('room_number', Integer),
+    Column('start', Date),
+    Column('end', Date),
+    Column('price', DECIMAL(precision=10, scale=2)),
+    Column('prepayment', DECIMAL(precision=10, scale=2)),
+    Column('refund', DECIMAL(precision=10, scale=2)),
+    Column('is_paid', Boolean),
+    Column('is_prepayment_paid', Boolean),
+    Column('is_canceled', Boolean),
+    resolved('client_id', Integer),
+    resolved('room_id', Integer),
+    resolved('order_id', Integer),
+)
+
+
+class RejectedRow(NamedTuple):
+    # номер строки данных в файле (без заголовка), начиная с 1
+    line: int
+    reason: str
+
+
+class ImportReport(NamedTuple):
+    imported: int
+    rejected: List[RejectedRow]
+
+
+class JsonlStream:
+    """
+    Файлоподобный объект для COPY: строки JSONL перекодируются в CSV по мере чтения
+    """
+    def __init__(self, source: TextIO, columns: List[str]):
+        self.__lines = enumerate(source, start=1)
+        self.__columns = columns
+        self.__chunk = ''
+
+    @staticmethod
+    def __csv_value(value) -> str:
+        # в csv формате COPY пустое значение без кавычек - NULL, а строка в кавычках - значение (в т.ч. пустое)
+        if value is None:
+            return ''
+        if isinstance(value, bool):
+            return 'true' if value else 'false'
+        if isinstance(value, (int, float)):
+            return str(value)
+        if not isinstance(value, str):
+            value = json.dumps(value, ensure_ascii=False)
+        return '"' + value.replace('"', '""') + '"'
+
+    def __next_row(self) -> str:
+        for number, line in self.__lines:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            unknown = row.keys() - set(self.__columns)
+            if unknown:
+                raise ValueError(f'Неизвестные поля в строке {number}: {", ".join(sorted(unknown))}')
+            return ','.join(self.__csv_value(row.get(name)) for name in self.__columns) + '\n'
+        return ''
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self.__chunk) < size:
+            row = self.__next_row()
+            if not row:
+                break
+            self.__chunk += row
+        if size < 0:
+            size = len(self.__chunk)
+        chunk, self.__chunk = self.__chunk[:size], self.__chunk[size:]
+        return chunk
+
+
+@instrumented
+class ImportGateway:
+    """
+    Класс для массового импорта (перенос из старой системы, заведение нового объекта).
+    Файл потоком загружается через COPY во временную таблицу, строки проверяются запросами над всей таблицей,
+    прошедшие проверку строки переносятся в основные таблицы одним запросом на таблицу.
+    Строки с неверным типом значения прерывают весь импорт (ошибка COPY), остальные ошибки попадают в отчет
+    """
+    CSV = 'csv'
+    JSONL = 'jsonl'
+
+    @staticmethod
+    def __copy(table: Table, source: TextIO, file_format: str, db: Session):
+        """
+        Загрузка файла во временную таблицу
+        :param table: временная таблица
+        :param source: текстовый файл (csv с заголовком или jsonl)
+        :param file_format: формат файла
+        :param db: сессия
+        :return:
+        """
+        columns = [column.name for column in table.c if column.name not in ('line', 'reject_reason')
+                   and not column.info.get('resolved')]
+        if file_format == ImportGateway.CSV:
+            header = [name.strip() for name in next(csv.reader([source.readline()]), [])]
+            if not header:
+                raise ValueError('В файле нет заголовка')
+            unknown = set(header) - set(columns)
+            if unknown:
+                raise ValueError(f'Неизвестные колонки: {", ".join(sorted(unknown))}')
+            stream = source
+        elif file_format == ImportGateway.JSONL:
+            header = columns
+            stream = JsonlStream(source, columns)
+        else:
+            raise ValueError('Неизвестный формат файла')
+
+        connection = db.connection()
+        table.create(connection)
+        quote = connection.dialect.identifier_preparer.quote
+        with connection.connection.cursor() as cursor:
+            cursor.copy_expert(
+                f'COPY {table.name} ({", ".join(quote(name) for name in header)}) FROM STDIN WITH (FORMAT csv)',
+                stream,
+            )
+
+    @staticmethod
+    def __reject(table: Table, rules: Iterable, db: Session):
+        """
+        Отклонение строк, не прошедших проверки (по запросу на проверку).
+        Строке записывается причина первой непройденной проверки, следующие проверки ее не учитывают
+        :param table: временная таблица
+        :param rules: пары (причина, условие отклонения)
+        :param db: сессия
+        :return:
+        """
+        for reason, condition in rules:
+            db.execute(update(table).where(table.c.reject_reason == None, condition).values(reject_reason=reason))
+
+    @staticmethod
+    def __rejected(table: Table, db: Session) -> List[RejectedRow]:
+        return [
+            RejectedRow(line, reason) for line, reason in db.execute(
+                select(table.c.line, table.c.reject_reason).where(
+                    table.c.reject_reason != None,
+                ).order_by(table.c.line)
+            )
+        ]
+
+    @staticmethod
+    def __repeated(table: Table, *columns: str):
+        """
+        Условие: в файле есть более ранняя непринятая к отклонению строка с теми же значениями колонок
+        """
+        earlier = table.alias('earlier')
+        return exists().where(
+            earlier.c.line < table.c.line,
+            earlier.c.reject_reason == None,
+            *(earlier.c[name] == table.c[name] for name in columns),
+        )
+
+    @classmethod
+    def import_categories(cls, source: TextIO, db: Session, file_format: str = CSV) -> ImportReport:
+        """
+        Импорт категорий
+        :param source: файл с колонками name, description, price, prepayment_percent, refund_percent,
+        main_photo_path, rooms_count, floors, beds, square, is_hidden
+        :param db: сессия
+        :param file_format: формат файла (csv или jsonl)
+        :return: отчет импорта
+        """
+        table = import_categories
+        cls.__copy(table, source, file_format, db)
+        cls.__reject(table, (
+            ('Не заполнены обязательные поля', or_(*(
+                table.c[name] == None for name in (
+                    'name', 'description', 'price', 'prepayment_percent', 'refund_percent',
+                    'main_photo_path', 'rooms_count', 'floors', 'beds', 'square',
+                )
+            ))),
+            ('Цена должна быть больше 0', table.c.price <= 0),
+            ('Предоплата не может быть меньше 0 и больше 100', ~table.c.prepayment_percent.between(0, 100)),
+            ('Возврат не может быть меньше 0 и больше 100', ~table.c.refund_percent.between(0, 100)),
+        ), db)
+
+        columns = [
+            'name', 'description', 'price', 'prepayment_percent', 'refund_percent',
+            'main_photo_path', 'rooms_count', 'floors', 'beds', 'square',
+        ]
+        imported = db.execute(
+            insert(Category.__table__).from_select(
+                [*columns, 'is_hidden', 'date_created'],
+                select(
+                    *(table.c[name] for name in columns),
+                    func.coalesce(table.c.is_hidden, False),
+                    literal(datetime.now(tz=settings.TIMEZONE)),
+                ).where(table.c.reject_reason == None).order_by(table.c.line),
+                include_defaults=False,
+            )
+        ).rowcount
+        rejected = cls.__rejected(table, db)
+        db.commit()
+        return ImportReport(imported, rejected)
+
+    @classmethod
+    def import_rooms(cls, source: TextIO, db: Session, file_format: str = CSV) -> ImportReport:
+        """
+        Импорт комнат
+        :param source: файл с колонками room_number, category_id
+        :param db: сессия
+        :param file_format: формат файла (csv или jsonl)
+        :return: отчет импорта
+        """
+        table = import_rooms
+        rooms = Room.__table__
+        categories = Category.__table__
+        cls.__copy(table, source, file_format, db)
+        cls.__reject(table, (
+            ('Номер комнаты не может быть меньше 1', or_(table.c.room_number == None, table.c.room_number <= 0)),
+            ('Не найдена категория с таким id', ~exists().where(
+                categories.c.id == table.c.category_id,
+                categories.c.date_deleted == None,
+            )),
+            ('Уже существует комната с этим номером', exists().where(
+                rooms.c.room_number == table.c.room_number,
+                rooms.c.date_deleted == None,
+            )),
+            ('Номер комнаты повторяется в файле', cls.__repeated(table, 'room_number')),
+        ), db)
+
+        category_ids = db.scalars(
+            insert(rooms).from_select(
+                ['room_number', 'category_id', 'date_created'],
+                select(
+                    table.c.room_number, table.c.category_id, literal(datetime.now(tz=settings.TIMEZONE)),
+                ).where(table.c.reject_reason == None).order_by(table.c.line),
+                include_defaults=False,
+            ).returning(rooms.c.category_id)
+        ).all()
+        rejected = cls.__rejected(table, db)
+        db.commit()
+        # новые комнаты меняют кол-во свободных комнат категорий
+        for category_id in set(category_ids):
+            calendar_cache.invalidate_category(category_id)
+        return ImportReport(len(category_ids), rejected)
+
+    @classmethod
+    def import_clients(cls, source: TextIO, db: Session, file_format: str = CSV) -> ImportReport:
+        """
+        Импорт клиентов
+        :param source: файл с колонками email, first_name, last_name, date_of_birth
+        :param db: сессия
+        :param file_format: формат файла (csv или jsonl)
+        :return: отчет импорта
+        """
+        table = import_clients
+        people = User.__table__
+        cls.__copy(table, source, file_format, db)
+        cls.__reject(table, (
+            ('Неверный формат адреса эл. почты', or_(table.c.email == None, ~table.c.email.contains('@'))),
+            ('Уже есть пользователь с таким адресом эл. почты', exists().where(
+                people.c.email == table.c.email,
+                people.c.date_deleted == None,
+            )),
+            ('Адрес эл. почты повторяется в файле', cls.__repeated(table, 'email')),
+        ), db)
+
+        valid = table.c.reject_reason == None
+        # общая часть пользователя и строка клиента добавляются одним запросом
+        new_people = insert(people).from_select(
+            ['email', 'first_name', 'last_name', 'type', 'is_confirmed', 'date_created'],
+            select(
+                table.c.email, table.c.first_name, table.c.last_name,
+                literal('client'), literal(False), literal(datetime.now(tz=settings.TIMEZONE)),
+            ).where(valid).order_by(table.c.line),
+            include_defaults=False,
+        ).returning(people.c.id, people.c.email).cte('new_people')
+        imported = db.execute(
+            insert(Client.__table__).from_select(
+                ['id', 'date_of_birth'],
+                select(new_people.c.id, table.c.date_of_birth).join(
+                    table, and_(table.c.email == new_people.c.email, valid),
+                ),
+                include_defaults=False,
+            ).add_cte(new_people)
+        ).rowcount
+        rejected = cls.__rejected(table, db)
+        db.commit()
+        return ImportReport(imported, rejected)
+
+    @classmethod
+    def import_purchases(cls, source: TextIO, db: Session, file_format: str = CSV) -> ImportReport:
+        """
+        Импорт покупок (например, истории броней). Покупки с одним order_ref объединяются в новый заказ,
+        оплаченная по файлу сумма записывается в журнал оплат заказа.
+        Не заданные в файле цены считаются по цене категории без учета скидок
+        :param source: файл с колонками order_ref, client_email, room_number, start, end,
+        price, prepayment, refund, is_paid, is_prepayment_paid, is_canceled
+        :param db: сессия
+        :param file_format: формат файла (csv или jsonl)
+        :return: отчет импорта
+        """
+        table = import_purchases
+        people = User.__table__
+        rooms = Room.__table__
+        categories = Category.__table__
+        purchases = Purchase.__table__
+        cls.__copy(table, source, file_format, db)
+
+        # ссылки файла (адрес эл. почты, номер комнаты) заменяем на id одним запросом
+        db.execute(update(table).values(
+            client_id=select(people.c.id).where(
+                people.c.email == table.c.client_email,
+                people.c.type == 'client',
+                people.c.date_deleted == None,
+            ).limit(1).scalar_subquery(),
+            room_id=select(rooms.c.id).where(
+                rooms.c.room_number == table.c.room_number,
+                rooms.c.date_deleted == None,
+            ).limit(1).scalar_subquery(),
+        ))
+
+        dates = func.daterange(table.c.start, table.c.end)
+        earlier = table.alias('earlier')
+        cls.__reject(table, (
+            ('Не заполнены обязательные поля', or_(*(
+                table.c[name] == None for name in ('order_ref', 'client_email', 'room_number', 'start', 'end')
+            ))),
+            ('Начало должно быть раньше конца', table.c.start >= table.c.end),
+            ('Не найден клиент с таким адресом эл. почты', table.c.client_id == None),
+            ('Не найдена комната с таким номером', table.c.room_id == None),
+            ('У заказа в файле указаны разные клиенты', exists().where(
+                earlier.c.order_ref == table.c.order_ref,
+                earlier.c.client_email.is_distinct_from(table.c.client_email),
+            )),
+            ('Комната уже занята на эти даты', and_(
+                table.c.is_canceled.is_not(True),
+                exists().where(
+                    purchases.c.room_id == table.c.room_id,
+                    purchases.c.is_canceled == False,
+                    func.daterange(purchases.c.start, purchases.c.end).op('&&')(dates),
+                ),
+            )),
+            # проверка идет по снимку до отклонения, поэтому цепочка пересечений отклоняется целиком, кроме первой
+            ('Комната в файле уже занята на эти даты более ранней строкой', and_(
+                table.c.is_canceled.is_not(True),
+                exists().where(
+                    earlier.c.line < table.c.line,
+                    earlier.c.reject_reason == None,
+                    earlier.c.is_canceled.is_not(True),
+                    earlier.c.room_id == table.c.room_id,
+                    func.daterange(earlier.c.start, earlier.c.end).op('&&')(dates),
+                ),
+            )),
+        ), db)
+
+        valid = table.c.reject_reason == None
+        now = datetime.now(tz=settings.TIMEZONE)
+        # цены, не заданные в файле, и id новых заказов (по одному на order_ref)
+        price = func.coalesce(table.c.price, categories.c.price * (table.c.end - table.c.start))
+        db.execute(update(table).where(
+            valid,
+            rooms.c.id == table.c.room_id,
+            categories.c.id == rooms.c.category_id,
+        ).values(
+            price=price,
+            prepayment=func.coalesce(
+                table.c.prepayment, func.round(price * cast(categories.c.prepayment_percent, DECIMAL) / 100, 2),
+            ),
+            refund=func.coalesce(
+                table.c.refund, func.round(price * cast(categories.c.refund_percent, DECIMAL) / 100, 2),
+            ),
+            is_paid=func.coalesce(table.c.is_paid, False),
+            is_prepayment_paid=func.coalesce(table.c.is_prepayment_paid, table.c.is_paid, False),
+            is_canceled=func.coalesce(table.c.is_canceled, False),
+        ))
+        refs = select(
+            table.c.order_ref,
+            func.nextval(func.pg_get_serial_sequence(BaseOrder.__tablename__, 'id')).label('order_id'),
+        ).where(valid).group_by(table.c.order_ref).subquery()
+        db.execute(update(table).where(valid, table.c.order_ref == refs.c.order_ref).values(order_id=refs.c.order_id))
+
+        # заказы (base_order и client_order) и их оплаты одним запросом
+        paid = func.sum(case(
+            (table.c.is_paid, table.c.price),
+            (table.c.is_prepayment_paid, table.c.prepayment),
+            else_=0,
+        ))
+        new_orders = select(
+            table.c.order_id,
+            func.min(table.c.client_id).label('client_id'),
+            paid.label('paid'),
+            case((func.bool_and(table.c.is_paid), now)).label('date_full_paid'),
+            case((func.bool_and(or_(table.c.is_paid, table.c.is_prepayment_paid)), now)).label('date_full_prepayment'),
+            case((func.bool_and(table.c.is_canceled), now)).label('date_canceled'),
+        ).where(valid).group_by(table.c.order_id).cte('new_orders')
+        base_orders = insert(BaseOrder.__table__).from_select(
+            ['id', 'type', 'date_created'],
+            select(new_orders.c.order_id, literal('order'), literal(now)),
+            include_defaults=False,
+        ).returning(BaseOrder.__table__.c.id).cte('new_base_orders')
+        client_orders = insert(Order.__table__).from_select(
+            ['id', 'client_id', 'paid', 'refunded', 'date_full_paid', 'date_full_prepayment', 'date_canceled'],
+            select(
+                new_orders.c.order_id, new_orders.c.client_id, new_orders.c.paid, literal(0),
+                new_orders.c.date_full_paid, new_orders.c.date_full_prepayment, new_orders.c.date_canceled,
+            ),
+            include_defaults=False,
+        ).returning(Order.__table__.c.id).cte('new_client_orders')
+        db.execute(
+            insert(Payment.__table__).from_select(
+                ['order_id', 'amount', 'kind', 'date_created'],
+                select(new_orders.c.order_id, new_orders.c.paid, literal(Payment.PAYMENT), literal(now)).where(
+                    new_orders.c.paid > 0,
+                ),
+                include_defaults=False,
+            ).add_cte(new_orders).add_cte(base_orders).add_cte(client_orders)
+        )
+
+        # итоги заказов пересчитывает триггер purchase_order_totals
+        columns = ['order_id', 'room_id', 'start', 'end', 'price', 'prepayment', 'refund',
+                   'is_paid', 'is_prepayment_paid', 'is_canceled']
+        inserted = db.execute(
+            insert(purchases).from_select(
+                columns,
+                select(*(table.c[name] for name in columns)).where(valid).order_by(table.c.line),
+                include_defaults=False,
+            ).returning(purchases.c.id, purchases.c.room_id, purchases.c.start, purchases.c.end, purchases.c.is_canceled)
+        ).all()
+        RoomNightsGateway.occupy([row.id for row in inserted], db)
+        room_categories = dict(db.execute(
+            select(rooms.c.id, rooms.c.category_id).where(rooms.c.id.in_({row.room_id for row in inserted}))
+        ).all()) if inserted and purchase_events.has_listeners() else {}
+        rejected = cls.__rejected(table, db)
+        db.commit()
+
+        if room_categories:
+            purchase_events.dispatch(
+                PurchaseChange.of(row.room_id, room_categories[row.room_id], row.start, row.end, is_busy=True)
+                for row in inserted if not row.is_canceled
+            )
+        return ImportReport(len(inserted), rejected)
@@ -1,15 +1,98 @@
 from _decimal import Decimal
 from datetime import datetime
-from sqlalchemy import or_
-from ..models.orders import Purchase, Order
+from typing import List, NamedTuple
+import time
+from sqlalchemy import or_, and_, update, delete, insert, select, func, tuple_, case, literal
+from ..models.orders import Purchase, Order, BaseOrder
+from ..models.job_watermarks import JobWatermark
+from ..models.payments import Payment
+from ..models.rooms import Room
 from ..settings import settings
+from .room_nights_gateway import RoomNightsGateway
+from ..utils import purchase_events
+from ..utils.purchase_events import PurchaseChange
+from ..session.routing import replica_read
+from ..utils.gateway_metrics import instrumented
 from sqlalchemy.orm import Session
 
 
+class FinishStats(NamedTuple):
+    # отмененные предоплаченные покупки
+    canceled: int
+    # удаленные неоплаченные покупки
+    deleted: int
+    # завершенные заказы
+    finished: int
+    # покупки и заказы, пропущенные из-за блокировок другими транзакциями
+    skipped: int
+    # продолжительность запуска в секундах
+    duration: float
+
+
+@instrumented
 class OrdersGateway:
     """
     Класс для управления заказами
     """
+    # колонки отмененных/удаленных покупок, по которым оповещаем об освободившихся ночах
+    RELEASED_COLUMNS = (Purchase.id, Purchase.room_id, Purchase.start, Purchase.end)
+
+    @staticmethod
+    def released_changes(rows, db: Session) -> List[PurchaseChange]:
+        """
+        Изменения занятости по строкам отмененных/удаленных покупок (RELEASED_COLUMNS)
+        :param rows: строки покупок
+        :param db: сессия БД
+        :return:
+        """
+        if not rows or not purchase_events.has_listeners():
+            return []
+        # категории комнат получаем одним запросом
+        categories = dict(db.execute(
+            select(Room.id, Room.category_id).where(Room.id.in_({row.room_id for row in rows}))
+        ).all())
+        return [
+            PurchaseChange.of(row.room_id, categories[row.room_id], row.start, row.end, is_busy=False)
+            for row in rows
+        ]
+
+    @staticmethod
+    def expire_totals(order: BaseOrder | None, db: Session):
+        """
+        Сброс загруженных итогов заказа, чтоб при обращении получить пересчитанные триггером значения
+        :param order: заказ, покупки которого изменились
+        :param db: сессия БД
+        :return:
+        """
+        if order is not None and order in db:
+            db.expire(order, ['price', 'prepayment'])
+
+    @staticmethod
+    def reconcile_totals(db: Session) -> int:
+        """
+        Пересчет хранимых итогов заказов по покупкам (исправляет расхождения, например после правок БД без триггера)
+        :param db: сессия БД
+        :return: кол-во исправленных заказов
+        """
+        orders = BaseOrder.__table__
+        totals = select(
+            orders.c.id,
+            func.coalesce(func.sum(Purchase.order_price), 0).label('price'),
+            func.coalesce(func.sum(Purchase.prepayment), 0).label('prepayment'),
+        ).select_from(orders).outerjoin(Purchase, Purchase.order_id == orders.c.id).group_by(orders.c.id).subquery()
+        result = db.execute(
+            update(orders).where(
+                orders.c.id == totals.c.id,
+                or_(
+                    orders.c.price_total != totals.c.price,
+                    orders.c.prepayment_total != totals.c.prepayment,
+                ),
+            ).values(price_total=totals.c.price, prepayment_total=totals.c.prepayment)
+        )
+        db.commit()
+        db.expire_all()
+        return result.rowcount
+
     @staticmethod
     def __update_payment(order: Order, db: Session):
         """
@@ -72,6 +155,152 @@ class OrdersGateway:
             cls.__update_payment(order, db)
         db.commit()
 
+    @staticmethod
+    def __payment_state(paid, price, prepayment):
+        """
+        Условия статуса оплаты (те же, что и в __update_payment): полностью оплачен, оплачена предоплата,
+        не оплачена предоплата, не оплачен полностью
+        """
+        return (
+            and_(paid >= price, paid > 0),
+            and_(paid >= prepayment, paid > 0),
+            paid < prepayment,
+            paid < price,
+        )
+
+    @staticmethod
+    def expire_payment(order: Order, db: Session):
+        """
+        Сброс загруженных сумм оплаты заказа и статусов оплаты его покупок, измененных в обход ORM
+        """
+        db.expire(order, ['paid', 'refunded', 'date_full_paid', 'date_full_prepayment'])
+        OrdersGateway.expire_totals(order, db)
+        for item in list(db.identity_map.values()):
+            if isinstance(item, Purchase) and item.order_id == order.id:
+                db.expire(item, ['is_paid', 'is_prepayment_paid'])
+
+    @staticmethod
+    def validate_amount(amount: Decimal) -> Decimal:
+        amount = round(Decimal(amount), 2)
+        if amount <= 0:
+            raise ValueError('Сумма должна быть больше 0')
+        return amount
+
+    @classmethod
+    def payment_statement(cls, order_id: int, amount: Decimal):
+        """
+        Запрос записи оплаты: одним запросом добавляется платеж, увеличивается оплаченная сумма заказа
+        и обновляются статусы оплаты покупок. Возвращает id платежа (ничего, если заказ не найден)
+        :param order_id: id оплачиваемого заказа
+        :param amount: сумма оплаты
+        :return:
+        """
+        now = datetime.now(tz=settings.TIMEZONE)
+        orders, base_orders = Order.__table__, BaseOrder.__table__
+        paid = orders.c.paid + amount
+        fully_paid, prepaid, not_prepaid, not_paid = cls.__payment_state(
+            paid, base_orders.c.price_total, base_orders.c.prepayment_total,
+        )
+        paid_order = update(orders).where(
+            orders.c.id == order_id,
+            base_orders.c.id == orders.c.id,
+        ).values(
+            paid=paid,
+            date_full_paid=case(
+                (fully_paid, func.coalesce(orders.c.date_full_paid, now)),
+                (prepaid, orders.c.date_full_paid),
+                (or_(not_prepaid, not_paid), None),
+                else_=orders.c.date_full_paid,
+            ),
+            date_full_prepayment=case(
+                (fully_paid, orders.c.date_full_prepayment),
+                (prepaid, func.coalesce(orders.c.date_full_prepayment, now)),
+                (not_prepaid, None),
+                else_=orders.c.date_full_prepayment,
+            ),
+        ).returning(
+            orders.c.id,
+            # в returning колонки client_order уже с новыми значениями
+            *(condition.label(name) for condition, name in zip(
+                cls.__payment_state(orders.c.paid, base_orders.c.price_total, base_orders.c.prepayment_total),
+                ('fully_paid', 'prepaid', 'not_prepaid', 'not_paid'),
+            )),
+        ).cte('paid_order')
+
+        purchases = Purchase.__table__
+        is_paid = case(
+            (paid_order.c.fully_paid, True),
+            (paid_order.c.prepaid, purchases.c.is_paid),
+            (or_(paid_order.c.not_prepaid, paid_order.c.not_paid), False),
+            else_=purchases.c.is_paid,
+        )
+        is_prepayment_paid = case(
+            (paid_order.c.fully_paid, purchases.c.is_prepayment_paid),
+            (paid_order.c.prepaid, True),
+            (paid_order.c.not_prepaid, False),
+            else_=purchases.c.is_prepayment_paid,
+        )
+        paid_purchases = update(purchases).where(
+            purchases.c.order_id == paid_order.c.id,
+            purchases.c.is_canceled == False,
+            or_(purchases.c.is_paid != is_paid, purchases.c.is_prepayment_paid != is_prepayment_paid),
+        ).values(is_paid=is_paid, is_prepayment_paid=is_prepayment_paid).returning(purchases.c.id).cte('paid_purchases')
+
+        return insert(Payment).from_select(
+            ['order_id', 'amount', 'kind', 'date_created'],
+            select(paid_order.c.id, literal(amount), literal(Payment.PAYMENT), literal(now)),
+        ).returning(Payment.id).add_cte(paid_order).add_cte(paid_purchases)
+
+    @classmethod
+    def record_payment(cls, order: Order, amount: Decimal, db: Session) -> Payment:
+        """
+        Запись оплаты заказа в журнал. Оплаченная сумма увеличивается на стороне БД,
+        поэтому параллельные оплаты не перезаписывают друг друга
+        :param order: оплачиваемый заказ
+        :param amount: сумма оплаты
+        :param db: сессия БД
+        :return: запись журнала
+        """
+        amount = cls.validate_amount(amount)
+        if order.date_finished is not None or order.date_canceled is not None:
+            raise ValueError('Нельзя оплатить неактивный заказ')
+        payment_id = db.scalar(cls.payment_statement(order.id, amount))
+        if payment_id is None:
+            raise ValueError('Не найден заказ с таким id')
+        db.commit()
+        cls.expire_payment(order, db)
+        return db.get(Payment, payment_id)
+
+    @classmethod
+    def record_refund(cls, order: Order, amount: Decimal, db: Session) -> Payment:
+        """
+        Запись возврата средств по заказу в журнал (одним запросом с увеличением возвращенной суммы заказа)
+        :param order: заказ
+        :param amount: сумма возврата
+        :param db: сессия БД
+        :return: запись журнала
+        """
+        amount = cls.validate_amount(amount)
+        now = datetime.now(tz=settings.TIMEZONE)
+        orders = Order.__table__
+        refunded_order = update(orders).where(
+            orders.c.id == order.id,
+            # вернуть больше, чем оплачено, нельзя (проверка и запись атомарны)
+            orders.c.refunded + amount <= orders.c.paid,
+        ).values(refunded=orders.c.refunded + amount).returning(orders.c.id).cte('refunded_order')
+
+        payment_id = db.scalar(
+            insert(Payment).from_select(
+                ['order_id', 'amount', 'kind', 'date_created'],
+                select(refunded_order.c.id, literal(amount), literal(Payment.REFUND), literal(now)),
+            ).returning(Payment.id).add_cte(refunded_order)
+        )
+        if payment_id is None:
+            raise ValueError('Сумма возврата не должна быть больше суммы оплаты')
+        db.commit()
+        cls.expire_payment(order, db)
+        return db.get(Payment, payment_id)
+
     @staticmethod
     def mark_as_canceled(order: Order, db: Session):
         """
@@ -87,19 +316,27 @@ class OrdersGateway:
         order.date_canceled = datetime.now(tz=settings.TIMEZONE)
         order.date_finished = None
         # отменяем оплаченные покупки
-        db.query(Purchase).filter(
-            Purchase.order_id == order.id,
-            Purchase.is_canceled == False,
-            or_(Purchase.is_paid == True, Purchase.is_prepayment_paid == True),
-        ).update({'is_canceled': True})
-        # удаляем не оплаченные покупки
-        db.query(Purchase).filter(
-            Purchase.order_id == order.id,
-            Purchase.is_canceled == False,
-            Purchase.is_paid == False,
-            Purchase.is_prepayment_paid == False,
-        ).delete()
+        canceled = db.execute(
+            update(Purchase).where(
+                Purchase.order_id == order.id,
+                Purchase.is_canceled == False,
+                or_(Purchase.is_paid == True, Purchase.is_prepayment_paid == True),
+            ).values(is_canceled=True).returning(*OrdersGateway.RELEASED_COLUMNS)
+        ).all()
+        RoomNightsGateway.release([row.id for row in canceled], db)
+        # удаляем не оплаченные покупки (их ночи удаляются из журнала каскадно)
+        deleted = db.execute(
+            delete(Purchase).where(
+                Purchase.order_id == order.id,
+                Purchase.is_canceled == False,
+                Purchase.is_paid == False,
+                Purchase.is_prepayment_paid == False,
+            ).returning(*OrdersGateway.RELEASED_COLUMNS)
+        ).all()
+        changes = OrdersGateway.released_changes(canceled + deleted, db)
         db.commit()
+        OrdersGateway.expire_totals(order, db)
+        purchase_events.dispatch(changes)
 
     @staticmethod
     def mark_as_paid(order: Order, db: Session):
@@ -107,35 +344,109 @@ class OrdersGateway:
             raise ValueError('Нельзя оплатить неактивный заказ')
         if order.date_full_paid is not None:
             return
-        order.paid = order.price
-        OrdersGateway.save_order(order, db)
+        if order.left_to_pay > 0:
+            OrdersGateway.record_payment(order, order.left_to_pay, db)
+        else:
+            OrdersGateway.save_order(order, db)
+
+    # имя задачи завершения заказов в таблице отметок
+    FINISH_ORDERS_JOB = 'finish_orders'
 
     @staticmethod
-    def finish_orders(db: Session):
-        db.query(Purchase).filter(
-            Purchase.end < datetime.now(settings.TIMEZONE),
+    def finish_orders(db: Session, chunk_size: int | None = None, full: bool = False) -> FinishStats:
+        """
+        Завершение заказов, у которых закончились все покупки. Обрабатываются только покупки,
+        закончившиеся с прошлого запуска, небольшими частями в отдельных транзакциях.
+        Строки, заблокированные другими транзакциями, пропускаются, и тогда отметка не сдвигается,
+        чтоб следующий запуск обработал их
+        :param db: сессия БД
+        :param chunk_size: кол-во строк в одной транзакции
+        :param full: обработать все покупки, а не только закончившиеся с прошлого запуска
+        :return: статистика запуска
+        """
+        started = time.monotonic()
+        chunk_size = chunk_size or settings.FINISH_ORDERS_CHUNK_SIZE
+        now = datetime.now(tz=settings.TIMEZONE)
+        watermark = db.get(JobWatermark, OrdersGateway.FINISH_ORDERS_JOB)
+        ended = [Purchase.end < now]
+        if watermark is not None and not full:
+            ended.append(Purchase.end >= watermark.value)
+        # предоплаченные покупки отменяются, неоплаченные удаляются
+        pending = and_(
             Purchase.is_paid == False,
-            Purchase.is_prepayment_paid == True,
-        ).update({'is_canceled': True})
+            or_(Purchase.is_prepayment_paid == False, Purchase.is_canceled == False),
+        )
 
-        db.query(Purchase).filter(
-            Purchase.end < datetime.now(settings.TIMEZONE),
-            Purchase.is_paid == False,
-            Purchase.is_prepayment_paid == False,
-        ).delete()
+        canceled = deleted = finished = 0
+        # заказы удаленных покупок тоже нужно проверить, хотя их покупок в выборке уже не будет
+        order_ids = set()
+        last = None
+        while True:
+            chunk = select(Purchase.id, Purchase.end, Purchase.is_prepayment_paid).where(*ended, pending)
+            if last is not None:
+                chunk = chunk.where(tuple_(Purchase.end, Purchase.id) > tuple_(*last))
+            rows = db.execute(
+                chunk.order_by(Purchase.end, Purchase.id).limit(chunk_size).with_for_update(skip_locked=True)
+            ).all()
+            if not rows:
+                db.commit()
+                break
+            last = (rows[-1].end, rows[-1].id)
+
+            canceled_rows = db.execute(
+                update(Purchase).where(
+                    Purchase.id.in_([row.id for row in rows if row.is_prepayment_paid]),
+                ).values(is_canceled=True).returning(*OrdersGateway.RELEASED_COLUMNS, Purchase.order_id)
+            ).all()
+            RoomNightsGateway.release([row.id for row in canceled_rows], db)
+            deleted_rows = db.execute(
+                delete(Purchase).where(
+                    Purchase.id.in_([row.id for row in rows if not row.is_prepayment_paid]),
+                ).returning(*OrdersGateway.RELEASED_COLUMNS, Purchase.order_id)
+            ).all()
+            changes = OrdersGateway.released_changes(canceled_rows + deleted_rows, db)
+            db.commit()
+            purchase_events.dispatch(changes)
 
-        db.query(Order).filter(
-            Order.id.not_in(
-                db.query(Purchase.order_id).filter(
-                    Purchase.end > datetime.now(settings.TIMEZONE),
+            canceled += len(canceled_rows)
+            deleted += len(deleted_rows)
+            order_ids.update(row.order_id for row in deleted_rows)
+        # покупки, пропущенные из-за блокировок
+        skipped = db.scalar(select(func.count(Purchase.id)).where(*ended, pending))
+
+        order_ids.update(db.scalars(select(Purchase.order_id).where(*ended).distinct()))
+        # заказ завершен, если у него нету незакончившихся покупок
+        finishable = [
+            Order.date_finished == None,
+            Order.price > 0,
+            ~select(Purchase.id).where(Purchase.order_id == Order.id, Purchase.end > now).exists(),
+        ]
+        order_ids = sorted(order_ids)
+        for offset in range(0, len(order_ids), chunk_size):
+            chunk_ids = db.scalars(
+                select(Order.id).where(
+                    *finishable, Order.id.in_(order_ids[offset:offset + chunk_size]),
+                ).with_for_update(skip_locked=True)
+            ).all()
+            if chunk_ids:
+                db.execute(
+                    update(Order.__table__).where(
+                        Order.__table__.c.id.in_(chunk_ids),
+                    ).values(date_finished=now)
                 )
-            ),
-            Order.price > 0
-        ).update({'date_finished': datetime.now(tz=settings.TIMEZONE)})
+            db.commit()
+            finished += len(chunk_ids)
+        # заказы, пропущенные из-за блокировок
+        if order_ids:
+            skipped += db.scalar(select(func.count(Order.id)).where(*finishable, Order.id.in_(order_ids)))
 
+        if not skipped:
+            db.merge(JobWatermark(name=OrdersGateway.FINISH_ORDERS_JOB, value=now.date()))
         db.commit()
+        return FinishStats(canceled, deleted, finished, skipped, time.monotonic() - started)
 
     @staticmethod
+    @replica_read
     def get_all(db: Session):
         return db.query(Order).all()
 
@@ -1,9 +1,13 @@
 from sqlalchemy.exc import IntegrityError
 
 from ..models.permissions import Permission
+from ..session.routing import replica_read
+from ..utils.gateway_metrics import instrumented
+from ..utils.permission_cache import permission_cache
 from sqlalchemy.orm import Session
 
 
+@instrumented
 class PermissionsGateway:
     @staticmethod
     def save_permission(permission: Permission, db: Session):
@@ -12,13 +16,17 @@ class PermissionsGateway:
             db.commit()
         except IntegrityError:
             raise ValueError('разрешение с таким наименованием уже существует')
+        # код существующего разрешения мог измениться
+        permission_cache.bump()
 
     @staticmethod
     def delete_permission(permission: Permission, db: Session):
         db.delete(permission)
         db.commit()
+        permission_cache.bump()
 
     @staticmethod
+    @replica_read
     def get_all(db: Session):
         return db.query(Permission).all()
 
@@ -1,40 +1,44 @@
 from typing import Optional
 from sqlalchemy import inspect, func
 from ..models.photos import Photo
+from ..session.routing import replica_read
+from ..utils.gateway_metrics import instrumented
 from hotel_business_module.utils.file_manager import FileManager
-from ..session.session import get_session
 from sqlalchemy.orm import Session
 from hotel_business_module.utils.protocols import SupportsReading, SupportsAsyncReading
 
 
+@instrumented
 class PhotosGateway:
     """
     Класс для управления фотографиями
     """
     @staticmethod
-    def __swap_photos(photo: Photo):
+    def __swap_photos(photo: Photo, db: Session):
         """
         Метод для перестановки фотографий местами
         :param photo: фото, которому обновляем порядок
+        :param db: сессия
         :return:
         """
-        # создаем отдельную сессию, чтоб получить изначальный порядковый номер фотографии
-        with get_session() as db:
-            category_id = photo.category_id if photo.category_id is not None else photo.category.id
+        category_id = photo.category_id if photo.category_id is not None else photo.category.id
+        with db.no_autoflush:
+            # изначальный порядковый номер фотографии (из истории изменений или из БД)
+            previous = inspect(photo).attrs.order.history.deleted
+            current_order = previous[0] if previous else db.query(Photo.order).filter(
+                Photo.id == photo.id,
+            ).scalar()
             # ищем фотографию, с которой поменяется местами
             photo_to_swap = db.query(Photo).filter(
                 Photo.category_id == category_id,
-                Photo.order == photo.order
+                Photo.order == photo.order,
+                Photo.id != photo.id,
             ).first()
-            if photo_to_swap is None:
-                raise ValueError('Не найдена фотография с таким номером')
+        if photo_to_swap is None:
+            raise ValueError('Не найдена фотография с таким номером')
 
-            # меняем местами фотографии
-            current_order = db.get(Photo, photo.id).order
-            photo_to_swap.order = current_order
-            # db.expunge(photo)
-            db.add(photo_to_swap)
-            db.commit()
+        # меняем местами фотографии, сохраняются вместе с фото
+        photo_to_swap.order = current_order
 
     @staticmethod
     def delete_photo(photo: Photo, db: Session):
@@ -65,7 +69,7 @@ class PhotosGateway:
     ):
         # если обновляли и поменяли порядок, то меняем местами
         if photo.order is not None and inspect(photo).attrs.order.history.has_changes():
-            cls.__swap_photos(photo)
+            cls.__swap_photos(photo, db)
 
         db.add(photo)
         # если создали новую, то автоматическа установливаем порядок (ставим последней)
@@ -115,6 +119,7 @@ class PhotosGateway:
         db.commit()
 
     @staticmethod
+    @replica_read
     def get_all(db: Session):
         return db.query(Photo).all()
 
@@ -1,23 +1,51 @@
-from _decimal import Decimal
-from datetime import datetime
-from typing import Optional
-from sqlalchemy import func
-from ..models.orders import Purchase
+from collections import Counter
+from datetime import datetime, date
+from typing import Optional, List, Iterable, Dict, Tuple
+from sqlalchemy import func, select, and_, cast, Date
+from sqlalchemy.exc import IntegrityError
+from ..models.orders import Purchase, is_booking_conflict
 from ..models.categories import Category
-from ..models.sales import Sale
 from ..models.rooms import Room
 from .categories_gateway import CategoriesGateway
 from .orders_gateway import OrdersGateway
-from ..models.orders import Order
+from .room_nights_gateway import RoomNightsGateway
+from ..models.orders import Order, BaseOrder
+from ..settings import settings
 from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+from ..utils import purchase_events
+from ..utils.purchase_events import PurchaseChange
+from ..utils.pricing import calculate_prices, PurchasePrices
+from ..utils.sales_timeline import sales_timeline, DiscountTimeline
+from ..session.routing import replica_read
+from ..utils.gateway_metrics import instrumented
 
 
+@instrumented
 class PurchasesGateway:
     """
     Класс для управления покупками заказа
     """
     @staticmethod
-    def __set_price(purchase: Purchase, db: Session):
+    def __apply_price(purchase: Purchase, category: Category, timeline: DiscountTimeline):
+        """
+        Расчет цен покупки, скидка применяется к каждой ночи по графику скидок категории
+        :param purchase: покупка, которой нужно установить цены
+        :param category: категория комнаты покупки
+        :param timeline: график скидок категории
+        :return:
+        """
+        start = purchase.start.date() if isinstance(purchase.start, datetime) else purchase.start
+        end = purchase.end.date() if isinstance(purchase.end, datetime) else purchase.end
+        purchase.price, purchase.prepayment, purchase.refund = calculate_prices(
+            category.price,
+            category.prepayment_percent,
+            category.refund_percent,
+            timeline.nightly_discounts(start, end),
+        )
+
+    @classmethod
+    def __set_price(cls, purchase: Purchase, db: Session):
         """
         Установка цен покупки
         :param purchase: покупка, которой нужно установить цены
@@ -25,33 +53,55 @@ class PurchasesGateway:
         """
         # берем категории комнаты, на которую оформлена покупка
         category: Category = db.get(Room, purchase.room_id).category
-        # считаем продолжительность покупки
-        delta_seconds: Decimal = (purchase.end - purchase.start).total_seconds()
-        SECONDS_IN_DAY: int = 86400
-        # считаем на сколько дней покупка
-        days: int = round(Decimal(delta_seconds / SECONDS_IN_DAY), 0)
-        # стандартная цена
-        default_price: Decimal = category.price * days
-        # ищем, есть ли активные скидки и если есть, то берем максимальную
-        sale = db.query(func.max(Sale.discount)).filter(
-            Sale.start_date <= datetime.now(),
-            Sale.end_date >= datetime.now(),
-            Sale.date_deleted == None,
-            Sale.categories.any(id=category.id)
-        ).scalar()
-        if sale:
-            # если есть скидка, то считаем цену с ее учетом
-            sale_ration = Decimal(sale / 100)
-            purchase.price = default_price - (default_price * sale_ration)
-        else:
-            purchase.price = default_price
+        cls.__apply_price(purchase, category, sales_timeline.get(category.id, db))
+
+    @staticmethod
+    def quote_many(stays: Iterable[Tuple[int, date, date]], db: Session) -> List[PurchasePrices]:
+        """
+        Расчет цен для набора вариантов брони без создания покупок
+        (категории и скидки загружаются одним запросом каждые)
+        :param stays: варианты брони (id категории, начало, конец)
+        :param db: сессия БД
+        :return: цена, предоплата и возврат для каждого варианта в порядке запроса
+        """
+        stays = [
+            (
+                category_id,
+                start.date() if isinstance(start, datetime) else start,
+                end.date() if isinstance(end, datetime) else end,
+            )
+            for category_id, start, end in stays
+        ]
+        if not stays:
+            return []
+        category_ids = {category_id for category_id, _, _ in stays}
+        categories = {
+            category.id: category for category in db.execute(
+                select(Category.id, Category.price, Category.prepayment_percent, Category.refund_percent).where(
+                    Category.id.in_(category_ids),
+                    Category.date_deleted == None,
+                )
+            ).all()
+        }
+        timelines = sales_timeline.get_many(category_ids, db)
 
-        # считаем устанавливаем предоплату
-        prepayment_ratio = Decimal(category.prepayment_percent / 100)
-        purchase.prepayment = purchase.price * prepayment_ratio
-        # считаем устанавливаем возврат
-        refund_ratio = Decimal(category.refund_percent / 100)
-        purchase.refund = purchase.price * refund_ratio
+        quotes = []
+        # варианты с одинаковым набором скидок по ночам стоят одинаково, поэтому считаем их один раз
+        calculated: Dict[Tuple, PurchasePrices] = {}
+        for category_id, start, end in stays:
+            if category_id not in categories:
+                raise ValueError('Не найдена категория с таким id')
+            if start >= end:
+                raise ValueError('Начало должно быть раньше конца')
+            discounts = timelines[category_id].nightly_discounts(start, end)
+            key = (category_id, tuple(sorted(Counter(discounts).items())))
+            if key not in calculated:
+                category = categories[category_id]
+                calculated[key] = calculate_prices(
+                    category.price, category.prepayment_percent, category.refund_percent, discounts,
+                )
+            quotes.append(calculated[key])
+        return quotes
 
     @staticmethod
     def __set_room(purchase: Purchase, category: Category, db: Session):
@@ -74,27 +124,252 @@ class PurchasesGateway:
 
         purchase.room_id = room_id
 
+    @staticmethod
+    def __committed_occupancy(purchase: Purchase, db: Session) -> List[PurchaseChange]:
+        """
+        Занятость сохраненной покупки до изменения (чтоб оповестить об освободившихся ночах)
+        :param purchase: покупка
+        :return:
+        """
+        if purchase.id is None or purchase.is_canceled or not purchase_events.has_listeners():
+            return []
+        committed = {}
+        for key in ('room_id', 'start', 'end'):
+            history = get_history(purchase, key)
+            committed[key] = history.deleted[0] if history.deleted else getattr(purchase, key)
+        room = db.get(Room, committed['room_id'])
+        return [PurchaseChange.of(
+            committed['room_id'], room.category_id, committed['start'], committed['end'], is_busy=False
+        )]
+
     @classmethod
     def save_purchase(cls, purchase: Purchase, db: Session, category: Optional[Category] = None):
-        db.add(purchase)
         category = category if category is not None else purchase.room.category
-        cls.__set_room(purchase, category, db)
-        cls.__set_price(purchase, db)
+        changes = cls.__committed_occupancy(purchase, db)
+        if purchase in db.new:
+            # покупка должна попасть в сессию внутри точки сохранения, иначе конфликт откатит всю транзакцию
+            db.expunge(purchase)
+        start, end = purchase.start, purchase.end
+        for _ in range(settings.PURCHASE_SAVE_ATTEMPTS):
+            try:
+                # сохраняем в точке сохранения, чтоб при конфликте откатить только ее
+                with db.begin_nested():
+                    db.add(purchase)
+                    # откат точки сохранения сбрасывает измененные даты, поэтому устанавливаем их заново
+                    purchase.start, purchase.end = start, end
+                    cls.__set_room(purchase, category, db)
+                    cls.__set_price(purchase, db)
+                    db.flush()
+                    RoomNightsGateway.occupy([purchase.id], db)
+                break
+            except IntegrityError as exc:
+                if not is_booking_conflict(exc):
+                    raise
+                # комнату параллельно занял другой запрос, подбираем следующую свободную
+        else:
+            raise ValueError('На эти даты нет свободных комнат этой категории')
         db.commit()
+        OrdersGateway.expire_totals(purchase.order, db)
+        changes.append(PurchaseChange.of(purchase.room_id, category.id, start, end, is_busy=True))
+        purchase_events.dispatch(changes)
 
         if isinstance(purchase.order, Order):
             OrdersGateway.save_order(purchase.order, db)
 
     @staticmethod
-    def mark_as_canceled(purchase: Purchase, db: Session):
+    def __rooms_occupancy(
+            category_ids: Iterable[int],
+            start: date,
+            end: date,
+            db: Session,
+    ) -> Dict[int, Tuple[int, List[Tuple[date, date]]]]:
+        """
+        Получение действующих комнат категорий и их броней за период (одним запросом)
+        :param category_ids: id категорий
+        :param start: дата начала периода
+        :param end: дата конца периода
+        :param db: сессия БД
+        :return: словарь {id комнаты: (id категории, [(начало брони, конец брони), ...])}
+        """
+        rows = db.execute(
+            select(Room.id, Room.category_id, Purchase.start, Purchase.end).outerjoin(Purchase, and_(
+                Purchase.room_id == Room.id,
+                Purchase.is_canceled == False,
+                func.daterange(Purchase.start, Purchase.end).op('&&')(
+                    func.daterange(cast(start, Date), cast(end, Date))
+                ),
+            )).where(
+                Room.category_id.in_(set(category_ids)),
+                Room.date_deleted == None,
+            ).order_by(Room.id)
+        ).all()
+        rooms = {}
+        for room_id, category_id, busy_start, busy_end in rows:
+            busy = rooms.setdefault(room_id, (category_id, []))[1]
+            if busy_start is not None:
+                busy.append((busy_start, busy_end))
+        return rooms
+
+    @staticmethod
+    def __overbooked(
+            stays: List[Tuple[Category, date, date]],
+            rooms: Dict[int, Tuple[int, List[Tuple[date, date]]]],
+    ) -> bool:
+        """
+        Проверка, есть ли ночь, на которую покупкам категории нужно больше комнат, чем свободно
+        :param stays: запрашиваемые покупки (категория, начало, конец)
+        :param rooms: комнаты и их брони
+        :return: True, если расселить всех точно нельзя
+        """
+        requested: Counter = Counter(
+            (category.id, date.fromordinal(night))
+            for category, start, end in stays for night in range(start.toordinal(), end.toordinal())
+        )
+        for (category_id, night), count in requested.items():
+            free = sum(
+                1 for room_category_id, busy in rooms.values()
+                if room_category_id == category_id
+                and not any(busy_start <= night < busy_end for busy_start, busy_end in busy)
+            )
+            if count > free:
+                return True
+        return False
+
+    @staticmethod
+    def __assign_rooms(
+            stays: List[Tuple[Category, date, date]],
+            rooms: Dict[int, Tuple[int, List[Tuple[date, date]]]],
+    ) -> Optional[List[int]]:
+        """
+        Подбор комнат сразу для всех покупок перебором с возвратами: на каждом шаге расселяется покупка
+        с наименьшим кол-вом подходящих комнат, а из комнат с одинаковой занятостью пробуется только одна.
+        Перебор ограничен PURCHASE_ALLOCATION_STEPS шагами
+        :param stays: запрашиваемые покупки (категория, начало, конец)
+        :param rooms: комнаты и их брони
+        :return: id комнат в порядке покупок или None, если расселить всех нельзя (или перебор не уложился в ограничение)
+        """
+        # периоды, на которые комнаты заняты бронями и уже подобранными покупками
+        taken = {room_id: list(busy) for room_id, (_, busy) in rooms.items()}
+        assigned: Dict[int, int] = {}
+        steps = 0
+
+        def candidates(index: int) -> List[int]:
+            category, start, end = stays[index]
+            fitting = {}
+            for room_id, (category_id, _) in rooms.items():
+                if category_id != category.id:
+                    continue
+                if any(start < busy_end and busy_start < end for busy_start, busy_end in taken[room_id]):
+                    continue
+                # комнаты с одинаковой занятостью взаимозаменяемы, достаточно попробовать одну
+                fitting.setdefault(tuple(sorted(taken[room_id])), room_id)
+            return list(fitting.values())
+
+        def search() -> bool:
+            nonlocal steps
+            if len(assigned) == len(stays):
+                return True
+            steps += 1
+            if steps > settings.PURCHASE_ALLOCATION_STEPS:
+                return False
+            options = {index: candidates(index) for index in range(len(stays)) if index not in assigned}
+            index = min(options, key=lambda option: len(options[option]))
+            for room_id in options[index]:
+                assigned[index] = room_id
+                taken[room_id].append(stays[index][1:])
+                if search():
+                    return True
+                taken[room_id].pop()
+                del assigned[index]
+            return False
+
+        if not search():
+            return None
+        return [assigned[index] for index in range(len(stays))]
+
+    @classmethod
+    def allocate_purchases(
+            cls,
+            order: BaseOrder,
+            stays: Iterable[Tuple[Category, date, date]],
+            db: Session,
+    ) -> List[Purchase]:
+        """
+        Оформление сразу нескольких покупок заказа: комнаты подбираются совместно,
+        покупки сохраняются все вместе или ни одной
+        :param order: заказ (или корзина), в который добавляются покупки
+        :param stays: запрашиваемые покупки (категория, начало, конец)
+        :param db: сессия БД
+        :return: созданные покупки в порядке запроса
+        """
+        stays = [
+            (
+                category,
+                start.date() if isinstance(start, datetime) else start,
+                end.date() if isinstance(end, datetime) else end,
+            )
+            for category, start, end in stays
+        ]
+        if not stays:
+            return []
+        if any(start >= end for _, start, end in stays):
+            raise ValueError('Начало должно быть раньше конца')
+        category_ids = {category.id for category, _, _ in stays}
+        period_start = min(start for _, start, _ in stays)
+        period_end = max(end for _, _, end in stays)
+
+        for _ in range(settings.PURCHASE_SAVE_ATTEMPTS):
+            try:
+                # при любой ошибке точка сохранения откатывается целиком, поэтому покупки сохраняются все или ни одной
+                with db.begin_nested():
+                    rooms = cls.__rooms_occupancy(category_ids, period_start, period_end, db)
+                    # заведомо невыполнимый запрос отклоняем до подбора комнат
+                    room_ids = None if cls.__overbooked(stays, rooms) else cls.__assign_rooms(stays, rooms)
+                    if room_ids is None:
+                        raise ValueError('На эти даты нет свободных комнат этой категории')
+                    timelines = sales_timeline.get_many(category_ids, db)
+                    purchases = []
+                    for (category, start, end), room_id in zip(stays, room_ids):
+                        purchase = Purchase(order=order, start=start, end=end, room_id=room_id)
+                        cls.__apply_price(purchase, category, timelines[category.id])
+                        purchases.append(purchase)
+                    db.add_all(purchases)
+                    db.flush()
+                    RoomNightsGateway.occupy([purchase.id for purchase in purchases], db)
+                break
+            except IntegrityError as exc:
+                if not is_booking_conflict(exc):
+                    raise
+                # комнату параллельно занял другой запрос, подбираем комнаты заново
+        else:
+            raise ValueError('На эти даты нет свободных комнат этой категории')
+        db.commit()
+        OrdersGateway.expire_totals(order, db)
+        purchase_events.dispatch([
+            PurchaseChange.of(room_id, category.id, start, end, is_busy=True)
+            for (category, start, end), room_id in zip(stays, room_ids)
+        ])
+
+        if isinstance(order, Order):
+            OrdersGateway.save_order(order, db)
+        return purchases
+
+    @classmethod
+    def mark_as_canceled(cls, purchase: Purchase, db: Session):
         db.add(purchase)
+        changes = cls.__committed_occupancy(purchase, db)
         if purchase.is_prepayment_paid or purchase.is_paid:
             purchase.is_canceled = True
+            RoomNightsGateway.release([purchase.id], db)
         else:
             db.delete(purchase)
+        order = purchase.order
         db.commit()
+        OrdersGateway.expire_totals(order, db)
+        purchase_events.dispatch(changes)
 
     @staticmethod
+    @replica_read
     def get_all(db: Session):
         return db.query(Purchase).all()
 
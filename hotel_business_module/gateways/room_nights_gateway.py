@@ -0,0 +1,98 @@
+from datetime import timedelta
+from typing import Iterable, NamedTuple
+from sqlalchemy import func, select, insert, cast, Date
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from ..models.orders import Purchase
+from ..models.room_nights import RoomNight
+from ..settings import settings
+from ..utils.gateway_metrics import instrumented
+from sqlalchemy.orm import Session
+
+
+class LedgerDrift(NamedTuple):
+    # ночи действующих покупок, которых нету в журнале
+    missing: int
+    # строки журнала, которым не соответствует ни одна действующая покупка
+    extra: int
+
+
+@instrumented
+class RoomNightsGateway:
+    """
+    Класс для ведения журнала занятых ночей комнат (room_night)
+    """
+    @staticmethod
+    def __purchases_nights():
+        """
+        Запрос ночей действующих покупок (room_id, night, purchase_id)
+        """
+        nights = cast(func.generate_series(Purchase.start, Purchase.end - 1, timedelta(days=1)), Date)
+        return select(Purchase.room_id, nights, Purchase.id).where(
+            Purchase.is_canceled == False,
+        )
+
+    @classmethod
+    def occupy(cls, purchase_ids: Iterable[int], db: Session):
+        """
+        Запись (перезапись) ночей покупок в журнал, отмененные покупки ночей не занимают
+        :param purchase_ids: id созданных или измененных покупок
+        :param db: сессия БД
+        :return:
+        """
+        purchase_ids = list(purchase_ids)
+        if not settings.ROOM_NIGHT_LEDGER or not purchase_ids:
+            return
+        # у измененной покупки могли поменяться комната и даты, поэтому сначала убираем старые ночи
+        cls.release(purchase_ids, db)
+        db.execute(
+            insert(RoomNight).from_select(
+                ['room_id', 'night', 'purchase_id'],
+                cls.__purchases_nights().where(Purchase.id.in_(purchase_ids)),
+            )
+        )
+
+    @staticmethod
+    def release(purchase_ids: Iterable[int], db: Session):
+        """
+        Освобождение ночей отмененных покупок (ночи удаленных покупок удаляются на стороне БД)
+        :param purchase_ids: id отмененных покупок
+        :param db: сессия БД
+        :return:
+        """
+        purchase_ids = list(purchase_ids)
+        if not settings.ROOM_NIGHT_LEDGER or not purchase_ids:
+            return
+        db.query(RoomNight).filter(
+            RoomNight.purchase_id.in_(purchase_ids),
+        ).delete(synchronize_session=False)
+
+    @classmethod
+    def rebuild(cls, db: Session) -> int:
+        """
+        Полное перестроение журнала по таблице покупок
+        :param db: сессия БД
+        :return: кол-во записанных ночей
+        """
+        db.query(RoomNight).delete(synchronize_session=False)
+        # если в покупках уже есть пересекающиеся брони, то ночь достается одной из них
+        inserted = db.execute(
+            pg_insert(RoomNight).from_select(
+                ['room_id', 'night', 'purchase_id'],
+                cls.__purchases_nights(),
+            ).on_conflict_do_nothing()
+        ).rowcount
+        db.commit()
+        return inserted
+
+    @classmethod
+    def verify(cls, db: Session) -> LedgerDrift:
+        """
+        Сравнение журнала с таблицей покупок
+        :param db: сессия БД
+        :return: расхождения журнала
+        """
+        expected = cls.__purchases_nights()
+        actual = select(RoomNight.room_id, RoomNight.night, RoomNight.purchase_id)
+        missing = select(func.count()).select_from(expected.except_(actual).subquery()).scalar_subquery()
+        extra = select(func.count()).select_from(actual.except_(expected).subquery()).scalar_subquery()
+        return LedgerDrift(*db.execute(select(missing, extra)).one())
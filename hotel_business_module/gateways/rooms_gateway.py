@@ -1,14 +1,21 @@
 from datetime import datetime
 from ..settings import settings
 from ..models.rooms import Room
+from ..utils.calendar_cache import calendar_cache
+from ..session.routing import replica_read
+from ..utils.gateway_metrics import instrumented
 from sqlalchemy import func
 from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
 
 
+@instrumented
 class RoomsGateway:
     @staticmethod
     def save_room(room: Room, db: Session):
         db.add(room)
+        # при переносе комнаты в другую категорию меняется кол-во свободных комнат обеих категорий
+        old_categories = get_history(room, 'category_id').deleted or []
 
         if room.id is None and room.room_number is None:
             current_max = db.query(func.max(Room.room_number)).filter(
@@ -20,14 +27,18 @@ class RoomsGateway:
                 room.room_number = current_max + 1
 
         db.commit()
+        for category_id in {room.category_id, *old_categories}:
+            calendar_cache.invalidate_category(category_id)
 
     @staticmethod
     def delete_room(room: Room, db: Session):
         db.add(room)
         room.date_deleted = datetime.now(tz=settings.TIMEZONE)
         db.commit()
+        calendar_cache.invalidate_category(room.category_id)
 
     @staticmethod
+    @replica_read
     def get_all(db: Session):
         return db.query(Room).filter_by(date_deleted=None).all()
 
@@ -1,21 +1,43 @@
 import math
 from datetime import datetime
-from typing import Optional
+from typing import List, Optional
 from sqlalchemy import desc
+from sqlalchemy.orm.attributes import get_history
+from ..models.categories import Category
 from ..models.sales import Sale
 from ..settings import settings
+from ..session.routing import replica_read
+from ..utils.gateway_metrics import instrumented
 from hotel_business_module.utils.file_manager import FileManager
 from hotel_business_module.utils.protocols import SupportsReading, SupportsAsyncReading
+from hotel_business_module.utils.sales_timeline import sales_timeline
 from sqlalchemy.orm import Session
 
 
+@instrumented
 class SalesGateway:
+    @staticmethod
+    def __affected_categories(sale: Sale) -> List[Category]:
+        """
+        Категории, графики скидок которых затрагивает изменение скидки: текущие и отвязанные от нее
+        (собираются до фиксации транзакции, пока история связи доступна)
+        """
+        history = get_history(sale, 'categories')
+        return [*history.unchanged, *history.added, *history.deleted]
+
+    @staticmethod
+    def __invalidate_timelines(categories: List[Category]):
+        # графики скидок этих категорий нужно перестроить (id новых категорий известны только после фиксации)
+        sales_timeline.invalidate([category.id for category in categories])
+
     @staticmethod
     def save_sale(sale: Sale, db: Session, file: Optional[SupportsReading], file_name: Optional[str]):
         db.add(sale)
+        categories = SalesGateway.__affected_categories(sale)
         if file is not None and file_name is not None:
             sale.image_path = FileManager.save_file(file=file, file_name=file_name, old_path=sale.image_path)
         db.commit()
+        SalesGateway.__invalidate_timelines(categories)
 
     @staticmethod
     async def asave_sale(
@@ -25,20 +47,25 @@ class SalesGateway:
             file_name: str | None = None
     ):
         db.add(sale)
+        categories = SalesGateway.__affected_categories(sale)
         if file is not None and file_name is not None:
             sale.image_path = await FileManager.asave_file(
                 file=file, file_name=file_name, old_path=sale.image_path
             )
         db.commit()
+        SalesGateway.__invalidate_timelines(categories)
 
     @staticmethod
     def delete_sale(sale: Sale, db: Session):
         db.add(sale)
+        categories = SalesGateway.__affected_categories(sale)
         sale.date_deleted = datetime.now(tz=settings.TIMEZONE)
         FileManager.delete_file(sale.image_path)
         db.commit()
+        SalesGateway.__invalidate_timelines(categories)
 
     @staticmethod
+    @replica_read
     def filter(filter: dict, db: Session):
         sales = db.query(Sale).filter_by(date_deleted=None)
         if 'id' in filter:
@@ -77,9 +104,11 @@ class SalesGateway:
         limit = filter['page_size']
         offset = filter['page_size'] * (filter['page'] - 1)
         pages_count = math.ceil(sales.count() / filter['page_size'])
-        return sales.offset(offset).limit(limit), pages_count
+        # страница загружается здесь, пока запросы направляются на реплику
+        return sales.offset(offset).limit(limit).all(), pages_count
 
     @staticmethod
+    @replica_read
     def get_all(db: Session):
         return db.query(Sale).filter(Sale.date_deleted == None).all()
 
@@ -1,8 +1,11 @@
 from sqlalchemy.exc import IntegrityError
 from ..models.tags import Tag
+from ..session.routing import replica_read
+from ..utils.gateway_metrics import instrumented
 from sqlalchemy.orm import Session
 
 
+@instrumented
 class TagsGateway:
     @staticmethod
     def save_tag(tag: Tag, db: Session):
@@ -18,6 +21,7 @@ class TagsGateway:
         db.commit()
 
     @staticmethod
+    @replica_read
     def get_all(db: Session):
         return db.query(Tag).all()
 
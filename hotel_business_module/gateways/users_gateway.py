@@ -1,10 +1,10 @@
 import hashlib
 import uuid
 from datetime import datetime
-from typing import List
-import bcrypt
+from typing import FrozenSet, List
 import jwt
 from jwt.exceptions import DecodeError, ExpiredSignatureError
+from sqlalchemy import select
 from sqlalchemy.orm import Session
 from ..models.black_list_tokens import BlackListJWT
 from ..models.groups import group_permission
@@ -13,6 +13,10 @@ from ..models.tokens import Token, TokenType
 from ..models.users import User
 from ..models.users import user_group
 from ..settings import settings
+from ..session.routing import replica_read
+from ..utils.gateway_metrics import instrumented
+from ..utils.passwords import check_password, hash_password, needs_rehash
+from ..utils.permission_cache import permission_cache
 
 
 def gen_confirm_token():
@@ -27,6 +31,7 @@ def gen_confirm_token():
     return clean_token, hashed_token
 
 
+@instrumented
 class UsersGateway:
     """
     Класс для работы с пользователями (аутентификация, сброс пароля, регистрация и т.п.)
@@ -41,13 +46,54 @@ class UsersGateway:
         :param db: сессия БД
         :return:
         """
-        user = db.query(User).filter_by(email=login).first()
-        if user is None \
-                or not bcrypt.checkpw(password.encode('utf-8'), user.password.encode('utf-8')) \
-                or not user.is_confirmed:
+        user = UsersGateway.get_by_email(login, db)
+        if user is None or not check_password(password, user.password) or not user.is_confirmed:
             raise ValueError('Активный пользователь с таким логином и паролем не найден')
+        # хэш, посчитанный с устаревшей стоимостью, пересчитываем, пока известен пароль
+        if needs_rehash(user.password):
+            UsersGateway.set_password(user, hash_password(password), db)
         return user
 
+    @staticmethod
+    def get_by_email(email: str, db: Session):
+        return db.query(User).filter_by(email=email).first()
+
+    @staticmethod
+    def set_password(user: User, hashed_password: str, db: Session):
+        """
+        Сохранение нового хэша пароля пользователя
+        :param user: пользователь
+        :param hashed_password: хэш пароля
+        :param db: сессия БД
+        :return:
+        """
+        db.add(user)
+        user.password = hashed_password
+        db.commit()
+
+    @staticmethod
+    def get_permission_codes(user: User, db: Session) -> FrozenSet[str]:
+        """
+        Получение кодов всех прав пользователя (через кэш прав)
+        :param user: пользователь
+        :param db: сессия БД
+        :return: множество кодов прав
+        """
+        if user.id is None:
+            return frozenset()
+        codes = permission_cache.get(user.id) if permission_cache.enabled else None
+        if codes is None:
+            # версию запоминаем до запроса, чтоб права, измененные во время загрузки, не попали в кэш как актуальные
+            version = permission_cache.version
+            codes = frozenset(db.scalars(
+                select(Permission.code).join(group_permission).join(
+                    user_group, user_group.c.group_id == group_permission.c.group_id
+                ).where(user_group.c.user_id == user.id)
+            ).all())
+            if permission_cache.enabled:
+                permission_cache.set(user.id, codes, version)
+        return codes
+
     @staticmethod
     def get_user_permissions(user: User, db: Session):
         """
@@ -56,10 +102,10 @@ class UsersGateway:
         :param db:
         :return:
         """
-        return db.query(Permission).join(group_permission).join(
-            user_group, user_group.c.group_id == group_permission.c.group_id
-        ).filter(user_group.c.user_id == user.id).all()
-
+        codes = UsersGateway.get_permission_codes(user, db)
+        if not codes:
+            return []
+        return db.query(Permission).filter(Permission.code.in_(codes)).all()
 
     @staticmethod
     def can_actions(user: User, codes: List[str], db: Session):
@@ -74,30 +120,20 @@ class UsersGateway:
         if hasattr(user, 'is_superuser') and user.is_superuser:
             return True
 
-        # получаем список необходимых прав
-        required_permissions = db.query(Permission).filter(
-            Permission.code.in_(codes),
-        )
-
-        # получаем права пользователя
-        user_permissions = db.query(User.id, group_permission.c.permission_id).join(user_group).join(
-            group_permission, group_permission.c.group_id == user_group.c.group_id
-        ).filter(
-            User.id == user.id,
-        ).subquery('user_permissions')
-
-        # получаем объединение прав пользователя с необходимым правами
-        user_required_permissions = required_permissions.join(
-            user_permissions, user_permissions.c.permission_id == Permission.id
-        )
-
-        # если кол-во необходимых права пользователя меньше переданного списка необхимых прав, то прав не хватает
-        if user_required_permissions.count() < required_permissions.count():
-            return False
-        return True
+        # у пользователя должны быть все переданные права (при попадании в кэш без запросов к БД).
+        # кэш прав свой в каждом процессе: изменения прав сбрасывают его только в процессе, где они сделаны,
+        # в остальных процессах отозванные права действуют до истечения PERMISSION_CACHE_TTL
+        return set(codes) <= UsersGateway.get_permission_codes(user, db)
 
     @staticmethod
-    def register_user(user: User, db: Session):
+    def register_user(user: User, db: Session, hashed_password: str | None = None):
+        """
+        Регистрация пользователя
+        :param user: пользователь с паролем в чистом виде
+        :param db: сессия БД
+        :param hashed_password: уже посчитанный хэш пароля (если None, то хэшируется пароль пользователя)
+        :return: пользователь и токен подтверждения
+        """
         # проверяем есть ли зарегестрированный (с паролем) пользователь с такой эл. почтой
         if db.query(
                 db.query(User).filter(
@@ -107,6 +143,10 @@ class UsersGateway:
         ).scalar():
             raise ValueError('Пользователь с таким адресом эл. почты уже ререгестрирован')
 
+        if hashed_password is None:
+            # хэшируем пароль (bcrypt сохраняет соль прямо в хэш)
+            hashed_password = hash_password(user.password)
+
         unregistered_user = db.query(User).filter(
             User.email == user.email,
             User.is_confirmed == False,
@@ -115,9 +155,7 @@ class UsersGateway:
             # если есть созданный, но не зарегестрированный (без пароля) клиент, то устанавливаем регестрируем его
             user = unregistered_user
 
-        # хэшируем пароль (bcrypt сохраняет соль прямо в хэш)
-        hashed_password = bcrypt.hashpw(user.password.encode('utf-8'), bcrypt.gensalt())
-        user.password = hashed_password.decode('utf8')
+        user.password = hashed_password
         db.add(user)
         db.flush()
 
@@ -167,12 +205,13 @@ class UsersGateway:
         return user, clean_token
 
     @staticmethod
-    def confirm_reset(token: Token, password: str, db: Session):
+    def confirm_reset(token: Token, password: str | None, db: Session, hashed_password: str | None = None):
         """
         Подтверждение сброса пароля
         :param token: токен сброса пароля
         :param password: пароль (в чистом виде)
         :param db: сессия БД
+        :param hashed_password: уже посчитанный хэш пароля (тогда password не используется)
         :return:
         """
         db.add(token)
@@ -180,8 +219,7 @@ class UsersGateway:
         # отмечаем токен как использованный
         token.is_used = True
         # хэшируем пароль
-        hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
-        token.user.password = hashed_password.decode('utf8')
+        token.user.password = hashed_password or hash_password(password)
         db.commit()
 
     @staticmethod
@@ -271,6 +309,7 @@ class UsersGateway:
         return access_token, refresh_token
 
     @staticmethod
+    @replica_read
     def get_all(db: Session):
         return db.query(User).filter(date_deleted=None).all()
 
@@ -1,11 +1,15 @@
 from datetime import datetime
-import bcrypt
 from sqlalchemy.orm import Session
 from ..models.groups import Group
 from ..models.users import Worker
 from ..settings import settings
+from ..session.routing import replica_read
+from ..utils.gateway_metrics import instrumented
+from ..utils.passwords import hash_password
+from ..utils.permission_cache import permission_cache
 
 
+@instrumented
 class WorkersGateway:
     @staticmethod
     def save_worker(worker: Worker, db: Session):
@@ -19,6 +23,7 @@ class WorkersGateway:
         db.commit()
 
     @staticmethod
+    @replica_read
     def get_all(db: Session):
         return db.query(Worker).filter_by(date_deleted=None).all()
 
@@ -27,11 +32,10 @@ class WorkersGateway:
         return db.query(Worker).filter_by(id=worker_id, date_deleted=None).first()
 
     @staticmethod
-    def create_superuser(email: str, password: str, db: Session):
-        hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+    def create_superuser(email: str, password: str | None, db: Session, hashed_password: str | None = None):
         super_user = Worker(
             email=email,
-            password=hashed_password.decode('utf8'),
+            password=hashed_password or hash_password(password),
             is_superuser=True,
             salary=0,
             is_confirmed=True,
@@ -44,6 +48,7 @@ class WorkersGateway:
         db.add(worker)
         worker.groups.append(group)
         db.commit()
+        permission_cache.bump()
 
     @staticmethod
     def remove_group_from_worker(worker: Worker, group: Group, db: Session):
@@ -51,3 +56,4 @@ class WorkersGateway:
         if group in worker.groups:
             worker.groups.remove(group)
         db.commit()
+        permission_cache.bump()
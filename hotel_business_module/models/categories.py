@@ -26,7 +26,7 @@ class Category(Base):
     floors: Mapped[int]
     beds: Mapped[int]
     square: Mapped[float]
-    date_created: Mapped[datetime] = mapped_column(default=datetime.now(tz=settings.TIMEZONE))
+    date_created: Mapped[datetime] = mapped_column(default=lambda: datetime.now(tz=settings.TIMEZONE))
     date_deleted: Mapped[Optional[datetime]] = mapped_column(index=True)
     is_hidden: Mapped[bool] = mapped_column(default=False, index=True)
 
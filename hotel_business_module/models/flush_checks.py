@@ -0,0 +1,61 @@
+from itertools import chain
+from typing import Callable, Iterable, List, Set, Tuple, Type
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session
+
+# проверки, которые выполняются один раз на flush для всех новых и измененных объектов модели
+_checks: List[Tuple[Type, Callable[[Session, list], None]]] = []
+
+
+def flush_check(model: Type):
+    """
+    Регистрация проверки объектов модели перед записью в БД.
+    Проверка получает сессию вызывающего кода и сразу все новые и измененные объекты модели,
+    поэтому должна проверять их пачкой, а не по одному
+    :param model: модель, объекты которой проверяются
+    :return: декоратор функции проверки (db, objects)
+    """
+    def decorator(check: Callable[[Session, list], None]):
+        _checks.append((model, check))
+        return check
+    return decorator
+
+
+def changed_objects(objects: Iterable, key: str) -> list:
+    """
+    Объекты, у которых при текущем flush задано или изменено значение атрибута
+    :param objects: проверяемые объекты
+    :param key: название атрибута
+    :return: список объектов с новым значением атрибута (кроме None)
+    """
+    return [
+        obj for obj in objects
+        if inspect(obj).attrs[key].history.has_changes() and getattr(obj, key) is not None
+    ]
+
+
+def missing_ids(db: Session, column, ids: Iterable[int], *criteria) -> Set[int]:
+    """
+    Поиск id, которым не нашлось строки в БД (одним запросом)
+    :param db: сессия
+    :param column: колонка id
+    :param ids: искомые id
+    :param criteria: дополнительные условия, которым должна удовлетворять строка
+    :return: множество ненайденных id
+    """
+    ids = set(ids)
+    if not ids:
+        return set()
+    found = db.scalars(select(column).where(column.in_(ids), *criteria)).all()
+    return ids - set(found)
+
+
+@event.listens_for(Session, 'before_flush')
+def run_flush_checks(db: Session, flush_context, instances):
+    pending = [obj for obj in chain(db.new, db.dirty) if obj not in db.deleted]
+    if not pending:
+        return
+    for model, check in _checks:
+        objects = [obj for obj in pending if isinstance(obj, model)]
+        if objects:
+            check(db, objects)
@@ -0,0 +1,14 @@
+from datetime import date
+from .base import Base
+from sqlalchemy.orm import Mapped, mapped_column
+
+
+class JobWatermark(Base):
+    """
+    Отметка, до которой фоновая задача уже обработала данные (чтоб следующий запуск начинал с нее)
+    """
+    __tablename__ = 'job_watermark'
+    REPR_MODEL_NAME = 'отметка задачи'
+
+    name: Mapped[str] = mapped_column(primary_key=True)
+    value: Mapped[date]
@@ -1,6 +1,8 @@
 from typing import Optional, List
-from sqlalchemy.orm import Mapped, mapped_column, relationship, validates, column_property
-from sqlalchemy import ForeignKey, func, select, event, case, and_
+from sqlalchemy.orm import Mapped, mapped_column, relationship, validates, Session
+from sqlalchemy import ForeignKey, func, select, event, case, and_, or_, column, text, DDL, Index
+from sqlalchemy.dialects.postgresql import ExcludeConstraint
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.types import DECIMAL, UUID
 from _decimal import Decimal
@@ -8,6 +10,8 @@ from datetime import datetime, date
 from ..settings import settings
 from .base import Base
 from ..session.session import get_session
+from .flush_checks import flush_check, changed_objects, missing_ids
+from ..utils.purchase_events import NOTIFY_CHANNEL, NOTIFY_SETTING
 import uuid
 import hotel_business_module.models.users as users
 import hotel_business_module.models.rooms as rooms
@@ -15,11 +19,23 @@ import hotel_business_module.models.rooms as rooms
 
 class Purchase(Base):
     __tablename__ = 'purchase'
+    __table_args__ = (
+        # на уровне БД запрещаем пересекающиеся действующие брони одной комнаты,
+        # gist индекс ограничения также используется в запросах на пересечение периодов
+        ExcludeConstraint(
+            (column('room_id'), '='),
+            (func.daterange(column('start'), column('end')), '&&'),
+            name='purchase_room_dates_excl',
+            using='gist',
+            where=text('NOT is_canceled'),
+        ),
+    )
     REPR_MODEL_NAME = 'покупка'
 
     id: Mapped[int] = mapped_column(primary_key=True)
     start: Mapped[date]
-    end: Mapped[date]
+    # по дате конца задача завершения заказов выбирает покупки, закончившиеся с прошлого запуска
+    end: Mapped[date] = mapped_column(index=True)
     price: Mapped[Decimal] = mapped_column(DECIMAL(precision=10, scale=2), default=0)
     prepayment: Mapped[Decimal] = mapped_column(DECIMAL(precision=10, scale=2), default=0)
     refund: Mapped[Decimal] = mapped_column(DECIMAL(precision=10, scale=2), default=0)
@@ -27,29 +43,62 @@ class Purchase(Base):
     is_prepayment_paid: Mapped[bool] = mapped_column(default=False, index=True)
     is_canceled: Mapped[bool] = mapped_column(default=False, index=True)
 
-    order_id: Mapped[int] = mapped_column(ForeignKey('base_order.id'))
+    order_id: Mapped[int] = mapped_column(ForeignKey('base_order.id'), index=True)
     order: Mapped['BaseOrder'] = relationship(back_populates='purchases')
 
     room_id: Mapped[int] = mapped_column(ForeignKey('room.id'))
     room: Mapped['rooms.Room'] = relationship(back_populates='purchases')
 
-    @validates('order_id')
-    def validate_order_id(self, key, order_id):
-        with get_session() as db:
-            if not db.query(
-                    and_(
-                        select(BaseOrder).where(
-                            BaseOrder.id == order_id,
-                        ).exists(),
-                        select(Order).where(
-                            Order.date_canceled == None,
-                            Order.date_finished == None,
-                        ).exists(),
-                    )
-            ).scalar():
-                raise ValueError('Не найден заказ с таким id')
+    @hybrid_property
+    def order_price(self):
+        """
+        Вклад покупки в цену заказа (та же формула, что и в триггере purchase_order_totals)
+        """
+        if self.is_canceled and self.is_paid:
+            return self.price - self.refund
+        if self.is_canceled:
+            return self.prepayment
+        return self.price
+
+    @order_price.inplace.expression
+    @classmethod
+    def _order_price_expression(cls):
+        return case(
+            # если отменен и оплачен, то цена = цена - возврат средств
+            (and_(cls.is_canceled == True, cls.is_paid == True), cls.price - cls.refund),
+            # если отменен и не оплачен, то цена = предоплате
+            (and_(cls.is_canceled == True, cls.is_paid == False), cls.prepayment),
+            # иначе цена = цене
+            else_=cls.price
+        )
 
-            return order_id
+
+@flush_check(Purchase)
+def check_purchases(db: Session, purchases: List[Purchase]):
+    """
+    Проверка заказов сохраняемых покупок: заказ должен существовать и не быть отмененным или завершенным
+    """
+    order_ids = {purchase.order_id for purchase in changed_objects(purchases, 'order_id')}
+    client_order = Order.__table__
+    if missing_ids(
+            db, BaseOrder.id, order_ids,
+            # корзины тоже заказы, у них нет строки в client_order
+            ~select(client_order.c.id).where(
+                client_order.c.id == BaseOrder.id,
+                or_(client_order.c.date_canceled != None, client_order.c.date_finished != None),
+            ).exists(),
+    ):
+        raise ValueError('Не найден заказ с таким id')
+
+
+def is_booking_conflict(exc: IntegrityError) -> bool:
+    """
+    Проверка, что ошибка вызвана пересечением броней одной комнаты
+    (ограничение purchase_room_dates_excl или первичный ключ журнала ночей)
+    """
+    # psycopg2 хранит имя ограничения в diag, у asyncpg оно в исходном исключении драйвера
+    diag = getattr(exc.orig, 'diag', None) or getattr(exc.orig, '__cause__', None)
+    return getattr(diag, 'constraint_name', None) in ('purchase_room_dates_excl', 'room_night_pkey')
 
 
 def validate_dates(mapper, connection, target: Purchase):
@@ -59,45 +108,155 @@ def validate_dates(mapper, connection, target: Purchase):
 
 event.listen(Purchase, 'before_insert', validate_dates)
 event.listen(Purchase, 'before_update', validate_dates)
+# для ограничения на пересечение броней нужен оператор = в gist индексе
+event.listen(Base.metadata, 'before_create', DDL('CREATE EXTENSION IF NOT EXISTS btree_gist'))
+
+# вклад покупки в цену заказа: если отменена и оплачена, то цена - возврат средств,
+# если отменена и не оплачена, то предоплата, иначе цена
+PURCHASE_ORDER_PRICE = '''
+CASE
+    WHEN {row}.is_canceled AND {row}.is_paid THEN {row}.price - {row}.refund
+    WHEN {row}.is_canceled THEN {row}.prepayment
+    ELSE {row}.price
+END
+'''
+
+# изменение итогов заказов на сумму вкладов строк {rows} (order_id, price, prepayment), каждый заказ обновляется один раз
+ORDER_TOTALS_UPDATE = '''
+        UPDATE base_order SET
+            price_total = price_total + delta.price,
+            prepayment_total = prepayment_total + delta.prepayment
+        FROM (
+            SELECT order_id, sum(price) AS price, sum(prepayment) AS prepayment FROM ({rows}) AS rows GROUP BY order_id
+        ) AS delta
+        WHERE base_order.id = delta.order_id AND (delta.price <> 0 OR delta.prepayment <> 0);
+'''
+NEW_ROWS = f'SELECT n.order_id, {PURCHASE_ORDER_PRICE.format(row="n")} AS price, n.prepayment FROM new_rows n'
+OLD_ROWS = f'SELECT o.order_id, -({PURCHASE_ORDER_PRICE.format(row="o")}) AS price, -o.prepayment AS prepayment FROM old_rows o'
+
+# триггеры поддерживают итоги заказа (base_order.price_total, prepayment_total) разницей старых и новых строк покупок,
+# поэтому итоги верны и после массовых update/delete в обход ORM. Триггеры срабатывают один раз на оператор:
+# измененные строки берутся из таблиц переходов, и каждый затронутый заказ обновляется одним изменением
+PURCHASE_ORDER_TOTALS_FUNCTION = DDL(f'''
+CREATE OR REPLACE FUNCTION purchase_order_totals() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        {ORDER_TOTALS_UPDATE.format(rows=NEW_ROWS)}
+    ELSIF TG_OP = 'DELETE' THEN
+        {ORDER_TOTALS_UPDATE.format(rows=OLD_ROWS)}
+    ELSE
+        {ORDER_TOTALS_UPDATE.format(rows=f'{NEW_ROWS} UNION ALL {OLD_ROWS}')}
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+''')
+
+# у триггера с таблицами переходов не может быть списка столбцов и нескольких событий,
+# поэтому на каждое событие свой триггер (не изменившие итоги обновления отсеиваются в функции)
+PURCHASE_ORDER_TOTALS_TRIGGERS = [
+    DDL(f'''
+CREATE TRIGGER purchase_order_totals_{event_name.lower()}
+AFTER {event_name} ON purchase
+REFERENCING {tables}
+FOR EACH STATEMENT EXECUTE FUNCTION purchase_order_totals()
+''')
+    for event_name, tables in (
+        ('INSERT', 'NEW TABLE AS new_rows'),
+        ('UPDATE', 'OLD TABLE AS old_rows NEW TABLE AS new_rows'),
+        ('DELETE', 'OLD TABLE AS old_rows'),
+    )
+]
+
+event.listen(Purchase.__table__, 'after_create', PURCHASE_ORDER_TOTALS_FUNCTION)
+for trigger in PURCHASE_ORDER_TOTALS_TRIGGERS:
+    event.listen(Purchase.__table__, 'after_create', trigger)
+
+# занятость строк покупок {rows}: комната и ночи, которые заняты (is_busy) или освобождены изменением.
+# отмененные покупки комнату не занимают, при обновлении учитываются только строки с измененной занятостью
+OCCUPANCY_CHANGES = {
+    'INSERT': 'SELECT n.room_id, n.start, n."end", true AS is_busy FROM new_rows n WHERE NOT n.is_canceled',
+    'DELETE': 'SELECT o.room_id, o.start, o."end", false AS is_busy FROM old_rows o WHERE NOT o.is_canceled',
+    'UPDATE': '''
+        SELECT occupancy.room_id, occupancy.start, occupancy."end", occupancy.is_busy
+        FROM old_rows o JOIN new_rows n USING (id)
+        CROSS JOIN LATERAL (VALUES
+            (o.room_id, o.start, o."end", false, o.is_canceled),
+            (n.room_id, n.start, n."end", true, n.is_canceled)
+        ) AS occupancy (room_id, start, "end", is_busy, is_canceled)
+        WHERE NOT occupancy.is_canceled
+        AND (o.room_id, o.start, o."end", o.is_canceled) IS DISTINCT FROM (n.room_id, n.start, n."end", n.is_canceled)
+        ORDER BY occupancy.is_busy
+    ''',
+}
+
+# оповещение через NOTIFY о занятых и освобожденных ночах комнат: оповещения доставляются слушателям
+# только после фиксации транзакции и содержат ее id, чтоб слушатель мог отбросить уже загруженные изменения
+OCCUPANCY_NOTIFY = '''
+        PERFORM pg_notify('{channel}', json_build_object(
+            'xid', pg_current_xact_id()::text,
+            'room_id', changes.room_id,
+            'start', changes.start,
+            'end', changes."end",
+            'is_busy', changes.is_busy
+        )::text) FROM ({changes}) AS changes;
+'''
+
+# триггеры оповещают, только если для соединения включен параметр NOTIFY_SETTING (settings.OCCUPANCY_NOTIFY)
+PURCHASE_OCCUPANCY_FUNCTION = DDL(f'''
+CREATE OR REPLACE FUNCTION purchase_occupancy_notify() RETURNS trigger AS $$
+BEGIN
+    IF coalesce(current_setting('{NOTIFY_SETTING}', true), '') <> 'on' THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP = 'INSERT' THEN
+        {OCCUPANCY_NOTIFY.format(channel=NOTIFY_CHANNEL, changes=OCCUPANCY_CHANGES['INSERT'])}
+    ELSIF TG_OP = 'DELETE' THEN
+        {OCCUPANCY_NOTIFY.format(channel=NOTIFY_CHANNEL, changes=OCCUPANCY_CHANGES['DELETE'])}
+    ELSE
+        {OCCUPANCY_NOTIFY.format(channel=NOTIFY_CHANNEL, changes=OCCUPANCY_CHANGES['UPDATE'])}
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+''')
+
+PURCHASE_OCCUPANCY_TRIGGERS = [
+    DDL(f'''
+CREATE TRIGGER purchase_occupancy_{event_name.lower()}
+AFTER {event_name} ON purchase
+REFERENCING {tables}
+FOR EACH STATEMENT EXECUTE FUNCTION purchase_occupancy_notify()
+''')
+    for event_name, tables in (
+        ('INSERT', 'NEW TABLE AS new_rows'),
+        ('UPDATE', 'OLD TABLE AS old_rows NEW TABLE AS new_rows'),
+        ('DELETE', 'OLD TABLE AS old_rows'),
+    )
+]
+
+event.listen(Purchase.__table__, 'after_create', PURCHASE_OCCUPANCY_FUNCTION)
+for trigger in PURCHASE_OCCUPANCY_TRIGGERS:
+    event.listen(Purchase.__table__, 'after_create', trigger)
 
 
 class BaseOrder(Base):
     __tablename__ = 'base_order'
+    # по индексу чистка брошенных корзин выбирает самые старые корзины
+    __table_args__ = (Index('base_order_type_date_created_index', 'type', 'date_created'), )
     REPR_MODEL_NAME = 'заказ'
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    date_created: Mapped[datetime] = mapped_column(default=datetime.now(tz=settings.TIMEZONE))
+    date_created: Mapped[datetime] = mapped_column(default=lambda: datetime.now(tz=settings.TIMEZONE))
     type: Mapped[str]
 
-    # вычисляемое свойство для получения цены из покупок в заказе
-    price = column_property(
-        func.coalesce(
-            select(func.sum(
-                case(
-                    # если отменен и оплачен, то цена = цена - возврат средств
-                    (and_(Purchase.is_canceled == True, Purchase.is_paid == True), Purchase.price - Purchase.refund),
-                    # если отменен и не оплачен, то цена = предоплате
-                    (and_(Purchase.is_canceled == True, Purchase.is_paid == False), Purchase.prepayment),
-                    # иначе цена = цене
-                    else_=Purchase.price
-                )
-            ))
-            .where(Purchase.order_id == id)
-            .correlate_except(Purchase)
-            .scalar_subquery(),
-            0
-        )
+    # цена и предоплата заказа хранятся в base_order и пересчитываются триггером purchase_order_totals
+    # при каждом изменении покупок, поэтому загрузка и фильтрация заказов не суммирует покупки
+    price: Mapped[Decimal] = mapped_column(
+        'price_total', DECIMAL(precision=10, scale=2), default=0, server_default='0',
     )
-
-    # вычисляемое свойство для получения предоплаты из покупок в заказе
-    prepayment = column_property(
-        func.coalesce(
-            select(func.sum(Purchase.prepayment))
-            .where(Purchase.order_id == id)
-            .correlate_except(Purchase)
-            .scalar_subquery(),
-            0
-        )
+    prepayment: Mapped[Decimal] = mapped_column(
+        'prepayment_total', DECIMAL(precision=10, scale=2), default=0, server_default='0',
     )
 
     purchases: Mapped[List['Purchase']] = relationship(back_populates='order')
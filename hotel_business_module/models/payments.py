@@ -0,0 +1,27 @@
+from datetime import datetime
+from _decimal import Decimal
+from .base import Base
+from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy import ForeignKey, CheckConstraint
+from sqlalchemy.types import DECIMAL
+
+
+class Payment(Base):
+    """
+    Журнал оплат и возвратов заказа (строки только добавляются), Order.paid и Order.refunded - его итоги
+    """
+    __tablename__ = 'payment'
+    __table_args__ = (
+        CheckConstraint('amount > 0', name='payment_amount_positive'),
+        CheckConstraint("kind IN ('payment', 'refund')", name='payment_kind'),
+    )
+    REPR_MODEL_NAME = 'платеж'
+
+    PAYMENT = 'payment'
+    REFUND = 'refund'
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    order_id: Mapped[int] = mapped_column(ForeignKey('client_order.id'), index=True)
+    amount: Mapped[Decimal] = mapped_column(DECIMAL(precision=10, scale=2))
+    kind: Mapped[str]
+    date_created: Mapped[datetime]
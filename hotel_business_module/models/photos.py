@@ -1,8 +1,9 @@
 from .base import Base
-from sqlalchemy.orm import Mapped, mapped_column, relationship, validates
-from sqlalchemy import ForeignKey, select
+from typing import List
+from sqlalchemy.orm import Mapped, mapped_column, relationship, validates, Session
+from sqlalchemy import ForeignKey
 import hotel_business_module.models.categories as categories
-from ..session.session import get_session
+from .flush_checks import flush_check, changed_objects, missing_ids
 
 
 class Photo(Base):
@@ -23,18 +24,15 @@ class Photo(Base):
 
         return order
 
-    @validates('category_id')
-    def validate_category_id(self, key, category_id):
-        with get_session() as db:
-            if not db.query(
-                    select(categories.Category).where(
-                        categories.Category.id == category_id,
-                        categories.Category.date_deleted == None,
-                    ).exists(),
-            ).scalar():
-                raise ValueError('Не найдена категория с таким id')
-
-            return category_id
+
+@flush_check(Photo)
+def check_photos(db: Session, photos: List[Photo]):
+    """
+    Проверка категорий сохраняемых фотографий
+    """
+    category_ids = {photo.category_id for photo in changed_objects(photos, 'category_id')}
+    if missing_ids(db, categories.Category.id, category_ids, categories.Category.date_deleted == None):
+        raise ValueError('Не найдена категория с таким id')
 
 
 # @event.listens_for(Photo, 'before_insert')
@@ -0,0 +1,18 @@
+from datetime import date
+from .base import Base
+from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy import ForeignKey
+
+
+class RoomNight(Base):
+    """
+    Журнал занятости комнат: одна строка на каждую ночь действующей (не отмененной) покупки
+    """
+    __tablename__ = 'room_night'
+    REPR_MODEL_NAME = 'ночь брони'
+
+    room_id: Mapped[int] = mapped_column(ForeignKey('room.id'), primary_key=True)
+    night: Mapped[date] = mapped_column(primary_key=True)
+
+    # при удалении покупки ее ночи удаляются на стороне БД
+    purchase_id: Mapped[int] = mapped_column(ForeignKey('purchase.id', ondelete='CASCADE'), index=True)
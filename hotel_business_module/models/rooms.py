@@ -1,12 +1,13 @@
+from collections import Counter
 from datetime import datetime
-from typing import Optional
+from typing import Optional, List
 from .base import Base
 from ..settings import settings
-from sqlalchemy.orm import Mapped, validates, mapped_column, relationship
+from sqlalchemy.orm import Mapped, validates, mapped_column, relationship, Session
 from sqlalchemy import ForeignKey, select
 import hotel_business_module.models.categories as categories
 import hotel_business_module.models.orders as orders
-from ..session.session import get_session
+from .flush_checks import flush_check, changed_objects, missing_ids
 
 
 class Room(Base):
@@ -15,7 +16,7 @@ class Room(Base):
 
     id: Mapped[int] = mapped_column(primary_key=True)
     room_number: Mapped[int]
-    date_created: Mapped[datetime] = mapped_column(default=datetime.now(tz=settings.TIMEZONE))
+    date_created: Mapped[datetime] = mapped_column(default=lambda: datetime.now(tz=settings.TIMEZONE))
     date_deleted: Mapped[Optional[datetime]] = mapped_column(index=True)
 
     category_id: Mapped[int] = mapped_column(ForeignKey("category.id"))
@@ -25,35 +26,37 @@ class Room(Base):
 
     @validates('room_number')
     def validate_room_number(self, key, room_number):
-        if room_number is None:
-            return room_number
-        with get_session() as db:
-            if db.query(
-                select(Room).where(
-                    Room.room_number == room_number,
-                    Room.date_deleted == None,
-                    Room.id != self.id
-                ).exists(),
-            ).scalar():
-                raise ValueError('Уже существует комната с этим номером')
+        # уникальность номера проверяется при сохранении (check_rooms)
+        if room_number is not None and room_number <= 0:
+            raise ValueError('Номер комнаты не может быть меньше 1')
 
-            if room_number <= 0:
-                raise ValueError('Номер комнаты не может быть меньше 1')
+        return room_number
 
-            return room_number
 
-    @validates('category_id')
-    def validate_category_id(self, key, category_id):
-        with get_session() as db:
-            if not db.query(
-                select(categories.Category).where(
-                    categories.Category.id == category_id,
-                    categories.Category.date_deleted == None,
-                ).exists(),
-            ).scalar():
-                raise ValueError('Не найдена категория с таким id')
+@flush_check(Room)
+def check_rooms(db: Session, rooms: List[Room]):
+    """
+    Проверка номеров и категорий сохраняемых комнат (по запросу на проверку, независимо от кол-ва комнат)
+    """
+    numbered = changed_objects(rooms, 'room_number')
+    numbers = Counter(room.room_number for room in numbered)
+    if any(count > 1 for count in numbers.values()):
+        raise ValueError('Уже существует комната с этим номером')
+    if numbers:
+        # строки сохраняемых комнат в БД хранят старые номера, поэтому их не учитываем
+        ids = [room.id for room in numbered if room.id is not None]
+        if db.query(
+            select(Room).where(
+                Room.room_number.in_(numbers),
+                Room.date_deleted == None,
+                Room.id.not_in(ids),
+            ).exists(),
+        ).scalar():
+            raise ValueError('Уже существует комната с этим номером')
 
-            return category_id
+    category_ids = {room.category_id for room in changed_objects(rooms, 'category_id')}
+    if missing_ids(db, categories.Category.id, category_ids, categories.Category.date_deleted == None):
+        raise ValueError('Не найдена категория с таким id')
 
 
 # @event.listens_for(Room, 'before_insert')
@@ -28,7 +28,7 @@ class Sale(Base):
     image_path: Mapped[str]
     start_date: Mapped[datetime]
     end_date: Mapped[datetime]
-    date_created: Mapped[datetime] = mapped_column(default=datetime.now(tz=settings.TIMEZONE))
+    date_created: Mapped[datetime] = mapped_column(default=lambda: datetime.now(tz=settings.TIMEZONE))
     date_deleted: Mapped[Optional[datetime]] = mapped_column(index=True)
 
     categories: Mapped[List['categories.Category']] = relationship(
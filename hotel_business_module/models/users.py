@@ -1,14 +1,15 @@
+from collections import Counter
 from datetime import datetime, date
 from _decimal import Decimal
 from typing import List
 from ..settings import settings
-from sqlalchemy.orm import Mapped, mapped_column, relationship, validates
-from sqlalchemy import ForeignKey, Table, Column, event
+from sqlalchemy.orm import Mapped, mapped_column, relationship, validates, Session
+from sqlalchemy import ForeignKey, Table, Column, select
 from typing import Optional
 from .base import Base
 import hotel_business_module.models.orders as orders
 import hotel_business_module.models.groups as groups
-from ..session.session import get_session
+from .flush_checks import flush_check
 
 
 user_group = Table(
@@ -27,7 +28,7 @@ class User(Base):
     last_name: Mapped[Optional[str]]
     email: Mapped[str]
     password: Mapped[Optional[str]]
-    date_created: Mapped[datetime] = mapped_column(default=datetime.now(tz=settings.TIMEZONE))
+    date_created: Mapped[datetime] = mapped_column(default=lambda: datetime.now(tz=settings.TIMEZONE))
     date_deleted: Mapped[Optional[datetime]]
     is_confirmed: Mapped[bool] = mapped_column(default=False)
     type: Mapped[str]
@@ -78,16 +79,16 @@ class Worker(User):
     }
 
 
-def validate_unq_email(mapper, connection, target: User):
-    with get_session() as db:
-        if db.query(
-                db.query(User).filter(
-                    User.email == target.email,
-                    User.date_deleted == None,
-                ).exists()
-        ).scalar():
-            raise ValueError('Уже есть пользователь с таким адреос эл. почты')
-
-
-event.listen(Client, 'before_insert', validate_unq_email)
-event.listen(Worker, 'before_insert', validate_unq_email)
+@flush_check(User)
+def check_users(db: Session, users: List[User]):
+    """
+    Проверка уникальности адресов эл. почты новых пользователей
+    """
+    emails = Counter(user.email for user in users if user in db.new and user.email is not None)
+    if any(count > 1 for count in emails.values()) or emails and db.query(
+            select(User).where(
+                User.email.in_(emails),
+                User.date_deleted == None,
+            ).exists()
+    ).scalar():
+        raise ValueError('Уже есть пользователь с таким адреос эл. почты')
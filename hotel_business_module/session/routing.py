@@ -0,0 +1,191 @@
+"""
+Распределение чтений между основной БД и репликами.
+Методы шлюзов, помеченные replica_read, выполняют SELECT на одной из здоровых реплик (по кругу),
+если сессия еще ничего не записывала. После первой записи сессия до конца работает только с основной БД,
+чтобы читать свои же изменения
+"""
+import inspect
+from contextlib import contextmanager
+from functools import wraps
+from itertools import count
+from threading import Lock
+from time import monotonic
+from typing import Dict, Iterable, List, NamedTuple, Optional
+from sqlalchemy import Engine, event, text
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import CompoundSelect, Select
+from sqlalchemy.sql.dml import UpdateBase
+from ..settings import settings
+
+# отставание реплики в секундах: 0, если все полученные изменения применены (или это не реплика)
+REPLICA_LAG_QUERY = text('''
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+''')
+
+
+class ReplicaHealth(NamedTuple):
+    healthy: bool
+    # отставание в секундах (None, если реплика недоступна)
+    lag: Optional[float]
+    checked_at: float
+
+
+class ReplicaSet:
+    """
+    Набор реплик: выбор по кругу среди доступных и не отстающих больше допустимого.
+    Состояние реплики проверяется не чаще раза в check_interval секунд,
+    а при обрыве соединения реплика сразу считается недоступной до следующей проверки
+    """
+    def __init__(self, engines: Iterable[Engine], check_interval: float | None = None):
+        self.engines: List[Engine] = list(engines)
+        self.check_interval = settings.DB_REPLICA_CHECK_INTERVAL if check_interval is None else check_interval
+        self.__health: Dict[Engine, ReplicaHealth] = {}
+        self.__counter = count()
+        self.__lock = Lock()
+        for engine in self.engines:
+            event.listen(engine, 'handle_error', self.__on_error)
+
+    def __on_error(self, context):
+        if context.is_disconnect and context.engine is not None:
+            self.mark_down(context.engine)
+
+    def mark_down(self, engine: Engine):
+        """
+        Пометка реплики недоступной (до следующей проверки)
+        :param engine: движок реплики
+        """
+        self.__health[engine] = ReplicaHealth(False, None, monotonic())
+
+    @staticmethod
+    def check(engine: Engine) -> ReplicaHealth:
+        """
+        Проверка доступности и отставания реплики
+        :param engine: движок реплики
+        :return: состояние реплики
+        """
+        try:
+            with engine.connect() as connection:
+                lag = connection.scalar(REPLICA_LAG_QUERY)
+        except Exception:
+            return ReplicaHealth(False, None, monotonic())
+        return ReplicaHealth(True, float(lag), monotonic())
+
+    def health(self, engine: Engine) -> ReplicaHealth:
+        """
+        Состояние реплики (проверяется заново, если последняя проверка старше check_interval)
+        :param engine: движок реплики
+        :return: состояние реплики
+        """
+        health = self.__health.get(engine)
+        if health is None or monotonic() - health.checked_at >= self.check_interval:
+            health = self.__health[engine] = self.check(engine)
+        return health
+
+    def choose(self, max_lag: float) -> Optional[Engine]:
+        """
+        Выбор следующей по кругу реплики, доступной и отстающей не больше max_lag
+        :param max_lag: допустимое отставание в секундах
+        :return: движок реплики или None, если подходящей нет
+        """
+        if not self.engines:
+            return None
+        with self.__lock:
+            start = next(self.__counter)
+        for offset in range(len(self.engines)):
+            engine = self.engines[(start + offset) % len(self.engines)]
+            health = self.health(engine)
+            if health.healthy and health.lag <= max_lag:
+                return engine
+        return None
+
+    def dispose(self, close: bool = True):
+        """
+        Закрытие соединений пулов реплик
+        :param close: закрывать соединения (False - только забыть их, например после форка)
+        """
+        for engine in self.engines:
+            engine.dispose(close=close)
+
+
+class RoutingSession(Session):
+    """
+    Сессия, которая внутри replica_reads выполняет чтения на реплике.
+    Запись (flush, INSERT/UPDATE/DELETE) закрепляет сессию за основной БД до ее закрытия
+    """
+    def __init__(self, *args, replicas: ReplicaSet | None = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.replicas = replicas
+        self.pinned = False
+        self.__depth = 0
+        self.__max_lag: float = settings.DB_REPLICA_MAX_LAG
+        self.__replica: Optional[Engine] = None
+
+    @contextmanager
+    def replica_reads(self):
+        """
+        Чтения внутри блока можно выполнять на реплике (все - на одной)
+        """
+        self.__depth += 1
+        try:
+            yield self
+        finally:
+            self.__depth -= 1
+            if not self.__depth:
+                self.__replica = None
+
+    @contextmanager
+    def replica_lag(self, max_lag: float):
+        """
+        Допустимое отставание реплики для чтений внутри блока
+        :param max_lag: отставание в секундах (0 - только полностью догнавшая реплика)
+        """
+        previous, self.__max_lag = self.__max_lag, max_lag
+        try:
+            yield self
+        finally:
+            self.__max_lag = previous
+
+    @property
+    def reads_replica(self) -> bool:
+        """
+        Чтения текущего блока replica_reads выполнены на реплике (результат может отставать от основной БД)
+        """
+        return self.__replica is not None
+
+    @staticmethod
+    def __is_read(clause) -> bool:
+        if isinstance(clause, Select):
+            return clause._for_update_arg is None
+        return isinstance(clause, CompoundSelect)
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.pinned = True
+        elif self.__depth and self.replicas is not None and not self.pinned and self.__is_read(clause):
+            if self.__replica is None:
+                self.__replica = self.replicas.choose(self.__max_lag)
+            if self.__replica is not None:
+                return self.__replica
+        return super().get_bind(mapper, clause=clause, **kw)
+
+
+def replica_read(method):
+    """
+    Пометка метода шлюза, который только читает: в RoutingSession (параметр db) его запросы идут на реплику
+    :param method: функция метода шлюза
+    :return: обернутая функция
+    """
+    signature = inspect.signature(method)
+
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        db = signature.bind(*args, **kwargs).arguments.get('db')
+        if not isinstance(db, RoutingSession):
+            return method(*args, **kwargs)
+        with db.replica_reads():
+            return method(*args, **kwargs)
+
+    return wrapper
@@ -1,17 +1,305 @@
+import os
+from datetime import datetime, timezone
+from threading import Lock
+from time import perf_counter
+from typing import NamedTuple, Optional
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from sqlalchemy import create_engine, event, Engine
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
-from os import environ
+from sqlalchemy.pool import NullPool, QueuePool, AsyncAdaptedQueuePool
+from ..settings import settings
+from .routing import ReplicaSet, RoutingSession
+from ..utils.purchase_events import NOTIFY_SETTING
 
-db_name = environ.get('DB_NAME', 'db_name')
-db_user = environ.get('DB_USER', 'db_user')
-db_password = environ.get('DB_PASSWORD', 'db_password')
 
-engine = create_engine(
-    f'postgresql+psycopg2://{db_user}:{db_password}@db/{db_name}',
-)
+class PoolStats(NamedTuple):
+    pool: str
+    # соединения в пуле, выданные и сверх размера пула (для null пула - нули)
+    size: int
+    checked_in: int
+    checked_out: int
+    overflow: int
+    # счетчики с момента создания движка (или форка процесса)
+    checkouts: int
+    connects: int
+    timeouts: int
+    # суммарное и максимальное время получения соединения из пула в секундах
+    wait_total: float
+    wait_max: float
 
-session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine, expire_on_commit=False)
+
+class PoolCounters:
+    """
+    Счетчики пула соединений
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        self.checkouts = 0
+        self.connects = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def on_checkout(self, *args):
+        with self.lock:
+            self.checkouts += 1
+
+    def on_connect(self, *args):
+        with self.lock:
+            self.connects += 1
+
+    def on_wait(self, wait: float, timed_out: bool):
+        with self.lock:
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            self.timeouts += timed_out
+
+
+counters = PoolCounters()
+
+
+class MeasuredPoolMixin:
+    """
+    Замер времени ожидания соединения пула (ожидание освобождения или открытие нового)
+    """
+    def _do_get(self):
+        started = perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            counters.on_wait(perf_counter() - started, timed_out)
+
+
+class MeasuredQueuePool(MeasuredPoolMixin, QueuePool):
+    pass
+
+
+class MeasuredAsyncQueuePool(MeasuredPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+# классы пулов синхронного и асинхронного движков
+POOL_CLASSES = {
+    'queue': (MeasuredQueuePool, MeasuredAsyncQueuePool),
+    'null': (NullPool, NullPool),
+}
+
+_engine: Optional[Engine] = None
+_async_engine: Optional[AsyncEngine] = None
+_replicas: Optional[ReplicaSet] = None
+_engine_lock = Lock()
+
+session_factory = sessionmaker(class_=RoutingSession, autocommit=False, autoflush=False, expire_on_commit=False)
+async_session_factory = async_sessionmaker(autoflush=False, expire_on_commit=False)
+
+
+def pool_options(is_async: bool = False) -> dict:
+    """
+    Настройки пула соединений из settings
+    :param is_async: для асинхронного движка
+    :return: параметры create_engine
+    """
+    if settings.DB_POOL not in POOL_CLASSES:
+        raise ValueError(f'Неизвестный тип пула соединений: {settings.DB_POOL}')
+    pool_class = POOL_CLASSES[settings.DB_POOL][is_async]
+    options = {'poolclass': pool_class, 'pool_pre_ping': settings.DB_POOL_PRE_PING}
+    if pool_class is not NullPool:
+        options.update(
+            pool_size=settings.DB_POOL_SIZE,
+            max_overflow=settings.DB_MAX_OVERFLOW,
+            pool_timeout=settings.DB_POOL_TIMEOUT,
+            pool_recycle=settings.DB_POOL_RECYCLE,
+        )
+    return options
+
+
+def server_options() -> dict:
+    """
+    Параметры сервера для соединений из settings
+    :return: {параметр: значение}
+    """
+    options = {}
+    if settings.DB_STATEMENT_TIMEOUT:
+        options['statement_timeout'] = str(settings.DB_STATEMENT_TIMEOUT)
+    if settings.OCCUPANCY_NOTIFY:
+        options[NOTIFY_SETTING] = 'on'
+    return options
+
+
+def build_engine(url: str) -> Engine:
+    """
+    Создание движка с настройками пула и соединений из settings
+    :param url: адрес БД
+    :return: движок
+    """
+    connect_args = {'application_name': settings.DB_APPLICATION_NAME, 'connect_timeout': settings.DB_CONNECT_TIMEOUT}
+    options = ' '.join(f'-c {name}={value}' for name, value in server_options().items())
+    if options:
+        connect_args['options'] = options
+
+    engine = create_engine(url, connect_args=connect_args, **pool_options())
+    event.listen(engine, 'checkout', counters.on_checkout)
+    event.listen(engine, 'connect', counters.on_connect)
+    return engine
+
+
+async def _text_timestamps(connection):
+    # модели пишут в timestamp (без зоны) время с часовым поясом: psycopg2 передает его как timestamptz,
+    # и сервер переводит его в часовой пояс сессии. asyncpg такие значения не принимает, поэтому для него
+    # timestamp передается строкой, предварительно переведенной в тот же часовой пояс сессии
+    try:
+        server_timezone = ZoneInfo(await connection.fetchval('SHOW TIME ZONE'))
+    except (ZoneInfoNotFoundError, ValueError):
+        server_timezone = timezone.utc
+
+    def encode(value: datetime) -> str:
+        if value.tzinfo is not None:
+            value = value.astimezone(server_timezone).replace(tzinfo=None)
+        return value.isoformat()
+
+    await connection.set_type_codec(
+        'timestamp', schema='pg_catalog', encoder=encode, decoder=datetime.fromisoformat, format='text',
+    )
+
+
+def build_async_engine(url: str) -> AsyncEngine:
+    """
+    Создание асинхронного движка (asyncpg) с теми же настройками пула и соединений
+    :param url: адрес БД (postgresql+asyncpg://...)
+    :return: асинхронный движок
+    """
+    server_settings = {'application_name': settings.DB_APPLICATION_NAME, **server_options()}
+
+    engine = create_async_engine(
+        url,
+        connect_args={'server_settings': server_settings, 'timeout': settings.DB_CONNECT_TIMEOUT},
+        **pool_options(is_async=True),
+    )
+    event.listen(engine.sync_engine, 'checkout', counters.on_checkout)
+    event.listen(engine.sync_engine, 'connect', counters.on_connect)
+    event.listen(
+        engine.sync_engine, 'connect',
+        lambda dbapi_connection, connection_record: dbapi_connection.run_async(_text_timestamps),
+    )
+    return engine
+
+
+def _database_url(driver: str, host: str | None = None) -> str:
+    host = host or f'{settings.DB_HOST}:{settings.DB_PORT}'
+    return f'postgresql+{driver}://{settings.DB_USER}:{settings.DB_PASSWORD}@{host}/{settings.DB_NAME}'
+
+
+def get_engine() -> Engine:
+    """
+    Движок основной БД, создается при первом обращении (а не при импорте моделей)
+    """
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = build_engine(_database_url('psycopg2'))
+    return _engine
+
+
+def get_replicas() -> Optional[ReplicaSet]:
+    """
+    Реплики для чтения из settings.DB_REPLICA_HOSTS (None, если реплик нет)
+    """
+    global _replicas
+    if _replicas is None and settings.DB_REPLICA_HOSTS:
+        with _engine_lock:
+            if _replicas is None:
+                _replicas = ReplicaSet(
+                    build_engine(_database_url('psycopg2', host)) for host in settings.DB_REPLICA_HOSTS
+                )
+    return _replicas
+
+
+def get_async_engine() -> AsyncEngine:
+    """
+    Асинхронный движок основной БД, создается при первом обращении
+    """
+    global _async_engine
+    if _async_engine is None:
+        with _engine_lock:
+            if _async_engine is None:
+                _async_engine = build_async_engine(_database_url('asyncpg'))
+    return _async_engine
+
+
+def dispose_engine():
+    """
+    Закрытие соединений пула (следующее обращение к БД создаст движок заново)
+    """
+    global _engine, _replicas
+    with _engine_lock:
+        if _engine is not None:
+            _engine.dispose()
+        if _replicas is not None:
+            _replicas.dispose()
+        _engine = _replicas = None
+    counters.reset()
+
+
+async def dispose_async_engine():
+    """
+    Закрытие соединений пула асинхронного движка
+    """
+    global _async_engine
+    engine, _async_engine = _async_engine, None
+    if engine is not None:
+        await engine.dispose()
+
+
+def pool_stats(is_async: bool = False) -> PoolStats:
+    """
+    Состояние пула соединений основной БД и счетчики (общие для обоих движков)
+    :param is_async: состояние пула асинхронного движка
+    """
+    pool = get_async_engine().sync_engine.pool if is_async else get_engine().pool
+    gauges = (0, 0, 0, 0)
+    if isinstance(pool, QueuePool):
+        gauges = (pool.size(), pool.checkedin(), pool.checkedout(), max(pool.overflow(), 0))
+    return PoolStats(
+        type(pool).__name__, *gauges,
+        counters.checkouts, counters.connects, counters.timeouts, counters.wait_total, counters.wait_max,
+    )
+
+
+def _after_fork():
+    # дочерний процесс не должен использовать соединения родителя, но и закрывать их тоже (close=False)
+    if _engine is not None:
+        _engine.dispose(close=False)
+    if _replicas is not None:
+        _replicas.dispose(close=False)
+    if _async_engine is not None:
+        _async_engine.sync_engine.dispose(close=False)
+    counters.reset()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def __getattr__(name):
+    # совместимость с кодом, импортирующим session.engine
+    if name == 'engine':
+        return get_engine()
+    raise AttributeError(name)
 
 
 def get_session():
-    return session_factory()
+    return session_factory(bind=get_engine(), replicas=get_replicas())
+
+
+def get_async_session():
+    return async_session_factory(bind=get_async_engine())
@@ -13,3 +13,72 @@ SECRET_KEY = environ.get('SECRET_KEY', 'my_very_secret_key')
 ACCESS_TOKEN_LIVE_TIME = timedelta(minutes=60)
 REFRESH_TOKEN_LIVE_TIME = timedelta(days=7)
 MEDIA_DIR = f'{pathlib.Path().resolve()}/media'
+# вести журнал занятых ночей комнат (room_night) и проверять доступность по нему
+ROOM_NIGHT_LEDGER = environ.get('ROOM_NIGHT_LEDGER', 'False') == 'True'
+# кол-во попыток подобрать комнату, если ее параллельно занял другой запрос
+PURCHASE_SAVE_ATTEMPTS = int(environ.get('PURCHASE_SAVE_ATTEMPTS', 3))
+# максимум шагов перебора при совместном подборе комнат для нескольких покупок
+PURCHASE_ALLOCATION_STEPS = int(environ.get('PURCHASE_ALLOCATION_STEPS', 10000))
+# кол-во месяцев календарей категорий в кэше (0 - кэш отключен) и время жизни записи в секундах.
+# кэш свой в каждом процессе, брони других процессов видны в нем только через TTL, поэтому по умолчанию он выключен
+CALENDAR_CACHE_SIZE = int(environ.get('CALENDAR_CACHE_SIZE', 0))
+CALENDAR_CACHE_TTL = int(environ.get('CALENDAR_CACHE_TTL', 300))
+# кол-во графиков скидок категорий в кэше и время жизни графика в секундах.
+# кэш свой в каждом процессе: изменение скидок в другом процессе становится видно только через TTL
+# (до этого цены считаются со старыми скидками), поэтому он короткий
+SALES_TIMELINE_SIZE = int(environ.get('SALES_TIMELINE_SIZE', 1024))
+SALES_TIMELINE_TTL = int(environ.get('SALES_TIMELINE_TTL', 5))
+# кол-во покупок/заказов, обрабатываемых задачей завершения заказов в одной транзакции
+FINISH_ORDERS_CHUNK_SIZE = int(environ.get('FINISH_ORDERS_CHUNK_SIZE', 500))
+# время, через которое неоформленная корзина считается брошенной
+CART_LIFETIME = timedelta(hours=int(environ.get('CART_LIFETIME_HOURS', 24)))
+# кол-во корзин, удаляемых за одну транзакцию, и максимум транзакций за один запуск чистки
+CART_REAPER_BATCH_SIZE = int(environ.get('CART_REAPER_BATCH_SIZE', 200))
+CART_REAPER_MAX_BATCHES = int(environ.get('CART_REAPER_MAX_BATCHES', 50))
+# подключение к БД
+DB_HOST = environ.get('DB_HOST', 'db')
+DB_PORT = int(environ.get('DB_PORT', 5432))
+DB_NAME = environ.get('DB_NAME', 'db_name')
+DB_USER = environ.get('DB_USER', 'db_user')
+DB_PASSWORD = environ.get('DB_PASSWORD', 'db_password')
+# пул соединений: queue - собственный пул, null - без пула (соединения держит pgbouncer)
+DB_POOL = environ.get('DB_POOL', 'queue')
+DB_POOL_SIZE = int(environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(environ.get('DB_MAX_OVERFLOW', 10))
+# время ожидания свободного соединения и время жизни соединения в секундах (-1 - без ограничения)
+DB_POOL_TIMEOUT = float(environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(environ.get('DB_POOL_RECYCLE', 1800))
+# проверять соединение перед выдачей из пула
+DB_POOL_PRE_PING = environ.get('DB_POOL_PRE_PING', 'False') == 'True'
+# ограничение времени выполнения запроса в миллисекундах (0 - без ограничения)
+DB_STATEMENT_TIMEOUT = int(environ.get('DB_STATEMENT_TIMEOUT', 0))
+DB_APPLICATION_NAME = environ.get('DB_APPLICATION_NAME', 'hotel_business')
+# оповещать об изменениях занятости комнат через NOTIFY (для снимка занятости OccupancyMatrix).
+# NOTIFY при фиксации берет общую блокировку очереди оповещений, поэтому по умолчанию выключено
+OCCUPANCY_NOTIFY = environ.get('OCCUPANCY_NOTIFY', 'False') == 'True'
+# время ожидания подключения к БД в секундах
+DB_CONNECT_TIMEOUT = int(environ.get('DB_CONNECT_TIMEOUT', 10))
+# реплики для чтения через запятую (host:port), пусто - все запросы идут в основную БД
+DB_REPLICA_HOSTS = [host for host in environ.get('DB_REPLICA_HOSTS', '').split(',') if host]
+# допустимое по умолчанию отставание реплики в секундах и интервал проверки состояния реплик в секундах
+DB_REPLICA_MAX_LAG = float(environ.get('DB_REPLICA_MAX_LAG', 1))
+DB_REPLICA_CHECK_INTERVAL = float(environ.get('DB_REPLICA_CHECK_INTERVAL', 5))
+# учет SQL запросов по методам шлюзов и кол-во повторов одного запроса за вызов, после которого он считается N+1
+SQL_STATS_ENABLED = environ.get('SQL_STATS_ENABLED', 'False') == 'True'
+SQL_STATS_REPEAT_THRESHOLD = int(environ.get('SQL_STATS_REPEAT_THRESHOLD', 5))
+# замеры времени выполнения методов шлюзов
+GATEWAY_METRICS_ENABLED = environ.get('GATEWAY_METRICS_ENABLED', 'True') == 'True'
+# доля профилируемых вызовов шлюзов при запуске (0 - выключено), профилировщик (cprofile, pyinstrument)
+# и кол-во хранимых отчетов
+GATEWAY_PROFILE_RATE = float(environ.get('GATEWAY_PROFILE_RATE', 0))
+GATEWAY_PROFILE_BACKEND = environ.get('GATEWAY_PROFILE_BACKEND', 'cprofile')
+GATEWAY_PROFILE_KEEP = int(environ.get('GATEWAY_PROFILE_KEEP', 20))
+# кол-во пользователей в кэше прав (0 - кэш отключен) и время жизни записи в секундах.
+# кэш свой в каждом процессе: отзыв прав в другом процессе становится виден только через TTL, поэтому он короткий
+PERMISSION_CACHE_SIZE = int(environ.get('PERMISSION_CACHE_SIZE', 10000))
+PERMISSION_CACHE_TTL = int(environ.get('PERMISSION_CACHE_TTL', 5))
+# стоимость хэширования паролей bcrypt (log2 кол-ва раундов), хэши с другой стоимостью пересчитываются при входе
+BCRYPT_ROUNDS = int(environ.get('BCRYPT_ROUNDS', 12))
+# пул асинхронного хэширования паролей: thread или process, и его размер (0 - по кол-ву процессоров)
+PASSWORD_HASH_POOL = environ.get('PASSWORD_HASH_POOL', 'thread')
+PASSWORD_HASH_WORKERS = int(environ.get('PASSWORD_HASH_WORKERS', 0))
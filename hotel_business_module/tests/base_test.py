@@ -1,6 +1,9 @@
 from hotel_business_module.models.base import Base
 from hotel_business_module.tests.session import engine
 from hotel_business_module.tests.session import get_session
+from hotel_business_module.utils.calendar_cache import calendar_cache
+from hotel_business_module.utils.permission_cache import permission_cache
+from hotel_business_module.utils.sales_timeline import sales_timeline
 import unittest
 from unittest.mock import patch
 
@@ -13,13 +16,13 @@ class BaseTest(unittest.TestCase):
     def setUp(self):
         # создаем БД
         Base.metadata.create_all(engine)
+        # id категорий в новой БД повторяются, поэтому календари прошлых тестов не должны попадать в кэш
+        calendar_cache.clear()
+        sales_timeline.clear()
+        permission_cache.clear()
         # Патчим получение сессий в модулях, чтою они использовали тестовое БД
         self.patchers = [
-            patch('hotel_business_module.models.rooms.get_session', side_effect=get_session),
             patch('hotel_business_module.models.orders.get_session', side_effect=get_session),
-            patch('hotel_business_module.models.users.get_session', side_effect=get_session),
-            patch('hotel_business_module.models.photos.get_session', side_effect=get_session),
-            patch('hotel_business_module.gateways.photos_gateway.get_session', side_effect=get_session)
         ]
         for item in self.patchers:
             item.start()
@@ -0,0 +1,138 @@
+import asyncio
+from datetime import date, datetime, timedelta
+from unittest import IsolatedAsyncioTestCase, skipIf
+from unittest.mock import patch
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from hotel_business_module.tests.base_test import BaseTest
+from hotel_business_module.gateways.clients_gateway import ClientsGateway
+from hotel_business_module.gateways.async_gateways import (
+    AsyncCategoriesGateway, AsyncRoomsGateway, AsyncClientsGateway, AsyncOrdersGateway, AsyncPurchasesGateway,
+    AsyncUsersGateway, AsyncWorkersGateway,
+)
+from hotel_business_module.models.categories import Category
+from hotel_business_module.models.orders import Order, Purchase
+from hotel_business_module.models.rooms import Room
+from hotel_business_module.models.tokens import TokenType
+from hotel_business_module.models.users import Client
+from hotel_business_module.settings import settings
+from hotel_business_module.utils.gateway_metrics import gateway_metrics
+from hotel_business_module.tests.session import get_async_engine, get_session
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+
+@skipIf(asyncpg is None, 'asyncpg не установлен')
+class TestAsyncGateways(BaseTest, IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.engine = get_async_engine()
+        self.get_session = async_sessionmaker(self.engine, autoflush=False, expire_on_commit=False)
+
+    async def asyncTearDown(self):
+        await self.engine.dispose()
+
+    async def test_concurrent_booking(self):
+        """
+        Тестирование параллельного бронирования через асинхронные шлюзы
+        """
+        async with self.get_session() as session:
+            category = Category(
+                name='test_category', description='lorem ipsum...', price=1000, prepayment_percent=20,
+                refund_percent=50, main_photo_path='C:\\images\\image1.jpg', rooms_count=2, floors=1, beds=2, square=50,
+            )
+            await AsyncCategoriesGateway.save_category(category, session)
+            for _ in range(2):
+                await AsyncRoomsGateway.save_room(Room(category_id=category.id), session)
+            client = Client(email='test@gmail.com', is_confirmed=True)
+            await AsyncClientsGateway.save_client(client, session)
+            order = Order(client=client)
+            await AsyncOrdersGateway.save_order(order, session)
+            start = date.today() + timedelta(days=10)
+            self.assertEqual(await AsyncCategoriesGateway.get_free_rooms(category, start, start, session), {start: 2})
+
+        async def book():
+            # каждая бронь в своей сессии (как отдельный запрос)
+            async with self.get_session() as db:
+                purchase = Purchase(order_id=order.id, start=start, end=start + timedelta(days=2))
+                await AsyncPurchasesGateway.save_purchase(purchase, db, category)
+                return purchase.room_id
+
+        results = await asyncio.gather(book(), book(), book(), return_exceptions=True)
+        rooms = [result for result in results if not isinstance(result, Exception)]
+        # две комнаты на три брони: одна бронь не проходит, комнаты не повторяются
+        self.assertEqual(len(set(rooms)), 2)
+        self.assertEqual([str(result) for result in results if isinstance(result, Exception)], [
+            'На эти даты нет свободных комнат этой категории',
+        ])
+
+        async with self.get_session() as session:
+            self.assertTrue(await AsyncCategoriesGateway.is_day_busy(category, start + timedelta(days=1), session))
+            order = await AsyncOrdersGateway.get_by_id(order.id, session)
+            self.assertEqual(order.price, 2 * 2 * category.price)
+
+    async def test_timestamps_between_drivers(self):
+        """
+        Тестирование того, что время с часовым поясом одинаково сохраняется через psycopg2 и asyncpg
+        """
+        date_created = settings.TIMEZONE.localize(datetime(2026, 1, 1, 12, 0))
+        with get_session() as session:
+            sync_client = Client(email='sync@gmail.com', date_created=date_created)
+            ClientsGateway.save_client(sync_client, session)
+        async with self.get_session() as session:
+            async_client = Client(email='async@gmail.com', date_created=date_created)
+            await AsyncClientsGateway.save_client(async_client, session)
+        async with self.get_session() as session:
+            # записанное через psycopg2 и через asyncpg одинаково читается через asyncpg
+            async_read = [
+                (await AsyncClientsGateway.get_by_id(client.id, session)).date_created
+                for client in (sync_client, async_client)
+            ]
+        with get_session() as session:
+            sync_read = [
+                ClientsGateway.get_by_id(client.id, session).date_created for client in (sync_client, async_client)
+            ]
+        self.assertEqual(len(set(async_read + sync_read)), 1)
+        # сервер хранит время в своем часовом поясе, без сдвига
+        self.assertEqual(sync_read[0].replace(tzinfo=None), sync_read[0])
+
+    async def test_auth(self):
+        """
+        Тестирование регистрации, входа и сброса пароля с хэшированием в пуле
+        """
+        email = 'test@gmail.com'
+        gateway_metrics.reset()
+        async with self.get_session() as session:
+            with patch.object(settings, 'BCRYPT_ROUNDS', 4):
+                client, token = await AsyncUsersGateway.register_user(Client(email=email, password='passwd123'), session)
+                token = await AsyncUsersGateway.check_token(token, TokenType.register, session)
+                await AsyncUsersGateway.confirm_account(token, session)
+                # одновременные входы (каждый в своей сессии) хэшируют пароли параллельно в пуле
+                async def login():
+                    async with self.get_session() as db:
+                        return await AsyncUsersGateway.authenticate_user(email, 'passwd123', db)
+
+                users = await asyncio.gather(login(), login(), login())
+                self.assertEqual({user.id for user in users}, {client.id})
+                with self.assertRaises(ValueError):
+                    await AsyncUsersGateway.authenticate_user(email, 'wrong_passwrd', session)
+
+            with patch.object(settings, 'BCRYPT_ROUNDS', 5):
+                # хэш с устаревшей стоимостью пересчитывается при входе
+                user = await AsyncUsersGateway.authenticate_user(email, 'passwd123', session)
+                self.assertTrue(user.password.startswith('$2b$05$'))
+
+                _, token = await AsyncUsersGateway.request_reset(email, session)
+                token = await AsyncUsersGateway.check_token(token, TokenType.reset, session)
+                await AsyncUsersGateway.confirm_reset(token, 'new_password', session)
+                self.assertEqual(await AsyncUsersGateway.authenticate_user(email, 'new_password', session), client)
+
+                await AsyncWorkersGateway.create_superuser('admin@gmail.com', 'admin_password', session)
+                admin = await AsyncUsersGateway.authenticate_user('admin@gmail.com', 'admin_password', session)
+                admin = await AsyncWorkersGateway.get_by_id(admin.id, session)
+                self.assertTrue(admin.is_superuser)
+
+        if gateway_metrics.enabled:
+            # асинхронные методы замеряются вместе с ошибками
+            self.assertEqual(gateway_metrics.snapshot()['AsyncUsersGateway.authenticate_user'].errors, {'ValueError': 1})
@@ -1,8 +1,10 @@
+from unittest.mock import patch
 from hotel_business_module.tests.base_test import BaseTest
 from hotel_business_module.gateways.clients_gateway import ClientsGateway
 from hotel_business_module.gateways.users_gateway import UsersGateway
 from hotel_business_module.models.tokens import TokenType
 from hotel_business_module.models.users import Client
+from hotel_business_module.settings import settings
 from hotel_business_module.tests.session import get_session
 
 
@@ -71,3 +73,32 @@ class TestTags(BaseTest):
             self.assertEqual(client, UsersGateway.authenticate_user(email, new_password, session))
             # пробуем войти по старому паролю
             self.assertRaises(ValueError, UsersGateway.authenticate_user, email, password, session)
+
+    def test_rehash(self):
+        """
+        Тестирование пересчета хэша пароля с устаревшей стоимостью при входе
+        """
+        with get_session() as session:
+            email = 'test@gmail.ru'
+            password = 'passwd123'
+            with patch.object(settings, 'BCRYPT_ROUNDS', 4):
+                client, token = UsersGateway.register_user(Client(email=email, password=password), session)
+                UsersGateway.confirm_account(UsersGateway.check_token(token, TokenType.register, session), session)
+                self.assertTrue(client.password.startswith('$2b$04$'))
+                UsersGateway.authenticate_user(email, password, session)
+                self.assertTrue(client.password.startswith('$2b$04$'))
+
+            with patch.object(settings, 'BCRYPT_ROUNDS', 5):
+                # неверный пароль хэш не меняет
+                self.assertRaises(ValueError, UsersGateway.authenticate_user, email, 'wrong_passwrd', session)
+                self.assertTrue(client.password.startswith('$2b$04$'))
+                UsersGateway.authenticate_user(email, password, session)
+                session.refresh(client)
+                self.assertTrue(client.password.startswith('$2b$05$'))
+                self.assertEqual(client, UsersGateway.authenticate_user(email, password, session))
+
+            with patch.object(settings, 'BCRYPT_ROUNDS', 4):
+                # хэш с большей стоимостью, чем в настройках, остается прежним
+                UsersGateway.authenticate_user(email, password, session)
+                session.refresh(client)
+                self.assertTrue(client.password.startswith('$2b$05$'))
@@ -1,5 +1,6 @@
 from unittest.mock import Mock, patch
 from datetime import datetime, timedelta
+from sqlalchemy import event
 from hotel_business_module.tests.base_test import BaseTest
 from hotel_business_module.gateways.categories_gateway import CategoriesGateway
 from hotel_business_module.gateways.tags_gateway import TagsGateway
@@ -7,7 +8,7 @@ from hotel_business_module.gateways.rooms_gateway import RoomsGateway
 from hotel_business_module.models.categories import Category
 from hotel_business_module.models.tags import Tag
 from hotel_business_module.models.rooms import Room
-from hotel_business_module.tests.session import get_session
+from hotel_business_module.tests.session import get_session, engine
 
 
 class TestCategories(BaseTest):
@@ -154,3 +155,41 @@ class TestCategories(BaseTest):
             )
             # проверяем, чтоб вернувшийся id был равен созданной комнате
             self.assertEqual(picked_room, room.id)
+
+    def test_rooms_checks(self):
+        """
+        Тестирование проверок комнат при сохранении (один раз на flush, в сессии вызывающего кода)
+        """
+        with get_session() as session:
+            category = self.spawn_category()
+            category.main_photo_path = 'C:\\images\\image1.jpg'
+            session.add(category)
+            session.commit()
+
+            queries = []
+            listener = lambda *args: queries.append(args)
+            event.listen(engine, 'before_cursor_execute', listener)
+            session.add_all([Room(category_id=category.id, room_number=number) for number in range(1, 501)])
+            session.commit()
+            event.remove(engine, 'before_cursor_execute', listener)
+            # проверка категорий, проверка номеров и вставка комнат
+            self.assertLessEqual(len(queries), 5)
+
+            # номер уже занят
+            session.add(Room(category_id=category.id, room_number=1))
+            self.assertRaises(ValueError, session.flush)
+            session.rollback()
+            # одинаковые номера в одном flush
+            session.add_all([Room(category_id=category.id, room_number=501), Room(category_id=category.id, room_number=501)])
+            self.assertRaises(ValueError, session.flush)
+            session.rollback()
+            # несуществующая категория
+            session.add(Room(category_id=category.id + 1, room_number=501))
+            self.assertRaises(ValueError, session.flush)
+            session.rollback()
+
+            # комнаты можно поменять номерами в одном flush
+            first, second = session.query(Room).filter(Room.room_number.in_([1, 2])).order_by(Room.room_number)
+            first.room_number, second.room_number = 2, 1
+            session.commit()
+            self.assertEqual((first.room_number, second.room_number), (2, 1))
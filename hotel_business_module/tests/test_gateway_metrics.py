@@ -0,0 +1,134 @@
+import asyncio
+import inspect
+import json
+import unittest
+from datetime import date, timedelta
+from hotel_business_module.tests.base_test import BaseTest
+from hotel_business_module.gateways.categories_gateway import CategoriesGateway
+from hotel_business_module.gateways.tags_gateway import TagsGateway
+from hotel_business_module.models.categories import Category
+from hotel_business_module.models.tags import Tag
+from hotel_business_module.tests.session import get_session
+from hotel_business_module.gateways.async_gateways import AsyncUsersGateway
+from hotel_business_module.utils.gateway_metrics import (
+    LatencyHistogram, gateway_metrics, instrumented, profiler, pyinstrument,
+)
+
+
+class TestLatencyHistogram(unittest.TestCase):
+    def test_percentiles(self):
+        """
+        Тестирование точности процентилей гистограммы на широком диапазоне значений
+        """
+        histogram = LatencyHistogram()
+        for value in range(1, 100_001):
+            histogram.record(value / 1_000_000)
+        self.assertEqual(histogram.count, 100_000)
+        self.assertEqual(histogram.max, 100_000)
+        for percent in (50, 90, 99, 99.9):
+            expected = percent / 100 * 0.1
+            self.assertAlmostEqual(histogram.percentile(percent), expected, delta=expected / 64)
+        self.assertEqual(histogram.percentile(100), 0.1)
+        self.assertEqual(histogram.percentile(0), 0.000001)
+        self.assertEqual(LatencyHistogram().percentile(50), 0.0)
+
+
+class TestGatewayMetrics(BaseTest):
+    def setUp(self):
+        super().setUp()
+        gateway_metrics.reset()
+        profiler.profiles.clear()
+        self.addCleanup(gateway_metrics.reset)
+        self.addCleanup(profiler.stop)
+
+    def test_latency_and_errors(self):
+        """
+        Тестирование замеров вызовов методов шлюзов, в том числе вложенных и завершившихся ошибкой
+        """
+        with get_session() as session:
+            for i in range(3):
+                TagsGateway.save_tag(Tag(name=f'tag_{i}'), session)
+            self.assertEqual(len(TagsGateway.get_all(session)), 3)
+            with self.assertRaises(ValueError):
+                CategoriesGateway.filter(session, {'show_hidden': True, 'desc': False, 'page_size': 0, 'page': 1,
+                                                   'sort_by': 'id'})
+            category = Category(
+                name='category', description='lorem ipsum...', price=999, prepayment_percent=10, refund_percent=50,
+                rooms_count=2, floors=1, beds=2, square=50, main_photo_path='image.jpg',
+            )
+            session.add(category)
+            session.commit()
+            CategoriesGateway.get_busy_dates(category, date.today(), date.today() + timedelta(days=3), session)
+
+        snapshot = gateway_metrics.snapshot()
+        self.assertEqual(snapshot['TagsGateway.save_tag'].count, 3)
+        self.assertEqual(snapshot['TagsGateway.get_all'].count, 1)
+        self.assertLessEqual(snapshot['TagsGateway.save_tag'].p50, snapshot['TagsGateway.save_tag'].max)
+        self.assertEqual(snapshot['CategoriesGateway.filter'].errors, {'ValueError': 1})
+        # вложенный вызов замеряется отдельно
+        self.assertEqual(snapshot['CategoriesGateway.get_free_rooms'].count, 1)
+
+        metrics = gateway_metrics.to_prometheus()
+        self.assertIn('hotel_gateway_latency_seconds_count{method="TagsGateway.save_tag"} 3', metrics)
+        self.assertIn('hotel_gateway_errors_total{method="CategoriesGateway.filter",error="ValueError"} 1', metrics)
+        self.assertEqual(json.loads(gateway_metrics.to_json())['TagsGateway.get_all']['count'], 1)
+
+    def test_async_methods(self):
+        """
+        Тестирование замеров асинхронных методов: время до завершения корутины и ее ошибки
+        """
+        @instrumented
+        class SlowGateway:
+            @staticmethod
+            async def wait(seconds: float):
+                await asyncio.sleep(seconds)
+
+            @staticmethod
+            async def fail():
+                await asyncio.sleep(0)
+                raise ValueError('ошибка')
+
+        async def run():
+            await SlowGateway.wait(0.05)
+            with self.assertRaises(ValueError):
+                await SlowGateway.fail()
+
+        asyncio.run(run())
+        snapshot = gateway_metrics.snapshot()
+        self.assertGreaterEqual(snapshot['SlowGateway.wait'].min, 0.05)
+        self.assertEqual(snapshot['SlowGateway.fail'].errors, {'ValueError': 1})
+        # методы асинхронных шлюзов после оборачивания остаются корутинами
+        self.assertTrue(inspect.iscoroutinefunction(AsyncUsersGateway.authenticate_user))
+
+    def test_profiling(self):
+        """
+        Тестирование профилирования выборочных вызовов
+        """
+        self.assertRaises(ValueError, profiler.start, 0)
+        self.assertRaises(ValueError, profiler.start, 1, 'unknown')
+        with get_session() as session:
+            TagsGateway.get_all(session)
+            self.assertEqual(len(profiler.profiles), 0)
+
+            profiler.start(1.0)
+            category = Category(
+                name='category', description='lorem ipsum...', price=999, prepayment_percent=10, refund_percent=50,
+                rooms_count=2, floors=1, beds=2, square=50, main_photo_path='image.jpg',
+            )
+            session.add(category)
+            session.commit()
+            CategoriesGateway.get_busy_dates(category, date.today(), date.today() + timedelta(days=3), session)
+            # профилируется только внешний вызов
+            self.assertEqual([profile.method for profile in profiler.profiles], ['CategoriesGateway.get_busy_dates'])
+            self.assertIn('get_free_rooms', profiler.profiles[0].report)
+
+            profiler.stop()
+            TagsGateway.get_all(session)
+            self.assertEqual(len(profiler.profiles), 1)
+
+    @unittest.skipIf(pyinstrument is None, 'pyinstrument не установлен')
+    def test_pyinstrument(self):
+        profiler.start(1.0, 'pyinstrument')
+        with get_session() as session:
+            TagsGateway.get_all(session)
+        self.assertEqual(profiler.profiles[-1].method, 'TagsGateway.get_all')
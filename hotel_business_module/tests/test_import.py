@@ -0,0 +1,136 @@
+import io
+from datetime import date
+from hotel_business_module.tests.base_test import BaseTest
+from hotel_business_module.gateways.import_gateway import ImportGateway, RejectedRow
+from hotel_business_module.models.categories import Category
+from hotel_business_module.models.orders import Order, Purchase
+from hotel_business_module.models.payments import Payment
+from hotel_business_module.models.rooms import Room
+from hotel_business_module.models.users import Client
+from hotel_business_module.tests.session import get_session
+
+
+class TestImport(BaseTest):
+    def spawn_category(self, session) -> Category:
+        category = Category(
+            name='test_category', description='lorem ipsum...', price=1000, prepayment_percent=10,
+            refund_percent=50, main_photo_path='C:\\images\\image1.jpg', rooms_count=2, floors=1, beds=2, square=50,
+        )
+        session.add(category)
+        session.commit()
+        return category
+
+    def test_import_categories(self):
+        """
+        Тестирование импорта категорий из jsonl
+        """
+        with get_session() as session:
+            source = io.StringIO(
+                '{"name": "lux", "description": "", "price": 5000, "prepayment_percent": 20, "refund_percent": 50,'
+                ' "main_photo_path": "lux.jpg", "rooms_count": 2, "floors": 1, "beds": 2, "square": 60}\n'
+                '{"name": "free", "description": "", "price": 0, "prepayment_percent": 20, "refund_percent": 50,'
+                ' "main_photo_path": "free.jpg", "rooms_count": 2, "floors": 1, "beds": 2, "square": 60}\n'
+                '{"name": "no_photo", "price": 100}\n'
+            )
+            report = ImportGateway.import_categories(source, session, ImportGateway.JSONL)
+            self.assertEqual(report.imported, 1)
+            self.assertEqual(report.rejected, [
+                RejectedRow(2, 'Цена должна быть больше 0'),
+                RejectedRow(3, 'Не заполнены обязательные поля'),
+            ])
+            self.assertEqual([category.name for category in session.query(Category)], ['lux'])
+
+    def test_import_rooms(self):
+        """
+        Тестирование импорта комнат: ссылки на категории и уникальность номеров
+        """
+        with get_session() as session:
+            category = self.spawn_category(session)
+            session.add(Room(category_id=category.id, room_number=1))
+            session.commit()
+
+            source = io.StringIO(
+                'room_number,category_id\n'
+                f'2,{category.id}\n'
+                f'1,{category.id}\n'
+                f'3,{category.id + 1}\n'
+                f'2,{category.id}\n'
+                f'0,{category.id}\n'
+                f'4,{category.id}\n'
+            )
+            report = ImportGateway.import_rooms(source, session)
+            self.assertEqual(report.imported, 2)
+            self.assertEqual(report.rejected, [
+                RejectedRow(2, 'Уже существует комната с этим номером'),
+                RejectedRow(3, 'Не найдена категория с таким id'),
+                RejectedRow(4, 'Номер комнаты повторяется в файле'),
+                RejectedRow(5, 'Номер комнаты не может быть меньше 1'),
+            ])
+            self.assertEqual(sorted(room.room_number for room in session.query(Room)), [1, 2, 4])
+
+            # неизвестные колонки не загружаются
+            self.assertRaises(ValueError, ImportGateway.import_rooms, io.StringIO('number\n1\n'), session)
+
+    def test_import_clients(self):
+        """
+        Тестирование импорта клиентов: уникальность адресов эл. почты
+        """
+        with get_session() as session:
+            session.add(Client(email='old@gmail.com'))
+            session.commit()
+
+            source = io.StringIO(
+                'email,first_name,date_of_birth\n'
+                'new@gmail.com,Ivan,1990-05-01\n'
+                'old@gmail.com,Petr,\n'
+                'new@gmail.com,Ivan,\n'
+                'wrong_email,,\n'
+            )
+            report = ImportGateway.import_clients(source, session)
+            self.assertEqual(report.imported, 1)
+            self.assertEqual([row.line for row in report.rejected], [2, 3, 4])
+            client = session.query(Client).filter_by(email='new@gmail.com').one()
+            self.assertEqual((client.first_name, client.date_of_birth), ('Ivan', date(1990, 5, 1)))
+
+    def test_import_purchases(self):
+        """
+        Тестирование импорта покупок: заказы, пересечение дат и итоги заказов
+        """
+        with get_session() as session:
+            category = self.spawn_category(session)
+            client = Client(email='client@gmail.com')
+            session.add_all([client, Room(category_id=category.id, room_number=1), Room(category_id=category.id, room_number=2)])
+            session.commit()
+
+            source = io.StringIO(
+                'order_ref,client_email,room_number,start,end,price,is_paid\n'
+                'A,client@gmail.com,1,2023-05-01,2023-05-03,,true\n'
+                'A,client@gmail.com,2,2023-05-01,2023-05-02,1500,true\n'
+                'B,client@gmail.com,1,2023-05-02,2023-05-04,,false\n'
+                'B,client@gmail.com,1,2023-05-04,2023-05-03,,false\n'
+                'C,nobody@gmail.com,2,2023-06-01,2023-06-02,,false\n'
+                'D,client@gmail.com,3,2023-06-01,2023-06-02,,false\n'
+            )
+            report = ImportGateway.import_purchases(source, session)
+            self.assertEqual(report.imported, 2)
+            self.assertEqual(report.rejected, [
+                RejectedRow(3, 'Комната в файле уже занята на эти даты более ранней строкой'),
+                RejectedRow(4, 'Начало должно быть раньше конца'),
+                RejectedRow(5, 'Не найден клиент с таким адресом эл. почты'),
+                RejectedRow(6, 'Не найдена комната с таким номером'),
+            ])
+            order = session.query(Order).one()
+            # 2 ночи по цене категории и 1500 из файла
+            self.assertEqual(order.price, 3500)
+            self.assertEqual(order.paid, 3500)
+            self.assertIsNotNone(order.date_full_paid)
+            self.assertEqual(session.query(Payment).one().amount, 3500)
+            self.assertEqual(session.query(Purchase).count(), 2)
+
+            # повторный импорт упирается в существующие брони
+            source = io.StringIO(
+                'order_ref,client_email,room_number,start,end\n'
+                'E,client@gmail.com,1,2023-05-02,2023-05-03\n'
+            )
+            report = ImportGateway.import_purchases(source, session)
+            self.assertEqual(report.rejected, [RejectedRow(1, 'Комната уже занята на эти даты')])
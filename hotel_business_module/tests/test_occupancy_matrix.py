@@ -0,0 +1,176 @@
+from typing import Tuple
+from unittest import skipIf
+from unittest.mock import patch, Mock
+from sqlalchemy import event
+from datetime import datetime, timedelta
+from hotel_business_module.tests.base_test import BaseTest
+from hotel_business_module.gateways.categories_gateway import CategoriesGateway
+from hotel_business_module.gateways.clients_gateway import ClientsGateway
+from hotel_business_module.gateways.orders_gateway import OrdersGateway
+from hotel_business_module.gateways.purchase_gateway import PurchasesGateway
+from hotel_business_module.gateways.rooms_gateway import RoomsGateway
+from hotel_business_module.models.categories import Category
+from hotel_business_module.models.orders import Order, Purchase
+from hotel_business_module.models.rooms import Room
+from hotel_business_module.models.users import Client
+from hotel_business_module.tests.session import get_session, engine
+from hotel_business_module.utils import occupancy_matrix
+from hotel_business_module.utils.purchase_events import NOTIFY_SETTING
+from hotel_business_module.utils.occupancy_matrix import OccupancyMatrix
+
+
+@skipIf(occupancy_matrix.np is None, 'numpy не установлен')
+class TestOccupancyMatrix(BaseTest):
+    """
+    Тестирование снимка занятости комнат
+    """
+
+    @patch('hotel_business_module.utils.file_manager.FileManager.save_file')
+    def spawn_preparation_data(self, session, mock_save_file: Mock) -> Tuple[Category, Room, Room, Order]:
+        """
+        Метод для создания подготовительных данных
+        """
+        mock_save_file.return_value = 'C:\\images\\image1.jpg'
+        file = Mock()
+        category = Category(
+            name='test_category',
+            description='lorem ipsum...',
+            price=1000,
+            prepayment_percent=20,
+            refund_percent=50,
+            rooms_count=2,
+            floors=1,
+            beds=2,
+            square=50
+        )
+        CategoriesGateway.save_category(category, session, file=file, file_name=file.name)
+
+        first_room = Room(category=category)
+        RoomsGateway.save_room(first_room, session)
+        second_room = Room(category=category)
+        RoomsGateway.save_room(second_room, session)
+
+        client = Client(email='test@gmail.com', is_confirmed=True)
+        ClientsGateway.save_client(client, session)
+        order = Order(client=client)
+        OrdersGateway.save_order(order, session)
+
+        return category, first_room, second_room, order
+
+    def create_matrix(self, session, start, days) -> OccupancyMatrix:
+        matrix = OccupancyMatrix.create(session, start, days)
+        self.addCleanup(matrix.unlink)
+        self.addCleanup(matrix.close)
+        return matrix
+
+    def test_matches_gateway(self):
+        """
+        Тестирование совпадения ответов снимка с ответами запросов к БД
+        """
+        with get_session() as session:
+            category, first_room, second_room, order = self.spawn_preparation_data(session)
+            today = datetime.now().date()
+            PurchasesGateway.save_purchase(
+                Purchase(order=order, start=today + timedelta(days=1), end=today + timedelta(days=4)),
+                db=session, category=category,
+            )
+            PurchasesGateway.save_purchase(
+                Purchase(order=order, start=today + timedelta(days=2), end=today + timedelta(days=3)),
+                db=session, category=category,
+            )
+
+            matrix = self.create_matrix(session, today - timedelta(days=1), 10)
+            date_start, date_end = today - timedelta(days=1), today + timedelta(days=4)
+            self.assertEqual(
+                matrix.get_free_rooms(category.id, date_start, date_end),
+                CategoriesGateway.get_free_rooms(category, date_start, date_end, session),
+            )
+            self.assertEqual(
+                matrix.get_busy_dates(category.id, date_start, date_end),
+                CategoriesGateway.get_busy_dates(category, date_start, date_end, session),
+            )
+            self.assertTrue(matrix.is_day_busy(category.id, today + timedelta(days=2)))
+            self.assertFalse(matrix.is_day_busy(category.id, today + timedelta(days=3)))
+            self.assertEqual(
+                matrix.pick_room(category.id, today + timedelta(days=4), today + timedelta(days=6)),
+                CategoriesGateway.pick_room(category, today + timedelta(days=4), today + timedelta(days=6), session),
+            )
+            self.assertIsNone(matrix.pick_room(category.id, today + timedelta(days=2), today + timedelta(days=3)))
+
+            categories, free = matrix.free_rooms_by_category(today, today + timedelta(days=3))
+            self.assertEqual(list(categories), [category.id])
+            self.assertEqual(list(free[0]), [2, 1, 0, 1])
+
+            # запросы за пределами снимка не допускаются
+            with self.assertRaises(ValueError):
+                matrix.pick_room(category.id, today, today + timedelta(days=20))
+
+    def enable_notify(self):
+        """
+        Включение оповещений триггеров purchase для соединений тестовой БД
+        """
+        def set_notify(dbapi_connection, connection_record, connection_proxy):
+            with dbapi_connection.cursor() as cursor:
+                cursor.execute(f'SET {NOTIFY_SETTING} = on')
+            # как и параметр сервера из session.server_options, действует вне транзакций
+            dbapi_connection.commit()
+
+        event.listen(engine, 'checkout', set_notify)
+        # соединения пула с включенным параметром не переиспользуются другими тестами
+        self.addCleanup(engine.dispose)
+        self.addCleanup(event.remove, engine, 'checkout', set_notify)
+
+    def test_notify(self):
+        """
+        Тестирование применения изменений покупок из оповещений
+        """
+        self.enable_notify()
+        with get_session() as session:
+            category, first_room, second_room, order = self.spawn_preparation_data(session)
+            today = datetime.now().date()
+            matrix = self.create_matrix(session, today - timedelta(days=1), 10)
+            # подключенный по имени снимок видит те же данные
+            attached = OccupancyMatrix.attach(matrix.name)
+            self.addCleanup(attached.close)
+            version = attached.version
+
+            purchase = Purchase(order=order, start=today + timedelta(days=1), end=today + timedelta(days=3))
+            PurchasesGateway.save_purchase(purchase=purchase, db=session, category=category)
+            self.assertEqual(matrix.poll(1), 1)
+            self.assertGreater(attached.version, version)
+            self.assertEqual(
+                list(attached.get_free_rooms(category.id, today, today + timedelta(days=3)).values()),
+                [2, 1, 1, 2],
+            )
+            # прошедшие даты заняты
+            categories, free = attached.free_rooms_by_category(today - timedelta(days=1), today + timedelta(days=1))
+            self.assertEqual(list(free[0]), [0, 2, 1])
+
+            # перенос дат освобождает старые ночи и занимает новые
+            purchase.start = today + timedelta(days=5)
+            purchase.end = today + timedelta(days=6)
+            PurchasesGateway.save_purchase(purchase, session)
+            self.assertEqual(matrix.poll(1), 2)
+            self.assertEqual(
+                list(attached.get_free_rooms(category.id, today, today + timedelta(days=5)).values()),
+                [2, 2, 2, 2, 2, 1],
+            )
+
+            PurchasesGateway.mark_as_canceled(purchase, session)
+            self.assertEqual(matrix.poll(1), 1)
+            self.assertFalse(matrix.cells.any())
+
+            # перезагрузка не учитывает повторно изменения, уже попавшие в загруженные данные
+            PurchasesGateway.save_purchase(
+                Purchase(order=order, start=today + timedelta(days=2), end=today + timedelta(days=4)),
+                db=session, category=category,
+            )
+            matrix.refresh(session)
+            self.assertEqual(matrix.poll(1), 0)
+            self.assertEqual(int(matrix.cells.sum()), 2)
+
+            # подключенные воркеры снимок только читают
+            with self.assertRaises(ValueError):
+                attached.refresh(session)
+            with self.assertRaises(ValueError):
+                attached.poll()
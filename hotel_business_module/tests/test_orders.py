@@ -1,3 +1,4 @@
+import time
 from typing import Tuple
 from hotel_business_module.tests.base_test import BaseTest
 from hotel_business_module.gateways.orders_gateway import OrdersGateway
@@ -7,10 +8,17 @@ from hotel_business_module.gateways.categories_gateway import CategoriesGateway
 from hotel_business_module.gateways.rooms_gateway import RoomsGateway
 from hotel_business_module.models.rooms import Room
 from hotel_business_module.models.categories import Category
-from hotel_business_module.models.orders import Order, Purchase
+from hotel_business_module.models.orders import Order, Purchase, Cart
+from hotel_business_module.gateways.carts_gateway import CartsGateway
 from hotel_business_module.models.users import Client
+from hotel_business_module.models.sales import Sale
+from hotel_business_module.models.payments import Payment
+from hotel_business_module.gateways.sales_gateway import SalesGateway
 from hotel_business_module.tests.session import get_session
+from hotel_business_module.utils.calendar_cache import calendar_cache
 from unittest.mock import patch, Mock
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy import text, update
 from datetime import datetime, timedelta
 from _decimal import Decimal
 
@@ -154,3 +162,616 @@ class TestOrders(BaseTest):
             self.assertEqual(third_purchase.room, first_room)
             # четвертая покупка не должна сохранится, т.к. в это время все комнаты заняты
             self.assertRaises(ValueError, PurchasesGateway.save_purchase, fourth_purchase, session, category)
+
+    def test_pick_room_overlap(self):
+        """
+        Тестирование подбора комнаты по пересечению периодов брони
+        """
+        with get_session() as session:
+            # создаем необходимые данные
+            category, first_room, client = self.spawn_preparation_data(session)
+            order = Order(client=client)
+            OrdersGateway.save_order(order, session)
+
+            second_room = Room(category=category)
+            RoomsGateway.save_room(second_room, session)
+
+            purchase = Purchase(order=order, start=datetime(2023, 5, 10), end=datetime(2023, 5, 15))
+            PurchasesGateway.save_purchase(purchase=purchase, db=session, category=category)
+            self.assertEqual(purchase.room, first_room)
+
+            # бронь, которая заканчивается в день заезда, комнату не занимает
+            self.assertEqual(CategoriesGateway.pick_room(
+                category, datetime(2023, 5, 15).date(), datetime(2023, 5, 20).date(), session
+            ), first_room.id)
+            # при пересечении хоть на одну ночь комната занята
+            self.assertEqual(CategoriesGateway.pick_room(
+                category, datetime(2023, 5, 14).date(), datetime(2023, 5, 20).date(), session
+            ), second_room.id)
+            # собственная бронь покупки не учитывается
+            self.assertEqual(CategoriesGateway.pick_room(
+                category, datetime(2023, 5, 12).date(), datetime(2023, 5, 16).date(), session, purchase.id
+            ), first_room.id)
+            # вторая комната освобождается позже первой
+            second_purchase = Purchase(order=order, start=datetime(2023, 5, 12), end=datetime(2023, 5, 16))
+            PurchasesGateway.save_purchase(purchase=second_purchase, db=session, category=category)
+            self.assertEqual(second_purchase.room, second_room)
+            # best_fit выбирает комнату, бронь которой заканчивается ближе всего к заезду
+            self.assertEqual(CategoriesGateway.pick_room(
+                category, datetime(2023, 5, 16).date(), datetime(2023, 5, 18).date(), session
+            ), first_room.id)
+            self.assertEqual(CategoriesGateway.pick_room(
+                category, datetime(2023, 5, 16).date(), datetime(2023, 5, 18).date(), session, strategy='best_fit'
+            ), second_room.id)
+            self.assertRaises(
+                ValueError, CategoriesGateway.pick_room,
+                category, datetime(2023, 5, 16).date(), datetime(2023, 5, 18).date(), session, None, 'unknown'
+            )
+
+    def test_busy_dates(self):
+        """
+        Тестирование календаря свободных комнат категории
+        """
+        with get_session() as session:
+            # создаем необходимые данные
+            category, first_room, client = self.spawn_preparation_data(session)
+            order = Order(client=client)
+            OrdersGateway.save_order(order, session)
+
+            second_room = Room(category=category)
+            RoomsGateway.save_room(second_room, session)
+
+            today = datetime.now().date()
+            first_purchase = Purchase(order=order, start=today + timedelta(days=1), end=today + timedelta(days=4))
+            second_purchase = Purchase(order=order, start=today + timedelta(days=2), end=today + timedelta(days=3))
+            PurchasesGateway.save_purchase(purchase=first_purchase, db=session, category=category)
+            PurchasesGateway.save_purchase(purchase=second_purchase, db=session, category=category)
+
+            # проверяем кол-во свободных комнат по дням
+            free_rooms = CategoriesGateway.get_free_rooms(
+                category, today - timedelta(days=1), today + timedelta(days=4), session
+            )
+            self.assertEqual(list(free_rooms.values()), [0, 2, 1, 0, 1, 2])
+            # прошедшие дни и дни без свободных комнат считаются занятыми
+            self.assertEqual(CategoriesGateway.get_busy_dates(
+                category, today - timedelta(days=1), today + timedelta(days=4), session
+            ), [today - timedelta(days=1), today + timedelta(days=2)])
+            self.assertTrue(CategoriesGateway.is_day_busy(category, today + timedelta(days=2), session))
+            self.assertFalse(CategoriesGateway.is_day_busy(category, today + timedelta(days=3), session))
+
+    def test_busy_dates_cache(self):
+        """
+        Тестирование кэша календарей категорий
+        """
+        if not calendar_cache.enabled:
+            calendar_cache.enable(64)
+            self.addCleanup(calendar_cache.disable)
+        with get_session() as session:
+            # создаем необходимые данные
+            category, room, client = self.spawn_preparation_data(session)
+            order = Order(client=client)
+            OrdersGateway.save_order(order, session)
+
+            today = datetime.now().date()
+            date_end = today + timedelta(days=5)
+            self.assertEqual(CategoriesGateway.get_busy_dates(category, today, date_end, session), [])
+            misses = calendar_cache.stats().misses
+            # повторный запрос берется из кэша
+            self.assertEqual(CategoriesGateway.get_busy_dates(category, today, date_end, session), [])
+            self.assertEqual(calendar_cache.stats().misses, misses)
+            self.assertGreater(calendar_cache.stats().hits, 0)
+
+            # сохранение покупки сбрасывает затронутые месяцы
+            purchase = Purchase(order=order, start=today + timedelta(days=1), end=today + timedelta(days=3))
+            PurchasesGateway.save_purchase(purchase=purchase, db=session, category=category)
+            self.assertEqual(
+                CategoriesGateway.get_busy_dates(category, today, date_end, session),
+                [today + timedelta(days=1), today + timedelta(days=2)],
+            )
+
+            # отмена покупки тоже
+            PurchasesGateway.mark_as_canceled(purchase, session)
+            self.assertEqual(CategoriesGateway.get_busy_dates(category, today, date_end, session), [])
+
+            # как и добавление комнаты
+            PurchasesGateway.save_purchase(
+                Purchase(order=order, start=today + timedelta(days=1), end=today + timedelta(days=2)),
+                db=session, category=category,
+            )
+            self.assertEqual(CategoriesGateway.get_busy_dates(category, today, date_end, session), [today + timedelta(days=1)])
+            RoomsGateway.save_room(Room(category=category), session)
+            self.assertEqual(CategoriesGateway.get_busy_dates(category, today, date_end, session), [])
+
+        # календарь, загрузка которого началась до сброса кэша, не сохраняется
+        key = calendar_cache.month_key(category.id, today)
+        generation = calendar_cache.generation
+        calendar_cache.invalidate([key])
+        calendar_cache.set(key, {today: 0}, generation)
+        self.assertIsNone(calendar_cache.get(key))
+
+    @patch('hotel_business_module.utils.file_manager.FileManager.save_file')
+    def test_filter_free_dates(self, mock_save_file: Mock):
+        """
+        Тестирование фильтрации категорий по свободным датам
+        """
+        mock_save_file.return_value = 'C:\\images\\image1.jpg'
+        file = Mock()
+        with get_session() as session:
+            # создаем необходимые данные
+            category, room, client = self.spawn_preparation_data(session)
+            order = Order(client=client)
+            OrdersGateway.save_order(order, session)
+
+            # создаем вторую категорию со свободной комнатой
+            free_category = Category(
+                name='free_category',
+                description='lorem ipsum...',
+                price=2000,
+                prepayment_percent=20,
+                refund_percent=50,
+                rooms_count=1,
+                floors=1,
+                beds=2,
+                square=50
+            )
+            CategoriesGateway.save_category(free_category, session, file=file, file_name=file.name)
+            RoomsGateway.save_room(Room(category=free_category), session)
+
+            # занимаем единственную комнату первой категории
+            today = datetime.now().date()
+            purchase = Purchase(order=order, start=today + timedelta(days=3), end=today + timedelta(days=5))
+            PurchasesGateway.save_purchase(purchase=purchase, db=session, category=category)
+
+            filter = {
+                'show_hidden': False,
+                'desc': False,
+                'page_size': 8,
+                'page': 1,
+                'sort_by': 'id',
+                'free_dates': {'date_from': today + timedelta(days=1), 'date_until': today + timedelta(days=4)}
+            }
+            # первая категория занята в выбранный период
+            self.assertEqual(CategoriesGateway.filter(session, filter), ([free_category], 1))
+
+            # до брони свободны обе категории
+            filter['free_dates'] = {'date_from': today + timedelta(days=1), 'date_until': today + timedelta(days=2)}
+            self.assertEqual(CategoriesGateway.filter(session, filter), ([category, free_category], 1))
+
+            # прошедшие даты заняты у всех категорий
+            filter['free_dates'] = {'date_from': today - timedelta(days=1), 'date_until': today + timedelta(days=2)}
+            self.assertEqual(CategoriesGateway.filter(session, filter), ([], 0))
+
+    def test_overlap_constraint(self):
+        """
+        Тестирование защиты от пересекающихся броней на уровне БД
+        """
+        with get_session() as session:
+            # создаем необходимые данные
+            category, first_room, client = self.spawn_preparation_data(session)
+            order = Order(client=client)
+            OrdersGateway.save_order(order, session)
+
+            second_room = Room(category=category)
+            RoomsGateway.save_room(second_room, session)
+
+            first_purchase = Purchase(order=order, start=datetime(2023, 5, 10), end=datetime(2023, 5, 15))
+            PurchasesGateway.save_purchase(purchase=first_purchase, db=session, category=category)
+            self.assertEqual(first_purchase.room, first_room)
+
+            # в обход подбора комнат пересекающуюся бронь сохранить нельзя
+            session.add(Purchase(order=order, room=first_room, start=datetime(2023, 5, 14), end=datetime(2023, 5, 16)))
+            self.assertRaises(IntegrityError, session.commit)
+            session.rollback()
+
+            # если подобранную комнату успели занять, то подбирается следующая
+            second_purchase = Purchase(order=order, start=datetime(2023, 5, 12), end=datetime(2023, 5, 14))
+            with patch.object(CategoriesGateway, 'pick_room', side_effect=[first_room.id, second_room.id]):
+                PurchasesGateway.save_purchase(purchase=second_purchase, db=session, category=category)
+            self.assertEqual(second_purchase.room_id, second_room.id)
+            self.assertIsNotNone(PurchasesGateway.get_by_id(second_purchase.id, session))
+
+            # отмененные брони комнату не занимают
+            PurchasesGateway.mark_as_canceled(first_purchase, session)
+            third_purchase = Purchase(order=order, room=first_room, start=datetime(2023, 5, 12), end=datetime(2023, 5, 14))
+            session.add(third_purchase)
+            session.commit()
+
+    def test_allocate_purchases(self):
+        """
+        Тестирование совместного оформления нескольких покупок
+        """
+        with get_session() as session:
+            # создаем необходимые данные
+            category, first_room, client = self.spawn_preparation_data(session)
+            order = Order(client=client)
+            OrdersGateway.save_order(order, session)
+
+            second_room = Room(category=category)
+            RoomsGateway.save_room(second_room, session)
+
+            busy_purchase = Purchase(order=order, start=datetime(2023, 5, 13), end=datetime(2023, 5, 15))
+            PurchasesGateway.save_purchase(purchase=busy_purchase, db=session, category=category)
+            self.assertEqual(busy_purchase.room, first_room)
+
+            # вторая покупка помещается только во вторую комнату, поэтому первой достается первая
+            purchases = PurchasesGateway.allocate_purchases(order, [
+                (category, datetime(2023, 5, 10), datetime(2023, 5, 12)),
+                (category, datetime(2023, 5, 11), datetime(2023, 5, 14)),
+            ], session)
+            self.assertEqual([purchase.room for purchase in purchases], [first_room, second_room])
+            self.assertEqual(purchases[1].price, 3 * category.price)
+            self.assertEqual(order.price, (2 + 2 + 3) * category.price)
+
+            # если хотя бы одну покупку расселить нельзя, то не сохраняется ни одна
+            purchases_count = len(PurchasesGateway.get_all(session))
+            self.assertRaises(ValueError, PurchasesGateway.allocate_purchases, order, [
+                (category, datetime(2023, 5, 20), datetime(2023, 5, 22)),
+                (category, datetime(2023, 5, 10), datetime(2023, 5, 12)),
+            ], session)
+            self.assertEqual(len(PurchasesGateway.get_all(session)), purchases_count)
+            self.assertEqual(len(order.purchases), purchases_count)
+
+    def test_allocate_purchases_interleaved(self):
+        """
+        Тестирование расселения покупок, которое возможно только при чередовании комнат
+        """
+        with get_session() as session:
+            category, first_room, client = self.spawn_preparation_data(session)
+            order = Order(client=client)
+            OrdersGateway.save_order(order, session)
+            second_room = Room(category=category)
+            RoomsGateway.save_room(second_room, session)
+            session.add(Purchase(order=order, room=second_room, start=datetime(2023, 8, 8), end=datetime(2023, 8, 10)))
+            session.commit()
+
+            # последняя покупка помещается только в первую комнату, поэтому вторая уходит во вторую комнату
+            purchases = PurchasesGateway.allocate_purchases(order, [
+                (category, datetime(2023, 8, 2), datetime(2023, 8, 4)),
+                (category, datetime(2023, 8, 3), datetime(2023, 8, 7)),
+                (category, datetime(2023, 8, 5), datetime(2023, 8, 9)),
+            ], session)
+            self.assertEqual([purchase.room for purchase in purchases], [first_room, second_room, first_room])
+
+    def test_allocate_purchases_infeasible(self):
+        """
+        Тестирование быстрого отказа, если расселить все покупки нельзя
+        """
+        with get_session() as session:
+            category, first_room, client = self.spawn_preparation_data(session)
+            order = Order(client=client)
+            OrdersGateway.save_order(order, session)
+            RoomsGateway.save_room(Room(category=category), session)
+            for _ in range(7):
+                RoomsGateway.save_room(Room(category=category), session)
+
+            # на одинаковые даты покупок больше, чем комнат
+            started = time.perf_counter()
+            self.assertRaises(ValueError, PurchasesGateway.allocate_purchases, order, [
+                (category, datetime(2023, 6, 10), datetime(2023, 6, 12)) for _ in range(10)
+            ], session)
+            self.assertLess(time.perf_counter() - started, 1)
+
+            # каждую ночь свободная комната есть, но ни одна не свободна обе ночи подряд
+            rooms = sorted(category.rooms, key=lambda room: room.id)
+            for index, room in enumerate(rooms):
+                night = datetime(2023, 7, 10) + timedelta(days=index % 2)
+                session.add(Purchase(order=order, room=room, start=night, end=night + timedelta(days=1)))
+            session.commit()
+            started = time.perf_counter()
+            self.assertRaises(ValueError, PurchasesGateway.allocate_purchases, order, [
+                (category, datetime(2023, 7, 10), datetime(2023, 7, 12)),
+            ], session)
+            self.assertLess(time.perf_counter() - started, 1)
+
+    def test_find_stays(self):
+        """
+        Тестирование поиска вариантов заезда в пределах периода
+        """
+        with get_session() as session:
+            # создаем необходимые данные
+            category, first_room, client = self.spawn_preparation_data(session)
+            order = Order(client=client)
+            OrdersGateway.save_order(order, session)
+
+            second_room = Room(category=category)
+            RoomsGateway.save_room(second_room, session)
+
+            today = datetime.now().date()
+            # первая комната занята 1-3 днями, вторая 2-6
+            PurchasesGateway.allocate_purchases(order, [
+                (category, today + timedelta(days=1), today + timedelta(days=4)),
+                (category, today + timedelta(days=2), today + timedelta(days=7)),
+            ], session)
+
+            options = CategoriesGateway.find_stays(today, today + timedelta(days=8), 3, session)
+            # заезд возможен, только если одна комната свободна все ночи подряд
+            self.assertEqual(
+                [(option.category, option.start, option.free_rooms) for option in options],
+                [
+                    (category, today + timedelta(days=4), 1),
+                    (category, today + timedelta(days=5), 1),
+                ],
+            )
+            self.assertEqual(len(CategoriesGateway.find_stays(today, today + timedelta(days=8), 3, session, limit=1)), 1)
+            self.assertEqual(CategoriesGateway.find_stays(today, today + timedelta(days=8), 3, session, category_ids=[]), [])
+            self.assertEqual(CategoriesGateway.find_stays(today, today + timedelta(days=2), 3, session), [])
+
+    @patch('hotel_business_module.utils.file_manager.FileManager.delete_file')
+    def test_nightly_discount(self, mock_delete_file: Mock):
+        """
+        Тестирование применения скидок к ночам покупки
+        """
+        with get_session() as session:
+            # создаем необходимые данные
+            category, room, client = self.spawn_preparation_data(session)
+            order = Order(client=client)
+            OrdersGateway.save_order(order, session)
+
+            # скидка действует на 2 из 4 ночей покупки
+            sale = Sale(
+                name='test_sale',
+                description='lorem ipsum...',
+                discount=10,
+                image_path='C:\\images\\image1.jpg',
+                start_date=datetime(2023, 5, 12),
+                end_date=datetime(2023, 5, 13, 12),
+            )
+            SalesGateway.save_sale(sale, session, file=None, file_name=None)
+            CategoriesGateway.add_sale_to_category(category, sale, session)
+
+            purchase = Purchase(order=order, start=datetime(2023, 5, 10), end=datetime(2023, 5, 14))
+            PurchasesGateway.save_purchase(purchase=purchase, db=session, category=category)
+            session.refresh(purchase)
+            self.assertEqual(purchase.price, 2 * category.price + 2 * category.price * Decimal('0.9'))
+
+            # отвязка категории через саму скидку тоже перестраивает график скидок категории
+            sale.categories.remove(category)
+            SalesGateway.save_sale(sale, session, file=None, file_name=None)
+            PurchasesGateway.save_purchase(purchase, session)
+            session.refresh(purchase)
+            self.assertEqual(purchase.price, 4 * category.price)
+            CategoriesGateway.add_sale_to_category(category, sale, session)
+
+            # после удаления скидки цена считается без нее
+            SalesGateway.delete_sale(sale, session)
+            purchase.end = purchase.end + timedelta(days=1)
+            PurchasesGateway.save_purchase(purchase, session)
+            session.refresh(purchase)
+            self.assertEqual(purchase.price, 5 * category.price)
+
+    def test_quote_many(self):
+        """
+        Тестирование расчета цен без создания покупок
+        """
+        with get_session() as session:
+            # создаем необходимые данные
+            category, room, client = self.spawn_preparation_data(session)
+            order = Order(client=client)
+            OrdersGateway.save_order(order, session)
+
+            sale = Sale(
+                name='test_sale',
+                description='lorem ipsum...',
+                discount=15,
+                image_path='C:\\images\\image1.jpg',
+                start_date=datetime(2023, 5, 12),
+                end_date=datetime(2023, 5, 20),
+            )
+            SalesGateway.save_sale(sale, session, file=None, file_name=None)
+            CategoriesGateway.add_sale_to_category(category, sale, session)
+
+            stays = [
+                (category.id, datetime(2023, 5, 10), datetime(2023, 5, 14)),
+                (category.id, datetime(2023, 5, 1), datetime(2023, 5, 3)),
+                (category.id, datetime(2023, 5, 18), datetime(2023, 5, 23)),
+            ]
+            quotes = PurchasesGateway.quote_many(stays, session)
+            # цены совпадают с ценами сохраненных покупок
+            for (category_id, start, end), quote in zip(stays, quotes):
+                purchase = Purchase(order=order, start=start, end=end)
+                PurchasesGateway.save_purchase(purchase=purchase, db=session, category=category)
+                self.assertEqual(quote, (purchase.price, purchase.prepayment, purchase.refund))
+
+            self.assertRaises(ValueError, PurchasesGateway.quote_many, [(category.id + 1, datetime(2023, 5, 1), datetime(2023, 5, 3))], session)
+
+    def test_order_totals(self):
+        """
+        Тестирование хранимых итогов заказа
+        """
+        with get_session() as session:
+            # создаем необходимые данные
+            category, room, client = self.spawn_preparation_data(session)
+            order = Order(client=client)
+            OrdersGateway.save_order(order, session)
+
+            first_purchase = Purchase(order=order, start=datetime(2023, 5, 10), end=datetime(2023, 5, 12))
+            second_purchase = Purchase(order=order, start=datetime(2023, 5, 12), end=datetime(2023, 5, 15))
+            PurchasesGateway.save_purchase(purchase=first_purchase, db=session, category=category)
+            PurchasesGateway.save_purchase(purchase=second_purchase, db=session, category=category)
+            self.assertEqual(order.price, 5 * category.price)
+            self.assertEqual(order.prepayment, round(first_purchase.prepayment + second_purchase.prepayment, 2))
+
+            # неоплаченная покупка при отмене удаляется
+            PurchasesGateway.mark_as_canceled(first_purchase, session)
+            self.assertEqual(order.price, 3 * category.price)
+
+            # оплаченная покупка при отмене остается с ценой за вычетом возврата
+            OrdersGateway.mark_as_paid(order, session)
+            PurchasesGateway.mark_as_canceled(second_purchase, session)
+            self.assertEqual(order.price, round(second_purchase.price - second_purchase.refund, 2))
+
+            # расхождение итогов исправляется сверкой
+            session.execute(text('UPDATE base_order SET price_total = 0'))
+            session.commit()
+            self.assertEqual(OrdersGateway.reconcile_totals(session), 1)
+            self.assertEqual(order.price, round(second_purchase.price - second_purchase.refund, 2))
+            self.assertEqual(OrdersGateway.reconcile_totals(session), 0)
+
+            # один оператор, меняющий покупки нескольких заказов, переносит итоги между ними
+            third_purchase = Purchase(order=order, start=datetime(2023, 5, 20), end=datetime(2023, 5, 22))
+            PurchasesGateway.save_purchase(purchase=third_purchase, db=session, category=category)
+            other_order = Order(client=client)
+            OrdersGateway.save_order(other_order, session)
+            price = order.price
+            session.execute(update(Purchase).where(Purchase.order_id == order.id).values(order_id=other_order.id))
+            session.commit()
+            OrdersGateway.expire_totals(order, session)
+            OrdersGateway.expire_totals(other_order, session)
+            self.assertEqual((order.price, other_order.price), (0, price))
+            self.assertEqual(OrdersGateway.reconcile_totals(session), 0)
+
+    def test_finish_orders(self):
+        """
+        Тестирование завершения закончившихся заказов частями
+        """
+        with get_session() as session:
+            # создаем необходимые данные
+            category, room, client = self.spawn_preparation_data(session)
+            paid_order = Order(client=client)
+            OrdersGateway.save_order(paid_order, session)
+            unpaid_order = Order(client=client)
+            OrdersGateway.save_order(unpaid_order, session)
+            future_order = Order(client=client)
+            OrdersGateway.save_order(future_order, session)
+
+            today = datetime.now().date()
+            paid_purchase = Purchase(order=paid_order, start=datetime(2023, 5, 1), end=datetime(2023, 5, 3))
+            PurchasesGateway.save_purchase(purchase=paid_purchase, db=session, category=category)
+            OrdersGateway.mark_as_paid(paid_order, session)
+            prepaid_purchase = Purchase(order=unpaid_order, start=datetime(2023, 5, 5), end=datetime(2023, 5, 7))
+            unpaid_purchase = Purchase(order=unpaid_order, start=datetime(2023, 5, 7), end=datetime(2023, 5, 9))
+            PurchasesGateway.save_purchase(purchase=prepaid_purchase, db=session, category=category)
+            PurchasesGateway.save_purchase(purchase=unpaid_purchase, db=session, category=category)
+            prepaid_purchase.is_prepayment_paid = True
+            session.commit()
+            PurchasesGateway.save_purchase(
+                Purchase(order=future_order, start=today + timedelta(days=1), end=today + timedelta(days=3)),
+                db=session, category=category,
+            )
+            OrdersGateway.mark_as_paid(future_order, session)
+
+            stats = OrdersGateway.finish_orders(session, chunk_size=1)
+            self.assertEqual(stats[:4], (1, 1, 2, 0))
+            session.expire_all()
+            self.assertTrue(prepaid_purchase.is_canceled)
+            self.assertIsNone(PurchasesGateway.get_by_id(unpaid_purchase.id, session))
+            self.assertIsNotNone(paid_order.date_finished)
+            self.assertIsNotNone(unpaid_order.date_finished)
+            self.assertIsNone(future_order.date_finished)
+
+            # следующий запуск начинает с отметки и не трогает ранее закончившиеся покупки
+            late_order = Order(client=client)
+            OrdersGateway.save_order(late_order, session)
+            PurchasesGateway.save_purchase(
+                Purchase(order=late_order, start=datetime(2023, 6, 1), end=datetime(2023, 6, 3)),
+                db=session, category=category,
+            )
+            self.assertEqual(OrdersGateway.finish_orders(session)[:4], (0, 0, 0, 0))
+            # а полный запуск обрабатывает все
+            self.assertEqual(OrdersGateway.finish_orders(session, full=True)[:4], (0, 1, 0, 0))
+
+    def test_payments(self):
+        """
+        Тестирование журнала оплат
+        """
+        with get_session() as session:
+            # создаем необходимые данные
+            category, room, client = self.spawn_preparation_data(session)
+            order = Order(client=client)
+            OrdersGateway.save_order(order, session)
+            purchase = Purchase(order=order, start=datetime(2023, 5, 10), end=datetime(2023, 5, 12))
+            PurchasesGateway.save_purchase(purchase=purchase, db=session, category=category)
+
+            # оплата предоплаты
+            OrdersGateway.record_payment(order, order.prepayment, session)
+            self.assertEqual(order.paid, order.prepayment)
+            self.assertTrue(purchase.is_prepayment_paid)
+            self.assertFalse(purchase.is_paid)
+            self.assertIsNotNone(order.date_full_prepayment)
+
+            # оплата из другой сессии не теряется
+            with get_session() as other_session:
+                other_order = OrdersGateway.get_by_id(order.id, other_session)
+                OrdersGateway.record_payment(other_order, other_order.left_to_pay, other_session)
+            OrdersGateway.record_payment(order, 100, session)
+            self.assertEqual(order.paid, order.price + 100)
+            self.assertTrue(purchase.is_paid)
+            self.assertIsNotNone(order.date_full_paid)
+
+            OrdersGateway.record_refund(order, 100, session)
+            self.assertEqual(order.refunded, 100)
+            self.assertRaises(ValueError, OrdersGateway.record_refund, order, order.paid, session)
+            self.assertRaises(ValueError, OrdersGateway.record_payment, order, 0, session)
+            self.assertEqual(
+                [(payment.kind, payment.amount) for payment in session.query(Payment).order_by(Payment.id)],
+                [
+                    (Payment.PAYMENT, order.prepayment),
+                    (Payment.PAYMENT, order.price - order.prepayment),
+                    (Payment.PAYMENT, 100),
+                    (Payment.REFUND, 100),
+                ],
+            )
+
+    def test_confirm_cart(self):
+        """
+        Тестирование оформления заказа из корзины
+        """
+        with get_session() as session:
+            # создаем необходимые данные
+            category, room, client = self.spawn_preparation_data(session)
+            OrdersGateway.save_order(Order(client=client), session)
+            cart = Cart()
+            CartsGateway.save_cart(cart, session)
+            purchase = Purchase(order=cart, start=datetime(2023, 5, 10), end=datetime(2023, 5, 12))
+            PurchasesGateway.save_purchase(purchase=purchase, db=session, category=category)
+            prepayment = round(purchase.prepayment, 2)
+
+            # для нового адреса создается клиент, оплачивается предоплата
+            order = CartsGateway.confirm_cart(cart, 'new_client@gmail.com', session)
+            self.assertEqual(order.client.email, 'new_client@gmail.com')
+            self.assertEqual(purchase.order_id, order.id)
+            self.assertEqual(order.price, 2 * category.price)
+            self.assertEqual(order.paid, prepayment)
+            self.assertTrue(purchase.is_prepayment_paid)
+            self.assertIsNone(CartsGateway.get_by_uuid(cart.cart_uuid, session))
+
+            # для существующего клиента заказ оформляется на него
+            cart = Cart()
+            CartsGateway.save_cart(cart, session)
+            PurchasesGateway.save_purchase(
+                Purchase(order=cart, start=datetime(2023, 5, 12), end=datetime(2023, 5, 15)),
+                db=session, category=category,
+            )
+            order = CartsGateway.confirm_cart(cart, client.email, session, is_fully_paid=True)
+            self.assertEqual(order.client, client)
+            self.assertEqual(order.paid, 3 * category.price)
+            self.assertIsNotNone(order.date_full_paid)
+
+    def test_clean_carts(self):
+        """
+        Тестирование удаления брошенных корзин
+        """
+        with get_session() as session:
+            # создаем необходимые данные
+            category, room, client = self.spawn_preparation_data(session)
+            OrdersGateway.save_order(Order(client=client), session)
+            carts = [Cart(), Cart(), Cart()]
+            for cart in carts:
+                CartsGateway.save_cart(cart, session)
+            PurchasesGateway.save_purchase(
+                Purchase(order=carts[0], start=datetime(2023, 5, 10), end=datetime(2023, 5, 12)),
+                db=session, category=category,
+            )
+            # первые две корзины брошены
+            for cart in carts[:2]:
+                cart.date_created = datetime.now() - timedelta(days=2)
+            session.commit()
+
+            stats = CartsGateway.clean_carts(session, batch_size=1)
+            self.assertEqual(stats, (2, 1, 2))
+            self.assertEqual(
+                [CartsGateway.get_by_uuid(cart.cart_uuid, session) is None for cart in carts],
+                [True, True, False],
+            )
+            # комната снова свободна
+            self.assertEqual(CategoriesGateway.pick_room(category, datetime(2023, 5, 10), datetime(2023, 5, 12), session), room.id)
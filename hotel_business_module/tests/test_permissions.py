@@ -7,6 +7,8 @@ from hotel_business_module.models.users import Worker
 from hotel_business_module.models.permissions import Permission
 from hotel_business_module.models.groups import Group
 from hotel_business_module.tests.session import get_session
+from hotel_business_module.utils.permission_cache import permission_cache
+from hotel_business_module.utils.sql_stats import sql_stats
 
 
 class TestPermissions(BaseTest):
@@ -65,3 +67,53 @@ class TestPermissions(BaseTest):
                 codes=[first_permission.code, second_permission.code, ],
                 db=session
             ))
+
+    def test_permission_cache(self):
+        """
+        Тестирование кэша прав: проверка без запросов к БД и сброс при изменении групп и прав
+        """
+        with get_session() as session:
+            first_permission = Permission(name='first_permission', code='first_permission')
+            second_permission = Permission(name='second_permission', code='second_permission')
+            PermissionsGateway.save_permission(first_permission, session)
+            PermissionsGateway.save_permission(second_permission, session)
+            group = Group(name='test_group')
+            GroupsGateway.save_group(group, session)
+            GroupsGateway.add_permission_to_group(group, first_permission, session)
+            worker = Worker(email='test@mail.com', salary=50000)
+            WorkersGateway.save_worker(worker, session)
+            WorkersGateway.add_group_to_worker(worker, group, session)
+
+            self.assertTrue(UsersGateway.can_actions(worker, ['first_permission'], session))
+            # повторные проверки берут права из кэша
+            with sql_stats.capture() as capture:
+                self.assertTrue(UsersGateway.can_actions(worker, ['first_permission'], session))
+                self.assertFalse(UsersGateway.can_actions(worker, ['first_permission', 'second_permission'], session))
+                # несуществующее право тоже не выдается
+                self.assertFalse(UsersGateway.can_actions(worker, ['unknown_permission'], session))
+            self.assertEqual(capture.statements, 0)
+            self.assertEqual(self.codes(UsersGateway.get_user_permissions(worker, session)), ['first_permission'])
+
+            # изменения прав группы сразу видны
+            GroupsGateway.add_permission_to_group(group, second_permission, session)
+            self.assertTrue(UsersGateway.can_actions(worker, ['first_permission', 'second_permission'], session))
+            GroupsGateway.remove_permission_from_group(group, first_permission, session)
+            self.assertFalse(UsersGateway.can_actions(worker, ['first_permission'], session))
+            GroupsGateway.remove_permission_from_group(group, second_permission, session)
+            self.assertFalse(UsersGateway.can_actions(worker, ['second_permission'], session))
+            version = permission_cache.version
+            PermissionsGateway.delete_permission(second_permission, session)
+            self.assertGreater(permission_cache.version, version)
+
+            # как и изменения групп сотрудника
+            GroupsGateway.add_permission_to_group(group, first_permission, session)
+            WorkersGateway.remove_group_from_worker(worker, group, session)
+            self.assertEqual(UsersGateway.get_user_permissions(worker, session), [])
+            WorkersGateway.add_group_to_worker(worker, group, session)
+            self.assertTrue(UsersGateway.can_actions(worker, ['first_permission'], session))
+            GroupsGateway.delete_group(group, session)
+            self.assertFalse(UsersGateway.can_actions(worker, ['first_permission'], session))
+
+    @staticmethod
+    def codes(permissions) -> list:
+        return sorted(permission.code for permission in permissions)
@@ -0,0 +1,125 @@
+from typing import Tuple
+from unittest.mock import patch, Mock
+from datetime import datetime
+from hotel_business_module.tests.base_test import BaseTest
+from hotel_business_module.gateways.categories_gateway import CategoriesGateway
+from hotel_business_module.gateways.clients_gateway import ClientsGateway
+from hotel_business_module.gateways.orders_gateway import OrdersGateway
+from hotel_business_module.gateways.purchase_gateway import PurchasesGateway
+from hotel_business_module.gateways.room_nights_gateway import RoomNightsGateway
+from hotel_business_module.gateways.rooms_gateway import RoomsGateway
+from hotel_business_module.models.categories import Category
+from hotel_business_module.models.orders import Order, Purchase
+from hotel_business_module.models.room_nights import RoomNight
+from hotel_business_module.models.rooms import Room
+from hotel_business_module.models.users import Client
+from hotel_business_module.settings import settings
+from hotel_business_module.tests.session import get_session
+
+
+class TestRoomNights(BaseTest):
+    """
+    Тестирование журнала занятых ночей комнат
+    """
+
+    def setUp(self):
+        super().setUp()
+        # включаем ведение журнала
+        ledger_patcher = patch.object(settings, 'ROOM_NIGHT_LEDGER', True)
+        ledger_patcher.start()
+        self.addCleanup(ledger_patcher.stop)
+
+    @patch('hotel_business_module.utils.file_manager.FileManager.save_file')
+    def spawn_preparation_data(self, session, mock_save_file: Mock) -> Tuple[Category, Room, Room, Order]:
+        """
+        Метод для создания подготовительных данных
+        """
+        mock_save_file.return_value = 'C:\\images\\image1.jpg'
+        file = Mock()
+        category = Category(
+            name='test_category',
+            description='lorem ipsum...',
+            price=1000,
+            prepayment_percent=20,
+            refund_percent=50,
+            rooms_count=2,
+            floors=1,
+            beds=2,
+            square=50
+        )
+        CategoriesGateway.save_category(category, session, file=file, file_name=file.name)
+
+        first_room = Room(category=category)
+        RoomsGateway.save_room(first_room, session)
+        second_room = Room(category=category)
+        RoomsGateway.save_room(second_room, session)
+
+        client = Client(email='test@gmail.com', is_confirmed=True)
+        ClientsGateway.save_client(client, session)
+        order = Order(client=client)
+        OrdersGateway.save_order(order, session)
+
+        return category, first_room, second_room, order
+
+    def test_occupy(self):
+        """
+        Тестирование записи ночей покупок в журнал
+        """
+        with get_session() as session:
+            category, first_room, second_room, order = self.spawn_preparation_data(session)
+
+            purchase = Purchase(order=order, start=datetime(2023, 5, 10), end=datetime(2023, 5, 15))
+            PurchasesGateway.save_purchase(purchase=purchase, db=session, category=category)
+            # на каждую ночь покупки одна строка журнала
+            self.assertEqual(session.query(RoomNight).filter_by(purchase_id=purchase.id).count(), 5)
+
+            # при изменении дат ночи перезаписываются
+            purchase.end = datetime(2023, 5, 12)
+            PurchasesGateway.save_purchase(purchase, session)
+            self.assertEqual(session.query(RoomNight).filter_by(purchase_id=purchase.id).count(), 2)
+
+            # подбор комнат и календарь работают по журналу
+            self.assertEqual(CategoriesGateway.pick_room(
+                category, datetime(2023, 5, 11).date(), datetime(2023, 5, 13).date(), session
+            ), second_room.id)
+            self.assertEqual(CategoriesGateway.pick_room(
+                category, datetime(2023, 5, 12).date(), datetime(2023, 5, 13).date(), session
+            ), first_room.id)
+            self.assertEqual(RoomNightsGateway.verify(session), (0, 0))
+
+    def test_release(self):
+        """
+        Тестирование освобождения ночей при отмене заказа
+        """
+        with get_session() as session:
+            category, first_room, second_room, order = self.spawn_preparation_data(session)
+
+            first_purchase = Purchase(order=order, start=datetime(2023, 5, 10), end=datetime(2023, 5, 15))
+            second_purchase = Purchase(order=order, start=datetime(2023, 5, 10), end=datetime(2023, 5, 12))
+            PurchasesGateway.save_purchase(purchase=first_purchase, db=session, category=category)
+            PurchasesGateway.save_purchase(purchase=second_purchase, db=session, category=category)
+
+            # оплаченная покупка при отмене заказа отменяется, неоплаченная удаляется
+            first_purchase.is_paid = True
+            session.commit()
+            OrdersGateway.mark_as_canceled(order, session)
+            self.assertEqual(session.query(RoomNight).count(), 0)
+            self.assertEqual(RoomNightsGateway.verify(session), (0, 0))
+
+    def test_rebuild(self):
+        """
+        Тестирование перестроения журнала
+        """
+        with get_session() as session:
+            category, first_room, second_room, order = self.spawn_preparation_data(session)
+
+            purchase = Purchase(order=order, start=datetime(2023, 5, 10), end=datetime(2023, 5, 15))
+            PurchasesGateway.save_purchase(purchase=purchase, db=session, category=category)
+
+            # портим журнал
+            session.query(RoomNight).filter(RoomNight.night == datetime(2023, 5, 10).date()).delete()
+            session.commit()
+            self.assertEqual(RoomNightsGateway.verify(session), (1, 0))
+
+            self.assertEqual(RoomNightsGateway.rebuild(session), 5)
+            self.assertEqual(RoomNightsGateway.verify(session), (0, 0))
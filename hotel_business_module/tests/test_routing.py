@@ -0,0 +1,119 @@
+from datetime import datetime
+from unittest.mock import patch
+from sqlalchemy import create_engine, select, text
+from sqlalchemy.exc import OperationalError
+from hotel_business_module.tests.base_test import BaseTest
+from hotel_business_module.gateways.categories_gateway import CategoriesGateway
+from hotel_business_module.gateways.sales_gateway import SalesGateway
+from hotel_business_module.gateways.tags_gateway import TagsGateway
+from hotel_business_module.models.base import Base
+from hotel_business_module.models.categories import Category
+from hotel_business_module.models.sales import Sale
+from hotel_business_module.models.tags import Tag
+from hotel_business_module.session.routing import ReplicaHealth, ReplicaSet, RoutingSession
+from hotel_business_module.tests.session import engine, replica_engine
+
+
+class TestReplicaRouting(BaseTest):
+    def setUp(self):
+        try:
+            with replica_engine.connect():
+                pass
+        except OperationalError:
+            self.skipTest('Вторая тестовая БД (реплика) недоступна')
+        super().setUp()
+        Base.metadata.create_all(replica_engine)
+        self.addCleanup(Base.metadata.drop_all, replica_engine)
+        # в основной БД и на "реплике" разные категории, по ним видно, откуда прочитаны данные
+        for bind, name in ((engine, 'primary'), (replica_engine, 'replica')):
+            with RoutingSession(bind=bind) as session:
+                session.add(self.spawn_category(name))
+                session.commit()
+        self.replicas = ReplicaSet([replica_engine], check_interval=60)
+
+    def spawn_category(self, name: str) -> Category:
+        return Category(
+            name=name,
+            description='lorem ipsum...',
+            price=999,
+            prepayment_percent=10,
+            refund_percent=50,
+            rooms_count=2,
+            floors=1,
+            beds=2,
+            square=50,
+            main_photo_path='image.jpg',
+        )
+
+    def session(self) -> RoutingSession:
+        return RoutingSession(bind=engine, replicas=self.replicas, autoflush=False, expire_on_commit=False)
+
+    @staticmethod
+    def names(categories) -> list:
+        return [category.name for category in categories]
+
+    def test_read_routing(self):
+        """
+        Тестирование чтения на реплике и закрепления сессии за основной БД после записи
+        """
+        with self.session() as session:
+            # помеченные методы читают с реплики, остальные - из основной БД
+            self.assertEqual(self.names(CategoriesGateway.get_all(session)), ['replica'])
+            self.assertEqual(self.names(CategoriesGateway.filter(session)[0]), ['replica'])
+            self.assertEqual(session.scalar(text('SELECT name FROM category')), 'primary')
+            # блокирующее чтение всегда в основной БД
+            with session.replica_reads():
+                self.assertEqual(session.scalar(select(Category.name).with_for_update()), 'primary')
+            self.assertFalse(session.pinned)
+
+            # после записи сессия читает свои изменения из основной БД
+            TagsGateway.save_tag(Tag(name='test_tag'), session)
+            self.assertTrue(session.pinned)
+            self.assertEqual(self.names(CategoriesGateway.get_all(session)), ['primary'])
+
+        # новая сессия снова читает с реплики
+        with self.session() as session:
+            self.assertEqual(self.names(CategoriesGateway.get_all(session)), ['replica'])
+
+    def test_sales_filter(self):
+        """
+        Тестирование загрузки страницы скидок с реплики
+        """
+        for bind, name in ((engine, 'primary'), (replica_engine, 'replica')):
+            with RoutingSession(bind=bind) as session:
+                session.add(Sale(
+                    name=name, description='lorem ipsum...', discount=10, image_path='image.jpg',
+                    start_date=datetime(2026, 1, 1), end_date=datetime(2026, 2, 1),
+                ))
+                session.commit()
+        with self.session() as session:
+            sales, pages = SalesGateway.filter({'desc': False, 'sort_by': 'id', 'page_size': 8, 'page': 1}, session)
+            self.assertEqual((self.names(sales), pages), (['replica'], 1))
+
+    def test_replica_health(self):
+        """
+        Тестирование выбора реплики по кругу, проверки доступности и допустимого отставания
+        """
+        replicas = ReplicaSet([replica_engine, replica_engine.execution_options()], check_interval=60)
+        # реплики выбираются по очереди
+        self.assertEqual({id(replicas.choose(1)), id(replicas.choose(1))}, {id(engine) for engine in replicas.engines})
+
+        # недоступная реплика пропускается, а без реплик чтение идет в основную БД
+        unreachable = create_engine(replica_engine.url.set(port=1), connect_args={'connect_timeout': 1})
+        self.assertFalse(ReplicaSet.check(unreachable).healthy)
+        replicas.mark_down(replicas.engines[0])
+        self.assertIs(replicas.choose(1), replicas.engines[1])
+        replicas.mark_down(replicas.engines[1])
+        self.assertIsNone(replicas.choose(1))
+        self.replicas = replicas
+        with self.session() as session:
+            self.assertEqual(self.names(CategoriesGateway.get_all(session)), ['primary'])
+
+        # отстающая реплика используется, только если вызывающий код допускает такое отставание
+        with patch.object(ReplicaSet, 'check', return_value=ReplicaHealth(True, 5.0, 0.0)):
+            self.replicas = ReplicaSet([replica_engine], check_interval=0)
+            with self.session() as session:
+                self.assertEqual(self.names(CategoriesGateway.get_all(session)), ['primary'])
+                with session.replica_lag(10):
+                    self.assertEqual(self.names(CategoriesGateway.get_all(session)), ['replica'])
+                self.assertEqual(self.names(CategoriesGateway.get_all(session)), ['primary'])
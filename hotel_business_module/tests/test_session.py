@@ -0,0 +1,56 @@
+import unittest
+from unittest.mock import patch
+from sqlalchemy import text
+from sqlalchemy.pool import NullPool
+from hotel_business_module.session import session
+from hotel_business_module.settings import settings
+from hotel_business_module.tests.session import db_name, db_user, db_password, db_port
+
+
+class TestSession(unittest.TestCase):
+    def setUp(self):
+        # основная БД в тестах - тестовая
+        self.patcher = patch.multiple(
+            settings, DB_HOST='localhost', DB_PORT=db_port, DB_NAME=db_name, DB_USER=db_user, DB_PASSWORD=db_password,
+        )
+        self.patcher.start()
+        session.dispose_engine()
+        self.addCleanup(self.patcher.stop)
+        self.addCleanup(session.dispose_engine)
+
+    def test_lazy_engine(self):
+        """
+        Тестирование создания движка при первом обращении и настроек соединений
+        """
+        with patch.multiple(settings, DB_STATEMENT_TIMEOUT=1500, DB_APPLICATION_NAME='test_app', DB_POOL_SIZE=2):
+            self.assertIsNone(session._engine)
+            with session.get_session() as db:
+                self.assertEqual(db.execute(text('SHOW statement_timeout')).scalar(), '1500ms')
+                self.assertEqual(db.execute(text('SHOW application_name')).scalar(), 'test_app')
+            # движок создается один раз
+            self.assertIs(session.get_engine(), session.engine)
+
+            stats = session.pool_stats()
+            self.assertEqual(stats.pool, 'MeasuredQueuePool')
+            self.assertEqual(stats.size, 2)
+            self.assertEqual((stats.checked_in, stats.checked_out), (1, 0))
+            self.assertEqual((stats.checkouts, stats.connects), (1, 1))
+
+            # после форка пул пустой и счетчики сброшены
+            session._after_fork()
+            stats = session.pool_stats()
+            self.assertEqual((stats.checked_in, stats.checkouts), (0, 0))
+
+    def test_null_pool(self):
+        """
+        Тестирование работы без пула (через pgbouncer)
+        """
+        with patch.object(settings, 'DB_POOL', 'null'):
+            self.assertIsInstance(session.get_engine().pool, NullPool)
+            with session.get_session() as db:
+                self.assertEqual(db.execute(text('SELECT 1')).scalar(), 1)
+            self.assertEqual(session.pool_stats().checkouts, 1)
+
+        with patch.object(settings, 'DB_POOL', 'unknown'):
+            session.dispose_engine()
+            self.assertRaises(ValueError, session.get_engine)
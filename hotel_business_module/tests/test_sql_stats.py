@@ -0,0 +1,102 @@
+import json
+from datetime import date, timedelta
+from sqlalchemy import select
+from hotel_business_module.tests.base_test import BaseTest
+from hotel_business_module.gateways.categories_gateway import CategoriesGateway
+from hotel_business_module.models.categories import Category
+from hotel_business_module.tests.session import get_session
+from hotel_business_module.utils.sql_stats import OUTSIDE, sql_stats, statement_shape
+
+
+class TestSqlStats(BaseTest):
+    def setUp(self):
+        super().setUp()
+        sql_stats.reset()
+        self.addCleanup(sql_stats.reset)
+
+    @staticmethod
+    def spawn_category(name: str) -> Category:
+        return Category(
+            name=name,
+            description='lorem ipsum...',
+            price=999,
+            prepayment_percent=10,
+            refund_percent=50,
+            rooms_count=2,
+            floors=1,
+            beds=2,
+            square=50,
+            main_photo_path='image.jpg',
+        )
+
+    def test_statement_shape(self):
+        """
+        Тестирование приведения запросов к форме без параметров
+        """
+        self.assertEqual(
+            statement_shape('SELECT * FROM room\n WHERE id IN (%(id_1_1)s, %(id_1_2)s) AND number = %(number_1)s'),
+            statement_shape('SELECT * FROM room WHERE id IN (%(id_1_1)s) AND number = %(number_1)s'),
+        )
+        self.assertEqual(
+            statement_shape('INSERT INTO tag (name) VALUES (%(name__0)s), (%(name__1)s)'),
+            'INSERT INTO tag (name) VALUES (?)',
+        )
+
+    def test_attribution(self):
+        """
+        Тестирование учета запросов по вызовам методов шлюзов и экспорта показателей
+        """
+        was_enabled = sql_stats.enabled
+        with get_session() as session:
+            session.add_all([self.spawn_category(f'category_{i}') for i in range(3)])
+            session.commit()
+
+            with sql_stats.capture() as capture:
+                self.assertEqual(len(CategoriesGateway.get_all(session)), 3)
+                # вложенные вызовы шлюзов засчитываются внешнему
+                free_dates = {'date_from': date.today(), 'date_until': date.today() + timedelta(days=30)}
+                CategoriesGateway.filter(session, {
+                    'show_hidden': True, 'desc': False, 'page_size': 8, 'page': 1, 'sort_by': 'id',
+                    'free_dates': free_dates,
+                })
+                session.execute(select(Category.id)).all()
+
+            calls = capture.by_method('CategoriesGateway.get_all')
+            self.assertEqual((len(calls), calls[0].statements, calls[0].rows), (1, 1, 3))
+            # фильтр по свободным датам - один запрос независимо от кол-ва категорий и дней
+            self.assertEqual(capture.by_method('CategoriesGateway.filter')[0].statements, 1)
+            self.assertEqual(capture.other.statements, 1)
+            self.assertEqual(capture.statements, 3)
+            self.assertEqual(capture.n_plus_one, [])
+
+        # после capture учет возвращается в прежнее состояние
+        self.assertEqual(sql_stats.enabled, was_enabled)
+        snapshot = json.loads(sql_stats.to_json())
+        self.assertEqual(snapshot['CategoriesGateway.get_all']['calls'], 1)
+        self.assertGreaterEqual(snapshot[OUTSIDE]['statements'], 1)
+        metrics = sql_stats.to_prometheus()
+        self.assertIn('# TYPE hotel_gateway_sql_statements_total counter', metrics)
+        self.assertIn('hotel_gateway_sql_rows_total{method="CategoriesGateway.get_all"} 3', metrics)
+
+    def test_n_plus_one(self):
+        """
+        Тестирование обнаружения одинаковых запросов внутри одного вызова
+        """
+        with get_session() as session:
+            categories = [self.spawn_category(f'category_{i}') for i in range(sql_stats.repeat_threshold)]
+            session.add_all(categories)
+            session.commit()
+
+            with sql_stats.capture() as capture:
+                with sql_stats.call('Test.load_one_by_one'):
+                    for category in categories:
+                        session.execute(select(Category.name).where(Category.id == category.id)).one()
+                with sql_stats.call('Test.load_at_once'):
+                    session.execute(select(Category.name).where(Category.id.in_([c.id for c in categories]))).all()
+
+            self.assertEqual([call.method for call in capture.n_plus_one], ['Test.load_one_by_one'])
+            [(shape, count)] = capture.n_plus_one[0].repeated.items()
+            self.assertEqual(count, sql_stats.repeat_threshold)
+            self.assertIn('WHERE category.id = ?', shape)
+            self.assertEqual(sql_stats.snapshot()['Test.load_one_by_one']['n_plus_one'], 1)
+            self.assertEqual(sql_stats.snapshot()['Test.load_at_once']['n_plus_one'], 0)
@@ -0,0 +1,149 @@
+from collections import OrderedDict
+from datetime import date
+from threading import Lock
+from typing import Dict, Hashable, Iterable, List, NamedTuple, Optional, Tuple
+import time
+from ..settings import settings
+from . import purchase_events
+from .purchase_events import PurchaseChange
+
+
+class CacheStats(NamedTuple):
+    hits: int
+    misses: int
+    evictions: int
+    size: int
+
+
+MonthKey = Tuple[int, int, int]
+
+
+class CalendarCache:
+    """
+    LRU кэш календарей свободных комнат категорий по месяцам с ограниченным временем жизни записей.
+    Ключ - (id категории, год, месяц), значение - {дата: кол-во свободных комнат} за весь месяц.
+    Записи сбрасываются по событиям изменения покупок и комнат этого процесса,
+    изменения из других процессов становятся видны только по истечении TTL, поэтому кэш включается явно (enable).
+    Каждый сброс увеличивает поколение кэша: календарь, загрузка которого началась до сброса, не сохраняется.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.generation = 0
+        self.__entries: OrderedDict[MonthKey, Tuple[float, Dict[date, int]]] = OrderedDict()
+        self.__lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def enable(self, max_size: int):
+        """
+        Включение кэша и подписка на изменения покупок
+        :param max_size: кол-во месяцев в кэше
+        """
+        self.max_size = max_size
+        purchase_events.listen(self.on_purchases_changed)
+
+    def disable(self):
+        """
+        Отключение кэша (без подписчиков изменения покупок не собираются)
+        """
+        purchase_events.remove(self.on_purchases_changed)
+        self.max_size = 0
+        self.clear()
+
+    @staticmethod
+    def month_key(category_id: int, day: date) -> MonthKey:
+        return category_id, day.year, day.month
+
+    @staticmethod
+    def next_month(day: date) -> date:
+        return date(day.year + day.month // 12, day.month % 12 + 1, 1)
+
+    @classmethod
+    def months(cls, date_start: date, date_end: date) -> List[date]:
+        """
+        Первые дни месяцев, которые затрагивает период [date_start, date_end]
+        """
+        months = []
+        month = date_start.replace(day=1)
+        while month <= date_end:
+            months.append(month)
+            month = cls.next_month(month)
+        return months
+
+    def get(self, key: MonthKey) -> Optional[Dict[date, int]]:
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.__entries[key]
+                self.misses += 1
+                return None
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: MonthKey, calendar: Dict[date, int], generation: int):
+        """
+        Сохранение календаря месяца
+        :param key: ключ месяца
+        :param calendar: календарь месяца
+        :param generation: поколение кэша, прочитанное до загрузки календаря из БД
+        (если за время загрузки кэш сбрасывался, календарь мог устареть и не сохраняется)
+        """
+        with self.__lock:
+            if generation != self.generation:
+                return
+            self.__entries[key] = (time.monotonic() + self.ttl, calendar)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, keys: Iterable[Hashable]):
+        with self.__lock:
+            self.generation += 1
+            for key in keys:
+                self.__entries.pop(key, None)
+
+    def invalidate_category(self, category_id: int):
+        with self.__lock:
+            self.generation += 1
+            for key in [key for key in self.__entries if key[0] == category_id]:
+                del self.__entries[key]
+
+    def on_purchases_changed(self, changes: List[PurchaseChange]):
+        """
+        Сброс месяцев, ночи которых затронули изменения покупок
+        :param changes: изменения занятости
+        :return:
+        """
+        keys = set()
+        for change in changes:
+            if change.start >= change.end:
+                continue
+            last_night = date.fromordinal(change.end.toordinal() - 1)
+            for month in self.months(change.start, last_night):
+                keys.add(self.month_key(change.category_id, month))
+        self.invalidate(keys)
+
+    def clear(self):
+        with self.__lock:
+            self.generation += 1
+            self.__entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> CacheStats:
+        with self.__lock:
+            return CacheStats(self.hits, self.misses, self.evictions, len(self.__entries))
+
+
+calendar_cache = CalendarCache(0, settings.CALENDAR_CACHE_TTL)
+if settings.CALENDAR_CACHE_SIZE:
+    calendar_cache.enable(settings.CALENDAR_CACHE_SIZE)
@@ -0,0 +1,338 @@
+"""
+Замеры времени выполнения методов шлюзов (гистограммы в духе HdrHistogram), счетчики ошибок
+и профилирование выборочных вызовов, которое включается и выключается во время работы.
+Методы шлюзов оборачиваются декоратором класса instrumented, он же открывает вызов для учета SQL запросов (sql_stats)
+"""
+import cProfile
+import inspect
+import io
+import json
+import pstats
+import random
+import signal
+from collections import deque
+from contextvars import ContextVar
+from functools import wraps
+from threading import Lock
+from time import perf_counter
+from typing import Deque, Dict, NamedTuple, Optional
+from ..settings import settings
+from .sql_stats import sql_stats
+
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+
+class LatencyHistogram:
+    """
+    Гистограмма времени выполнения с постоянной относительной точностью.
+    Значения хранятся в микросекундах по корзинам: внутри каждой степени двойки 2 ** (sub_bucket_bits - 1) корзин,
+    поэтому погрешность процентилей не больше 2 ** (1 - sub_bucket_bits) от значения при любом разбросе времени
+    """
+    def __init__(self, sub_bucket_bits: int = 7):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.sub_buckets = 1 << sub_bucket_bits
+        self.counts: Dict[int, int] = {}
+        self.count = 0
+        self.total = 0
+        self.min: Optional[int] = None
+        self.max: Optional[int] = None
+
+    def __index(self, value: int) -> int:
+        exponent = max(value.bit_length() - self.sub_bucket_bits, 0)
+        return (exponent << self.sub_bucket_bits) + (value >> exponent)
+
+    def __highest(self, index: int) -> int:
+        exponent, sub_bucket = divmod(index, self.sub_buckets)
+        return ((sub_bucket + 1) << exponent) - 1
+
+    def record(self, seconds: float):
+        value = max(int(seconds * 1_000_000), 0)
+        index = self.__index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, percent: float) -> float:
+        """
+        Время, быстрее которого выполнилось percent процентов вызовов
+        :param percent: процент (0-100)
+        :return: время в секундах (0, если замеров нет)
+        """
+        if not self.count:
+            return 0.0
+        rank = max(percent / 100 * self.count, 1)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self.__highest(index), self.max) / 1_000_000
+        return self.max / 1_000_000
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count / 1_000_000 if self.count else 0.0
+
+
+class MethodLatency(NamedTuple):
+    count: int
+    errors: Dict[str, int]
+    mean: float
+    min: float
+    max: float
+    p50: float
+    p90: float
+    p99: float
+    p999: float
+
+
+# квантили в выгрузке Prometheus и поля MethodLatency с ними
+QUANTILES = (('0.5', 'p50'), ('0.9', 'p90'), ('0.99', 'p99'), ('0.999', 'p999'))
+
+
+class GatewayMetrics:
+    """
+    Гистограммы времени выполнения и счетчики ошибок (по классам исключений) методов шлюзов
+    """
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.__lock = Lock()
+        self.__histograms: Dict[str, LatencyHistogram] = {}
+        self.__errors: Dict[str, Dict[str, int]] = {}
+
+    def record(self, method: str, elapsed: float, error: BaseException | None = None):
+        with self.__lock:
+            histogram = self.__histograms.get(method)
+            if histogram is None:
+                histogram = self.__histograms[method] = LatencyHistogram()
+            histogram.record(elapsed)
+            if error is not None:
+                errors = self.__errors.setdefault(method, {})
+                errors[type(error).__name__] = errors.get(type(error).__name__, 0) + 1
+
+    def reset(self):
+        with self.__lock:
+            self.__histograms.clear()
+            self.__errors.clear()
+
+    def snapshot(self) -> Dict[str, MethodLatency]:
+        """
+        Показатели по методам шлюзов
+        :return: {Класс.метод: MethodLatency}, время в секундах
+        """
+        with self.__lock:
+            return {
+                method: MethodLatency(
+                    histogram.count,
+                    dict(self.__errors.get(method, {})),
+                    histogram.mean,
+                    histogram.min / 1_000_000,
+                    histogram.max / 1_000_000,
+                    *(histogram.percentile(percent) for percent in (50, 90, 99, 99.9)),
+                )
+                for method, histogram in sorted(self.__histograms.items())
+            }
+
+    def to_json(self) -> str:
+        return json.dumps({method: latency._asdict() for method, latency in self.snapshot().items()})
+
+    def to_prometheus(self) -> str:
+        """
+        Показатели в текстовом формате Prometheus (summary времени и счетчик ошибок)
+        """
+        snapshot = self.snapshot()
+        lines = [
+            '# HELP hotel_gateway_latency_seconds Время выполнения методов шлюзов',
+            '# TYPE hotel_gateway_latency_seconds summary',
+        ]
+        for method, latency in snapshot.items():
+            for quantile, field in QUANTILES:
+                lines.append(
+                    f'hotel_gateway_latency_seconds{{method="{method}",quantile="{quantile}"}} {getattr(latency, field)}'
+                )
+            lines.append(f'hotel_gateway_latency_seconds_sum{{method="{method}"}} {latency.mean * latency.count}')
+            lines.append(f'hotel_gateway_latency_seconds_count{{method="{method}"}} {latency.count}')
+        lines.append('# HELP hotel_gateway_errors_total Вызовы методов шлюзов, завершившиеся исключением')
+        lines.append('# TYPE hotel_gateway_errors_total counter')
+        for method, latency in snapshot.items():
+            for error, count in sorted(latency.errors.items()):
+                lines.append(f'hotel_gateway_errors_total{{method="{method}",error="{error}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+class CallProfile(NamedTuple):
+    method: str
+    elapsed: float
+    # текстовый отчет профилировщика
+    report: str
+
+
+class CallProfiler:
+    """
+    Профилирование доли вызовов методов шлюзов (cProfile или pyinstrument).
+    Одновременно профилируется один вызов, остальные выбранные вызовы в это время пропускаются
+    """
+    BACKENDS = ('cprofile', 'pyinstrument')
+
+    def __init__(self, keep: int):
+        self.rate = 0.0
+        self.backend = 'cprofile'
+        self.profiles: Deque[CallProfile] = deque(maxlen=keep)
+        self.__busy = Lock()
+        self.__resume_rate = 0.0
+
+    def start(self, rate: float, backend: str = 'cprofile'):
+        """
+        Включение профилирования
+        :param rate: доля профилируемых вызовов (0-1)
+        :param backend: cprofile или pyinstrument
+        """
+        if not 0 < rate <= 1:
+            raise ValueError('доля профилируемых вызовов должна быть больше 0 и не больше 1')
+        if backend not in self.BACKENDS:
+            raise ValueError(f'неизвестный профилировщик: {backend}')
+        if backend == 'pyinstrument' and pyinstrument is None:
+            raise ValueError('для профилирования через pyinstrument нужно установить пакет pyinstrument')
+        self.backend = backend
+        self.rate = rate
+
+    def stop(self):
+        self.rate = 0.0
+
+    def toggle_on_signal(self, signum: int | None = None, rate: float | None = None):
+        """
+        Включение/выключение профилирования сигналом процессу (kill -USR2 <pid>)
+        :param signum: номер сигнала (по умолчанию SIGUSR2, его нет в Windows)
+        :param rate: доля профилируемых вызовов при включении (по умолчанию GATEWAY_PROFILE_RATE или 1%)
+        """
+        self.__resume_rate = rate or settings.GATEWAY_PROFILE_RATE or 0.01
+        if signum is None:
+            signum = signal.SIGUSR2
+
+        def handler(*args):
+            if self.rate:
+                self.stop()
+            else:
+                self.start(self.__resume_rate, self.backend)
+
+        signal.signal(signum, handler)
+
+    def begin(self):
+        """
+        Запуск профилировщика, если вызов попал в выборку
+        :return: профилировщик или None
+        """
+        if random.random() >= self.rate or not self.__busy.acquire(blocking=False):
+            return None
+        try:
+            if self.backend == 'pyinstrument':
+                active = pyinstrument.Profiler()
+                active.start()
+            else:
+                active = cProfile.Profile()
+                active.enable()
+        except BaseException:
+            self.__busy.release()
+            raise
+        return active
+
+    def end(self, active, method: str, elapsed: float):
+        """
+        Остановка профилировщика и сохранение отчета
+        :param active: профилировщик, запущенный begin
+        :param method: профилируемый метод
+        :param elapsed: время выполнения вызова
+        """
+        try:
+            if isinstance(active, cProfile.Profile):
+                active.disable()
+                report = io.StringIO()
+                pstats.Stats(active, stream=report).sort_stats('cumulative').print_stats(30)
+                report = report.getvalue()
+            else:
+                active.stop()
+                report = active.output_text()
+            self.profiles.append(CallProfile(method, elapsed, report))
+        finally:
+            self.__busy.release()
+
+
+gateway_metrics = GatewayMetrics(settings.GATEWAY_METRICS_ENABLED)
+profiler = CallProfiler(settings.GATEWAY_PROFILE_KEEP)
+if settings.GATEWAY_PROFILE_RATE:
+    profiler.start(settings.GATEWAY_PROFILE_RATE, settings.GATEWAY_PROFILE_BACKEND)
+
+# вызывается ли сейчас метод шлюза (профилируются только внешние вызовы)
+_in_call: ContextVar[bool] = ContextVar('in_gateway_call', default=False)
+
+
+def _track(func, method: str):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not (gateway_metrics.enabled or sql_stats.enabled or profiler.rate):
+            return func(*args, **kwargs)
+        outer = not _in_call.get()
+        token = _in_call.set(True)
+        profile = profiler.begin() if outer and profiler.rate else None
+        error = None
+        started = perf_counter()
+        try:
+            if sql_stats.enabled:
+                with sql_stats.call(method):
+                    return func(*args, **kwargs)
+            return func(*args, **kwargs)
+        except BaseException as exc:
+            error = exc
+            raise
+        finally:
+            elapsed = perf_counter() - started
+            if profile is not None:
+                profiler.end(profile, method, elapsed)
+            _in_call.reset(token)
+            if gateway_metrics.enabled:
+                gateway_metrics.record(method, elapsed, error)
+    return wrapper
+
+
+def _track_async(func, method: str):
+    # профилировщики потока не отделяют вызов от других задач цикла событий, поэтому корутины только замеряются
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        if not (gateway_metrics.enabled or sql_stats.enabled):
+            return await func(*args, **kwargs)
+        token = _in_call.set(True)
+        error = None
+        started = perf_counter()
+        try:
+            if sql_stats.enabled:
+                with sql_stats.call(method):
+                    return await func(*args, **kwargs)
+            return await func(*args, **kwargs)
+        except BaseException as exc:
+            error = exc
+            raise
+        finally:
+            elapsed = perf_counter() - started
+            _in_call.reset(token)
+            if gateway_metrics.enabled:
+                gateway_metrics.record(method, elapsed, error)
+    return wrapper
+
+
+def instrumented(cls):
+    """
+    Декоратор класса шлюза: вызовы его публичных статических методов и методов класса замеряются,
+    учитываются в sql_stats и могут профилироваться (асинхронные методы замеряются до завершения корутины)
+    :param cls: класс шлюза
+    :return: тот же класс
+    """
+    for name, attr in list(vars(cls).items()):
+        if name.startswith('_') or not isinstance(attr, (staticmethod, classmethod)):
+            continue
+        track = _track_async if inspect.iscoroutinefunction(attr.__func__) else _track
+        setattr(cls, name, type(attr)(track(attr.__func__, f'{cls.__name__}.{name}')))
+    return cls
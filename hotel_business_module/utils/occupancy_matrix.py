@@ -0,0 +1,376 @@
+import json
+import os
+import select as selectors
+from datetime import date, timedelta
+from multiprocessing import shared_memory, resource_tracker
+from threading import Lock
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, TypeVar
+import uuid
+from sqlalchemy import select, func, cast, and_, Date, Text
+from sqlalchemy.orm import Session
+from ..models.orders import Purchase
+from ..models.rooms import Room
+from .purchase_events import NOTIFY_CHANNEL, PurchaseChange
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+T = TypeVar('T')
+
+
+class Snapshot:
+    """
+    Снимок видимости транзакций PostgreSQL (pg_current_snapshot): по нему определяется,
+    попали ли изменения зафиксированной транзакции в загруженные данные
+    """
+
+    def __init__(self, value: str):
+        xmin, xmax, xip = value.split(':')
+        self.xmin = int(xmin)
+        self.xmax = int(xmax)
+        self.xip = {int(xid) for xid in xip.split(',') if xid}
+
+    def is_visible(self, xid: int) -> bool:
+        return xid < self.xmin or (xid < self.xmax and xid not in self.xip)
+
+
+class OccupancyMatrix:
+    """
+    Снимок занятости комнат (комнаты × дни) в разделяемой памяти.
+    Снимок создается один раз (например в мастер-процессе), воркеры подключаются к нему по имени,
+    поэтому на узле хранится одна копия.
+
+    Пишет в снимок только создавший его процесс: он слушает оповещения триггеров purchase (LISTEN, нужно
+    включить settings.OCCUPANCY_NOTIFY) и точечно применяет изменения броней всех процессов (poll).
+    Оповещения транзакций, уже попавших в загруженные данные, отбрасываются по снимку видимости транзакций.
+    Подключенные воркеры снимок только читают.
+
+    Чтение согласовано через версию (seqlock): на время записи версия нечетная, читатель повторяет чтение,
+    если версия была нечетной или изменилась за время чтения.
+
+    Раскладка памяти: заголовок int64[4] (кол-во комнат, кол-во дней, ordinal первого дня, версия),
+    id комнат int64[комнаты], id категорий int64[комнаты], ячейки uint8[комнаты × дни] с кол-вом броней.
+    Комнаты отсортированы по категории, поэтому комнаты одной категории идут подряд.
+    """
+    HEADER_SIZE = 4
+
+    def __init__(self, shm: shared_memory.SharedMemory, owner: bool = False):
+        if np is None:
+            raise ImportError('Для снимка занятости нужен numpy: pip install hotel_business_module[occupancy]')
+        self.__shm = shm
+        header = np.ndarray((self.HEADER_SIZE,), dtype=np.int64, buffer=shm.buf)
+        rooms_count, days = int(header[0]), int(header[1])
+        offset = header.nbytes
+        self.__header = header
+        self.room_ids = np.ndarray((rooms_count,), dtype=np.int64, buffer=shm.buf, offset=offset)
+        offset += self.room_ids.nbytes
+        self.category_ids = np.ndarray((rooms_count,), dtype=np.int64, buffer=shm.buf, offset=offset)
+        offset += self.category_ids.nbytes
+        self.cells = np.ndarray((rooms_count, days), dtype=np.uint8, buffer=shm.buf, offset=offset)
+        self.__rows = {int(room_id): row for row, room_id in enumerate(self.room_ids)}
+        self.__owner = owner
+        self.__lock = Lock()
+        self.__listener = None
+        self.__snapshot: Optional[Snapshot] = None
+
+    @property
+    def name(self) -> str:
+        return self.__shm.name
+
+    @property
+    def start(self) -> date:
+        return date.fromordinal(int(self.__header[2]))
+
+    @property
+    def days(self) -> int:
+        return int(self.__header[1])
+
+    @property
+    def version(self) -> int:
+        """
+        Номер версии снимка, увеличивается при каждом изменении
+        """
+        return int(self.__header[3]) // 2
+
+    @classmethod
+    def create(cls, db: Session, start: date, days: int, name: Optional[str] = None) -> 'OccupancyMatrix':
+        """
+        Загрузка занятости на горизонт [start, start + days) в новый блок разделяемой памяти
+        и подписка на изменения броней
+        :param db: сессия БД
+        :param start: первый день горизонта
+        :param days: кол-во дней горизонта
+        :param name: имя блока разделяемой памяти, по которому к нему подключаются воркеры
+        :return:
+        """
+        if np is None:
+            raise ImportError('Для снимка занятости нужен numpy: pip install hotel_business_module[occupancy]')
+        rooms = db.execute(
+            select(Room.id, Room.category_id).where(
+                Room.date_deleted == None,
+            ).order_by(Room.category_id, Room.id)
+        ).all()
+
+        rooms_count = len(rooms)
+        size = 8 * (cls.HEADER_SIZE + 2 * rooms_count) + rooms_count * days
+        shm = shared_memory.SharedMemory(
+            name=name or f'hotel_occupancy_{uuid.uuid4().hex[:12]}',
+            create=True,
+            size=max(size, 1),
+        )
+        header = np.ndarray((cls.HEADER_SIZE,), dtype=np.int64, buffer=shm.buf)
+        header[:] = (rooms_count, days, start.toordinal(), 0)
+        matrix = cls(shm, owner=True)
+        if rooms:
+            matrix.room_ids[:] = [room.id for room in rooms]
+            matrix.category_ids[:] = [room.category_id for room in rooms]
+            matrix.__rows = {room.id: row for row, room in enumerate(rooms)}
+        # подписываемся до загрузки, чтоб не пропустить изменения, зафиксированные во время нее
+        matrix.__listen(db)
+        matrix.refresh(db)
+        return matrix
+
+    def __listen(self, db: Session):
+        connection = db.get_bind().raw_connection()
+        # соединение слушателя не возвращается в пул
+        connection.detach()
+        self.__listener = connection.dbapi_connection
+        self.__listener.autocommit = True
+        with self.__listener.cursor() as cursor:
+            cursor.execute(f'LISTEN {NOTIFY_CHANNEL}')
+
+    def __load(self, db: Session) -> Tuple['np.ndarray', Snapshot]:
+        """
+        Подсчет броней по комнатам снимка и дням горизонта по данным БД
+        :return: ячейки и снимок видимости транзакций, с которым они загружены
+        """
+        start, days = self.start, self.days
+        end = start + timedelta(days=days)
+        # снимок видимости берется тем же запросом, что и покупки
+        snapshot = select(cast(func.pg_current_snapshot(), Text).label('snapshot')).subquery()
+        rows = db.execute(
+            select(snapshot.c.snapshot, Purchase.room_id, Purchase.start, Purchase.end).select_from(snapshot).outerjoin(
+                Purchase, and_(
+                    Purchase.is_canceled == False,
+                    func.daterange(Purchase.start, Purchase.end).op('&&')(
+                        func.daterange(cast(start, Date), cast(end, Date))
+                    ),
+                ),
+            )
+        ).all()
+        purchases = [row for row in rows if row.room_id in self.__rows]
+        cells = np.zeros(self.cells.shape, dtype=np.uint8)
+        if purchases:
+            # заполняем через разностный массив: +1 в день заезда, -1 в день выезда, затем накопительная сумма
+            room_rows = np.array([self.__rows[purchase.room_id] for purchase in purchases])
+            starts = np.clip([(purchase.start - start).days for purchase in purchases], 0, days)
+            ends = np.clip([(purchase.end - start).days for purchase in purchases], 0, days)
+            diff = np.zeros((len(self.room_ids), days + 1), dtype=np.int32)
+            np.add.at(diff, (room_rows, starts), 1)
+            np.add.at(diff, (room_rows, ends), -1)
+            cells[:] = np.cumsum(diff, axis=1)[:, :days]
+        return cells, Snapshot(rows[0].snapshot)
+
+    def __check_owner(self):
+        if not self.__owner:
+            raise ValueError('Изменять снимок занятости может только создавший его процесс')
+
+    def __write(self, write: Callable[[], None]):
+        # нечетная версия на время записи, чтоб читатели повторили чтение
+        with self.__lock:
+            self.__header[3] += 1
+            try:
+                write()
+            finally:
+                self.__header[3] += 1
+
+    def __read(self, read: Callable[[], T]) -> T:
+        while True:
+            version = int(self.__header[3])
+            if version % 2 == 0:
+                result = read()
+                if int(self.__header[3]) == version:
+                    return result
+            # запись занимает микросекунды, уступаем процессор пишущему процессу
+            os.sched_yield()
+
+    def refresh(self, db: Session):
+        """
+        Полная перезагрузка занятости из БД (например после потери соединения слушателя).
+        Комнаты, созданные после загрузки снимка, не добавляются - для них снимок нужно создать заново
+        :param db: сессия БД
+        :return:
+        """
+        self.__check_owner()
+        cells, snapshot = self.__load(db)
+
+        def write():
+            self.cells[:] = cells
+            self.__snapshot = snapshot
+
+        self.__write(write)
+
+    def apply(self, changes: Iterable[PurchaseChange]):
+        """
+        Точечное применение изменений броней к снимку
+        :param changes: изменения занятости
+        :return:
+        """
+        self.__check_owner()
+
+        def write():
+            for change in changes:
+                row = self.__rows.get(change.room_id)
+                if row is None:
+                    # комнат, созданных после загрузки снимка, в нем нет
+                    continue
+                first = max((change.start - self.start).days, 0)
+                last = min((change.end - self.start).days, self.days)
+                if first >= last:
+                    continue
+                cells = self.cells[row, first:last]
+                if change.is_busy:
+                    cells += 1
+                else:
+                    cells -= np.minimum(cells, 1)
+
+        self.__write(write)
+
+    def poll(self, timeout: float = 0) -> int:
+        """
+        Применение полученных оповещений об изменениях броней
+        :param timeout: сколько секунд ждать оповещений, если их еще нет
+        :return: кол-во примененных изменений
+        """
+        self.__check_owner()
+        if self.__listener is None:
+            raise ValueError('Снимок занятости не подписан на изменения броней')
+        if timeout and not self.__listener.notifies:
+            selectors.select([self.__listener], [], [], timeout)
+        self.__listener.poll()
+        changes = []
+        while self.__listener.notifies:
+            payload = json.loads(self.__listener.notifies.pop(0).payload)
+            if self.__snapshot.is_visible(int(payload['xid'])):
+                # изменение уже загружено
+                continue
+            changes.append(PurchaseChange(
+                payload['room_id'],
+                0,
+                date.fromisoformat(payload['start']),
+                date.fromisoformat(payload['end']),
+                payload['is_busy'],
+            ))
+        if changes:
+            self.apply(changes)
+        return len(changes)
+
+    @classmethod
+    def attach(cls, name: str) -> 'OccupancyMatrix':
+        """
+        Подключение к снимку, созданному в другом процессе
+        :param name: имя блока разделяемой памяти
+        :return:
+        """
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # до python 3.13 подключение регистрирует блок в resource_tracker, и тот удаляет его
+            # при завершении воркера, хотя блоком владеет создавший его процесс
+            shm = shared_memory.SharedMemory(name=name)
+            if os.name == 'posix':
+                resource_tracker.unregister(f'/{shm.name}', 'shared_memory')
+        return cls(shm)
+
+    def close(self):
+        if self.__listener is not None:
+            self.__listener.close()
+            self.__listener = None
+        self.cells = self.room_ids = self.category_ids = self.__header = None
+        self.__shm.close()
+
+    def unlink(self):
+        """
+        Удаление блока разделяемой памяти (вызывает процесс, создавший снимок)
+        """
+        if os.name == 'posix':
+            # воркеры, запущенные fork, делят resource_tracker с создателем, и attach в них снимает регистрацию блока,
+            # поэтому регистрируем его заново (повторная регистрация ничего не меняет), чтоб unlink снял ее без ошибки
+            resource_tracker.register(f'/{self.__shm.name}', 'shared_memory')
+        self.__shm.unlink()
+
+    def __days_slice(self, date_start: date, date_end: date) -> Tuple[int, int]:
+        """
+        Индексы дней [date_start, date_end) в снимке
+        """
+        first = (date_start - self.start).days
+        last = (date_end - self.start).days
+        if first < 0 or last > self.days or first > last:
+            raise ValueError('Период выходит за пределы снимка занятости')
+        return first, last
+
+    def __category_rows(self, category_id: int) -> slice:
+        # комнаты отсортированы по категориям, поэтому комнаты категории занимают непрерывный диапазон строк
+        first, last = np.searchsorted(self.category_ids, [category_id, category_id + 1])
+        return slice(int(first), int(last))
+
+    def free_rooms_by_category(self, date_start: date, date_end: date) -> Tuple['np.ndarray', 'np.ndarray']:
+        """
+        Кол-во свободных комнат каждой категории по дням
+        :param date_start: дата начала проверки
+        :param date_end: дата конца проверки (включительно)
+        :return: id категорий и матрица (категории × дни) кол-ва свободных комнат (прошедшие даты - 0)
+        """
+        first, last = self.__days_slice(date_start, date_end + timedelta(days=1))
+        if not len(self.category_ids):
+            return self.category_ids.copy(), np.zeros((0, last - first), dtype=np.int64)
+        free = self.__read(lambda: (self.cells[:, first:last] == 0).astype(np.int64))
+        # прошедшие даты считаются полностью занятыми, как и в get_free_rooms
+        past = min(max((date.today() - date_start).days, 0), last - first)
+        free[:, :past] = 0
+        categories, offsets = np.unique(self.category_ids, return_index=True)
+        return categories, np.add.reduceat(free, offsets, axis=0)
+
+    def get_free_rooms(self, category_id: int, date_start: date, date_end: date) -> Dict[date, int]:
+        """
+        Кол-во свободных комнат категории по дням (прошедшие даты считаются полностью занятыми)
+        :param category_id: id категории
+        :param date_start: дата начала проверки
+        :param date_end: дата конца проверки (включительно)
+        :return: словарь {дата: кол-во свободных комнат}
+        """
+        first, last = self.__days_slice(date_start, date_end + timedelta(days=1))
+        rows = self.__category_rows(category_id)
+        free = self.__read(lambda: (self.cells[rows, first:last] == 0).sum(axis=0))
+        today = date.today()
+        calendar = {}
+        for offset, count in enumerate(free):
+            day = date_start + timedelta(days=offset)
+            calendar[day] = int(count) if day >= today else 0
+        return calendar
+
+    def get_busy_dates(self, category_id: int, date_start: date, date_end: date) -> List[date]:
+        calendar = self.get_free_rooms(category_id, date_start, date_end)
+        return [day for day, free in calendar.items() if free <= 0]
+
+    def is_day_busy(self, category_id: int, day: date) -> bool:
+        first, last = self.__days_slice(day, day + timedelta(days=1))
+        rows = self.__category_rows(category_id)
+        return self.__read(lambda: not (self.cells[rows, first] == 0).any())
+
+    def pick_room(self, category_id: int, start: date, end: date) -> Optional[int]:
+        """
+        Поиск свободной на весь период комнаты категории
+        :param category_id: id категории
+        :param start: дата начала брони
+        :param end: дата конца брони
+        :return: id комнаты с наименьшим id, если нашлась подходящая, иначе None
+        """
+        first, last = self.__days_slice(start, end)
+        rows = self.__category_rows(category_id)
+        free = self.__read(lambda: ~self.cells[rows, first:last].any(axis=1))
+        if not free.any():
+            return None
+        return int(self.room_ids[rows][free].min())
@@ -0,0 +1,95 @@
+"""
+Хэширование паролей bcrypt. Синхронные функции выполняют хэширование в текущем потоке,
+асинхронный PasswordHasher - в ограниченном пуле потоков или процессов, не блокируя цикл событий
+"""
+import asyncio
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from threading import Lock
+from typing import Optional
+import bcrypt
+from ..settings import settings
+
+
+def hash_password(password: str, rounds: int | None = None) -> str:
+    """
+    Хэширование пароля (bcrypt сохраняет соль и стоимость прямо в хэш)
+    :param password: пароль в чистом виде
+    :param rounds: стоимость (log2 кол-ва раундов), по умолчанию BCRYPT_ROUNDS
+    :return: хэш пароля
+    """
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds or settings.BCRYPT_ROUNDS)).decode('utf-8')
+
+
+def check_password(password: str, hashed_password: str | None) -> bool:
+    """
+    Проверка пароля по хэшу
+    :param password: пароль в чистом виде
+    :param hashed_password: хэш пароля (None - пароль не задан)
+    :return: совпадает ли пароль
+    """
+    if not hashed_password:
+        return False
+    return bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8'))
+
+
+def needs_rehash(hashed_password: str) -> bool:
+    """
+    Проверка, посчитан ли хэш с меньшей стоимостью, чем задана в BCRYPT_ROUNDS
+    (более стойкие хэши не пересчитываются, чтоб снижение BCRYPT_ROUNDS не ослабляло их)
+    :param hashed_password: хэш пароля ($2b$<стоимость>$...)
+    """
+    return int(hashed_password.split('$')[2]) < settings.BCRYPT_ROUNDS
+
+
+class PasswordHasher:
+    """
+    Хэширование паролей в пуле (thread - потоки, bcrypt отпускает GIL; process - процессы).
+    Кол-во одновременных хэширований ограничено размером пула, остальные ждут в очереди пула
+    """
+    POOLS = {'thread': ThreadPoolExecutor, 'process': ProcessPoolExecutor}
+
+    def __init__(self, pool: str, workers: int):
+        if pool not in self.POOLS:
+            raise ValueError(f'Неизвестный тип пула хэширования паролей: {pool}')
+        self.pool = pool
+        self.workers = workers or os.cpu_count() or 1
+        self.__executor: Optional[Executor] = None
+        self.__lock = Lock()
+
+    def __get_executor(self) -> Executor:
+        if self.__executor is None:
+            with self.__lock:
+                if self.__executor is None:
+                    self.__executor = self.POOLS[self.pool](max_workers=self.workers)
+        return self.__executor
+
+    async def hash(self, password: str) -> str:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.__get_executor(), hash_password, password, settings.BCRYPT_ROUNDS)
+
+    async def check(self, password: str, hashed_password: str | None) -> bool:
+        if not hashed_password:
+            return False
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.__get_executor(), check_password, password, hashed_password)
+
+    def shutdown(self, wait: bool = True):
+        """
+        Остановка пула (следующее хэширование создаст его заново)
+        """
+        with self.__lock:
+            executor, self.__executor = self.__executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def after_fork(self):
+        # потоки и процессы пула родителя в дочернем процессе недоступны
+        self.__executor = None
+        self.__lock = Lock()
+
+
+password_hasher = PasswordHasher(settings.PASSWORD_HASH_POOL, settings.PASSWORD_HASH_WORKERS)
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=password_hasher.after_fork)
@@ -0,0 +1,76 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import FrozenSet, Optional, Tuple
+import time
+from ..settings import settings
+from .calendar_cache import CacheStats
+
+
+class PermissionCache:
+    """
+    LRU кэш кодов прав пользователей (id пользователя -> frozenset кодов).
+    Каждая запись хранит версию прав, при которой она была загружена. Изменение групп пользователей,
+    прав групп и самих прав увеличивает версию, после чего все записи старой версии считаются устаревшими.
+    Изменения из других процессов становятся видны по истечении TTL
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.version = 0
+        self.__entries: OrderedDict[int, Tuple[int, float, FrozenSet[str]]] = OrderedDict()
+        self.__lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def get(self, user_id: int) -> Optional[FrozenSet[str]]:
+        with self.__lock:
+            entry = self.__entries.get(user_id)
+            if entry is None or entry[0] != self.version or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self.__entries[user_id]
+                self.misses += 1
+                return None
+            self.__entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[2]
+
+    def set(self, user_id: int, codes: FrozenSet[str], version: int):
+        """
+        Сохранение прав пользователя
+        :param user_id: id пользователя
+        :param codes: коды прав
+        :param version: версия прав, прочитанная до загрузки кодов из БД
+        (если за время загрузки права изменились, запись сразу будет устаревшей)
+        """
+        with self.__lock:
+            self.__entries[user_id] = (version, time.monotonic() + self.ttl, codes)
+            self.__entries.move_to_end(user_id)
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+                self.evictions += 1
+
+    def bump(self):
+        """
+        Увеличение версии прав: все сохраненные права становятся устаревшими
+        """
+        with self.__lock:
+            self.version += 1
+            self.__entries.clear()
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> CacheStats:
+        with self.__lock:
+            return CacheStats(self.hits, self.misses, self.evictions, len(self.__entries))
+
+
+permission_cache = PermissionCache(settings.PERMISSION_CACHE_SIZE, settings.PERMISSION_CACHE_TTL)
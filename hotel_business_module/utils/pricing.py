@@ -0,0 +1,42 @@
+from _decimal import Decimal
+from collections import Counter
+from typing import Iterable, NamedTuple
+
+
+class PurchasePrices(NamedTuple):
+    price: Decimal
+    prepayment: Decimal
+    refund: Decimal
+
+
+def calculate_prices(
+        night_price: Decimal,
+        prepayment_percent: float,
+        refund_percent: float,
+        nightly_discounts: Iterable[float],
+) -> PurchasePrices:
+    """
+    Расчет цен покупки (без обращений к БД)
+    :param night_price: цена ночи категории
+    :param prepayment_percent: процент предоплаты категории
+    :param refund_percent: процент возврата категории
+    :param nightly_discounts: скидки на каждую ночь покупки (0 - без скидки)
+    :return: цена, предоплата и возврат
+    """
+    price = Decimal(0)
+    # ночи с одинаковой скидкой считаем вместе
+    for discount, nights in sorted(Counter(nightly_discounts).items()):
+        # стандартная цена
+        default_price: Decimal = night_price * nights
+        if discount:
+            # если есть скидка, то считаем цену с ее учетом
+            sale_ration = Decimal(discount / 100)
+            price += default_price - (default_price * sale_ration)
+        else:
+            price += default_price
+
+    # считаем предоплату
+    prepayment_ratio = Decimal(prepayment_percent / 100)
+    # считаем возврат
+    refund_ratio = Decimal(refund_percent / 100)
+    return PurchasePrices(price, price * prepayment_ratio, price * refund_ratio)
@@ -0,0 +1,62 @@
+from datetime import date, datetime
+from typing import Callable, Iterable, List, NamedTuple
+
+# канал NOTIFY, в который триггеры purchase отправляют изменения занятости (между процессами),
+# и параметр сервера, включающий эти оповещения для соединения
+NOTIFY_CHANNEL = 'purchase_occupancy'
+NOTIFY_SETTING = 'hotel.occupancy_notify'
+
+
+class PurchaseChange(NamedTuple):
+    """
+    Изменение занятости комнаты: ночи [start, end) заняты или освобождены
+    """
+    room_id: int
+    category_id: int
+    start: date
+    end: date
+    is_busy: bool
+
+    @classmethod
+    def of(cls, room_id: int, category_id: int, start: date, end: date, is_busy: bool):
+        # у несохраненных покупок даты могут быть переданы как datetime
+        if isinstance(start, datetime):
+            start = start.date()
+        if isinstance(end, datetime):
+            end = end.date()
+        return cls(room_id, category_id, start, end, is_busy)
+
+
+PurchaseListener = Callable[[List[PurchaseChange]], None]
+
+_listeners: List[PurchaseListener] = []
+
+
+def listen(listener: PurchaseListener):
+    """
+    Подписка на изменения занятости комнат (вызывается после фиксации транзакции)
+    """
+    if listener not in _listeners:
+        _listeners.append(listener)
+
+
+def remove(listener: PurchaseListener):
+    if listener in _listeners:
+        _listeners.remove(listener)
+
+
+def has_listeners() -> bool:
+    return bool(_listeners)
+
+
+def dispatch(changes: Iterable[PurchaseChange]):
+    """
+    Оповещение подписчиков об изменениях занятости
+    :param changes: изменения занятости
+    :return:
+    """
+    changes = list(changes)
+    if not changes:
+        return
+    for listener in list(_listeners):
+        listener(changes)
@@ -0,0 +1,117 @@
+from bisect import bisect_right
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from threading import Lock
+from typing import Dict, Iterable, List, Tuple
+import time
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from ..models.sales import Sale, category_sale
+from ..settings import settings
+
+
+class DiscountTimeline:
+    """
+    Действующая скидка категории по дням: непересекающиеся интервалы [начало, конец) с максимальной скидкой
+    """
+
+    def __init__(self, sales: Iterable[Tuple[datetime, datetime, float]] = ()):
+        # скидка действует в день, если период скидки задевает этот день
+        periods = [
+            (start_date.date(), end_date.date() + timedelta(days=1), discount)
+            for start_date, end_date, discount in sales
+        ]
+        points = sorted({point for start, end, _ in periods for point in (start, end)})
+        self.intervals: List[Tuple[date, date, float]] = []
+        for start, end in zip(points, points[1:]):
+            discount = max(
+                (discount for period_start, period_end, discount in periods if period_start <= start and end <= period_end),
+                default=0,
+            )
+            if not discount:
+                continue
+            if self.intervals and self.intervals[-1][1] == start and self.intervals[-1][2] == discount:
+                # соседние интервалы с одинаковой скидкой объединяем
+                start = self.intervals.pop()[0]
+            self.intervals.append((start, end, discount))
+        self.__starts = [start for start, _, _ in self.intervals]
+
+    def discount_on(self, day: date) -> float:
+        index = bisect_right(self.__starts, day) - 1
+        if index >= 0 and day < self.intervals[index][1]:
+            return self.intervals[index][2]
+        return 0
+
+    def nightly_discounts(self, start: date, end: date) -> List[float]:
+        """
+        Скидки на каждую ночь периода [start, end)
+        """
+        return [self.discount_on(start + timedelta(days=night)) for night in range((end - start).days)]
+
+
+class SalesTimelineCache:
+    """
+    LRU кэш графиков скидок категорий. Графики загружаются одним запросом для всех недостающих категорий
+    и сбрасываются при изменении скидок и их привязки к категориям.
+    Сброс действует только в текущем процессе, в остальных процессах графики обновляются по истечении ttl
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.__timelines: OrderedDict[int, Tuple[float, DiscountTimeline]] = OrderedDict()
+        self.__lock = Lock()
+
+    def get_many(self, category_ids: Iterable[int], db: Session) -> Dict[int, DiscountTimeline]:
+        """
+        Получение графиков скидок категорий
+        :param category_ids: id категорий
+        :param db: сессия БД
+        :return: словарь {id категории: график скидок}
+        """
+        category_ids = set(category_ids)
+        now = time.monotonic()
+        with self.__lock:
+            timelines = {}
+            for category_id in category_ids:
+                entry = self.__timelines.get(category_id)
+                if entry is not None and entry[0] >= now:
+                    self.__timelines.move_to_end(category_id)
+                    timelines[category_id] = entry[1]
+        missing = category_ids - timelines.keys()
+        if missing:
+            rows = db.execute(
+                select(category_sale.c.category_id, Sale.start_date, Sale.end_date, Sale.discount).join(
+                    Sale, Sale.id == category_sale.c.sale_id,
+                ).where(
+                    category_sale.c.category_id.in_(missing),
+                    Sale.date_deleted == None,
+                )
+            ).all()
+            sales = {category_id: [] for category_id in missing}
+            for category_id, start_date, end_date, discount in rows:
+                sales[category_id].append((start_date, end_date, discount))
+            loaded = {category_id: DiscountTimeline(periods) for category_id, periods in sales.items()}
+            with self.__lock:
+                for category_id, timeline in loaded.items():
+                    self.__timelines[category_id] = (now + self.ttl, timeline)
+                    self.__timelines.move_to_end(category_id)
+                while len(self.__timelines) > self.max_size:
+                    self.__timelines.popitem(last=False)
+            timelines.update(loaded)
+        return timelines
+
+    def get(self, category_id: int, db: Session) -> DiscountTimeline:
+        return self.get_many([category_id], db)[category_id]
+
+    def invalidate(self, category_ids: Iterable[int]):
+        with self.__lock:
+            for category_id in category_ids:
+                self.__timelines.pop(category_id, None)
+
+    def clear(self):
+        with self.__lock:
+            self.__timelines.clear()
+
+
+sales_timeline = SalesTimelineCache(settings.SALES_TIMELINE_SIZE, settings.SALES_TIMELINE_TTL)
@@ -0,0 +1,267 @@
+"""
+Учет SQL запросов по вызовам методов шлюзов (включается явно: SQL_STATS_ENABLED или sql_stats.enable()).
+Запросы, отправленные во время вызова публичного метода шлюза (gateway_metrics.instrumented), засчитываются этому методу
+(при вложенных вызовах - внешнему, т.е. методу, который вызвал код приложения).
+Если внутри одного вызова запрос одной и той же формы повторяется repeat_threshold раз и больше,
+вызов помечается как N+1
+"""
+import json
+import re
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from time import perf_counter
+from typing import Dict, List, Optional
+from sqlalchemy import Engine, event
+from ..settings import settings
+
+# метод, которому засчитываются запросы вне вызовов шлюзов
+OUTSIDE = 'other'
+
+_PARAMS = re.compile(r'%\(\w+\)s|%s|\$\d+')
+_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_ROWS = re.compile(r'\(\?\)(?:\s*,\s*\(\?\))+')
+
+
+def statement_shape(statement: str) -> str:
+    """
+    Форма запроса: текст без параметров, списки IN и строки VALUES любой длины сведены к одному элементу
+    :param statement: текст запроса
+    :return: форма запроса
+    """
+    shape = _PARAMS.sub('?', statement)
+    shape = _LISTS.sub('(?)', shape)
+    shape = _ROWS.sub('(?)', shape)
+    return ' '.join(shape.split())
+
+
+class GatewayCall:
+    """
+    Запросы одного вызова метода шлюза
+    """
+    def __init__(self, method: str, repeat_threshold: int):
+        self.method = method
+        self.repeat_threshold = repeat_threshold
+        self.statements = 0
+        self.rows = 0
+        self.time = 0.0
+        self.shapes: Counter[str] = Counter()
+
+    def add(self, shape: str, rows: int, elapsed: float):
+        self.statements += 1
+        self.rows += rows
+        self.time += elapsed
+        self.shapes[shape] += 1
+
+    @property
+    def repeated(self) -> Dict[str, int]:
+        """
+        Формы запросов, повторившиеся repeat_threshold раз и больше, и кол-во их повторов
+        """
+        return {shape: count for shape, count in self.shapes.items() if count >= self.repeat_threshold}
+
+
+class MethodTotals:
+    """
+    Накопленные показатели метода шлюза
+    """
+    def __init__(self):
+        self.calls = 0
+        self.statements = 0
+        self.rows = 0
+        self.time = 0.0
+        self.max_statements = 0
+        self.n_plus_one = 0
+        # последняя повторявшаяся форма запроса (пример для разбора)
+        self.repeated_shape: Optional[str] = None
+
+    def add(self, call: GatewayCall, counts_as_call: bool = True):
+        self.calls += counts_as_call
+        self.statements += call.statements
+        self.rows += call.rows
+        self.time += call.time
+        self.max_statements = max(self.max_statements, call.statements)
+        repeated = call.repeated
+        if repeated:
+            self.n_plus_one += 1
+            self.repeated_shape = max(repeated, key=repeated.get)
+
+    def as_dict(self) -> dict:
+        return {
+            'calls': self.calls,
+            'statements': self.statements,
+            'rows': self.rows,
+            'time': self.time,
+            'max_statements': self.max_statements,
+            'n_plus_one': self.n_plus_one,
+            'repeated_shape': self.repeated_shape,
+        }
+
+
+class Capture:
+    """
+    Вызовы шлюзов и запросы, выполненные внутри блока sql_stats.capture()
+    """
+    def __init__(self, repeat_threshold: int):
+        self.calls: List[GatewayCall] = []
+        self.other = GatewayCall(OUTSIDE, repeat_threshold)
+
+    @property
+    def statements(self) -> int:
+        return sum(call.statements for call in self.calls) + self.other.statements
+
+    def by_method(self, method: str) -> List[GatewayCall]:
+        """
+        Вызовы метода шлюза
+        :param method: название метода (Класс.метод)
+        """
+        return [call for call in self.calls if call.method == method]
+
+    @property
+    def n_plus_one(self) -> List[GatewayCall]:
+        """
+        Вызовы, в которых одинаковые запросы повторялись
+        """
+        return [call for call in self.calls if call.repeated]
+
+
+# вызов шлюза текущего потока (задачи)
+_current: ContextVar[Optional[GatewayCall]] = ContextVar('gateway_call', default=None)
+
+# метрики в формате Prometheus: название, поле MethodTotals, тип, описание
+PROMETHEUS_METRICS = (
+    ('hotel_gateway_calls_total', 'calls', 'counter', 'Вызовы методов шлюзов'),
+    ('hotel_gateway_sql_statements_total', 'statements', 'counter', 'SQL запросы методов шлюзов'),
+    ('hotel_gateway_sql_rows_total', 'rows', 'counter', 'Строки, полученные или измененные запросами'),
+    ('hotel_gateway_sql_seconds_total', 'time', 'counter', 'Время выполнения запросов'),
+    ('hotel_gateway_sql_max_statements', 'max_statements', 'gauge', 'Максимум запросов за один вызов'),
+    ('hotel_gateway_sql_n_plus_one_total', 'n_plus_one', 'counter', 'Вызовы с повторяющимися запросами (N+1)'),
+)
+
+
+class SqlStats:
+    """
+    Сборщик статистики запросов всех движков (события before/after_cursor_execute)
+    """
+    def __init__(self, repeat_threshold: int):
+        self.repeat_threshold = repeat_threshold
+        self.enabled = False
+        self.__lock = Lock()
+        self.__methods: Dict[str, MethodTotals] = {}
+        self.__captures: List[Capture] = []
+
+    def enable(self):
+        """
+        Включение учета запросов
+        """
+        with self.__lock:
+            if not self.enabled:
+                event.listen(Engine, 'before_cursor_execute', self.__before_execute)
+                event.listen(Engine, 'after_cursor_execute', self.__after_execute)
+                self.enabled = True
+
+    def disable(self):
+        """
+        Отключение учета запросов (накопленные данные сохраняются)
+        """
+        with self.__lock:
+            if self.enabled:
+                event.remove(Engine, 'before_cursor_execute', self.__before_execute)
+                event.remove(Engine, 'after_cursor_execute', self.__after_execute)
+                self.enabled = False
+
+    def reset(self):
+        with self.__lock:
+            self.__methods.clear()
+
+    @staticmethod
+    def __before_execute(conn, cursor, statement, parameters, context, executemany):
+        context._sql_stats_started = perf_counter()
+
+    def __after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = perf_counter() - context._sql_stats_started
+        rows = max(cursor.rowcount, 0)
+        shape = statement_shape(statement)
+        call = _current.get()
+        if call is not None:
+            call.add(shape, rows, elapsed)
+            return
+        # запрос вне шлюзов учитывается сразу
+        single = GatewayCall(OUTSIDE, self.repeat_threshold)
+        single.add(shape, rows, elapsed)
+        with self.__lock:
+            self.__methods.setdefault(OUTSIDE, MethodTotals()).add(single, counts_as_call=False)
+            for capture in self.__captures:
+                capture.other.add(shape, rows, elapsed)
+
+    @contextmanager
+    def call(self, method: str):
+        """
+        Учет запросов вызова метода шлюза (вложенные вызовы учитываются во внешнем)
+        :param method: название метода (Класс.метод)
+        :return: данные вызова
+        """
+        current = _current.get()
+        if current is not None:
+            yield current
+            return
+        call = GatewayCall(method, self.repeat_threshold)
+        token = _current.set(call)
+        try:
+            yield call
+        finally:
+            _current.reset(token)
+            with self.__lock:
+                self.__methods.setdefault(method, MethodTotals()).add(call)
+                for capture in self.__captures:
+                    capture.calls.append(call)
+
+    @contextmanager
+    def capture(self):
+        """
+        Сбор вызовов шлюзов и запросов внутри блока (для тестов), учет включается на время блока
+        :return: Capture
+        """
+        was_enabled = self.enabled
+        self.enable()
+        capture = Capture(self.repeat_threshold)
+        with self.__lock:
+            self.__captures.append(capture)
+        try:
+            yield capture
+        finally:
+            with self.__lock:
+                self.__captures.remove(capture)
+            if not was_enabled:
+                self.disable()
+
+    def snapshot(self) -> Dict[str, dict]:
+        """
+        Накопленные показатели по методам шлюзов
+        :return: {Класс.метод: показатели}
+        """
+        with self.__lock:
+            return {method: totals.as_dict() for method, totals in sorted(self.__methods.items())}
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), ensure_ascii=False)
+
+    def to_prometheus(self) -> str:
+        """
+        Показатели в текстовом формате Prometheus
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for name, field, kind, description in PROMETHEUS_METRICS:
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {kind}')
+            for method, totals in snapshot.items():
+                lines.append(f'{name}{{method="{method}"}} {totals[field]}')
+        return '\n'.join(lines) + '\n'
+
+
+sql_stats = SqlStats(settings.SQL_STATS_REPEAT_THRESHOLD)
+if settings.SQL_STATS_ENABLED:
+    sql_stats.enable()
+
@@ -19,4 +19,9 @@ setup(
         'python-dotenv==1.0.0',
         'coverage==7.2.4',
     ],
+    extras_require={
+        'occupancy': ['numpy'],
+        'async': ['asyncpg'],
+        'profiling': ['pyinstrument'],
+    },
 )